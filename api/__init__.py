@@ -1,5 +1,12 @@
 from __future__ import annotations
 
-from api.main import app
+from typing import Any
 
-__global__ = app
+
+def __getattr__(name: str) -> Any:
+    # Importing `api.jobs` or `api.sessions` should not build the whole app, `fastapi dev api` still finds `app`
+    if name in ('app', '__global__'):
+        from api.main import app
+
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,64 @@
+"""Single-flight coalescing of identical concurrent API calls."""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    TypeVar,
+)
+
+from pydantic import BaseModel
+
+T = TypeVar('T')
+
+
+class CoalescingStats(BaseModel):
+    """Counters of a `SingleFlight`."""
+
+    calls: int = 0
+    collapsed: int = 0
+    in_flight: int = 0
+
+
+def request_key(endpoint: str, body: Dict[str, Any]) -> str:
+    """Return the key of a request: the endpoint and a hash of its body with sorted keys."""
+    normalized_body = json.dumps(body, sort_keys=True, separators=(',', ':'), default=str)
+    return f'{endpoint}:{hashlib.sha256(normalized_body.encode()).hexdigest()}'
+
+
+class SingleFlight:
+    """Run at most one call per key at a time, the concurrent callers with the same key share its result."""
+
+    def __init__(self) -> None:
+        """Initialize a new instance of the `SingleFlight` class."""
+        self._in_flight: Dict[str, asyncio.Future[Any]] = {}
+        self._stats = CoalescingStats()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Return the result of `fn`, or of the call already in flight for `key`."""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._stats.collapsed += 1
+        else:
+            self._stats.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # The call is shielded so that a caller that goes away does not cancel it for the other callers
+        return await asyncio.shield(future)
+
+    def _forget(self, key: str, future: asyncio.Future[Any]) -> None:
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved, the callers may all have gone away
+            future.exception()
+
+    def stats(self) -> CoalescingStats:
+        """Return a snapshot of the counters."""
+        return self._stats.model_copy(update={'in_flight': len(self._in_flight)})
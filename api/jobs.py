@@ -0,0 +1,322 @@
+"""Background jobs, so that the long graph operations do not hold an HTTP connection open until they finish.
+
+A job is submitted with the coroutine function doing the work and gets an id right away. Its id goes through a
+`JobQueue`, FIFO and bounded by default, to a fixed pool of worker tasks running in the event loop of the API, and its
+status and result are polled by id. Queued and running jobs can be cancelled, the finished jobs are forgotten once
+their result is older than the time to live.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
+
+from loguru import logger
+from pydantic import (
+    BaseModel,
+    Field,
+)
+
+from llm_graphs.metrics import register_callback_gauge
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_QUEUED = 256
+DEFAULT_RESULT_TTL = 3600.0
+
+JobStatus = Literal['queued', 'running', 'succeeded', 'failed', 'cancelled']
+FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled')
+
+
+class JobQueueFullError(RuntimeError):
+    """The job queue holds as many jobs as it can."""
+
+
+class Job(BaseModel):
+    """The status of a job, and its result or errors once finished."""
+
+    job_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    kind: str
+    status: JobStatus = 'queued'
+    result: Any = None
+    errors: List[str] = []
+    created_at: float = Field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+class JobStats(BaseModel):
+    """Counters of a `JobRunner`."""
+
+    submitted: int = 0
+    rejected: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    expired: int = 0
+    queued: int = 0
+    running: int = 0
+
+
+class JobQueue(ABC):
+    """Interface of the queues handing the ids of the submitted jobs to the workers."""
+
+    @abstractmethod
+    def put_nowait(self, job_id: str) -> None:
+        """Enqueue a job id, raise `JobQueueFullError` when the queue is full."""
+
+    @abstractmethod
+    async def get(self) -> str:
+        """Wait for and return the next job id."""
+
+    @abstractmethod
+    def qsize(self) -> int:
+        """Return the number of job ids in the queue."""
+
+
+class MemoryJobQueue(JobQueue):
+    """In-memory FIFO queue of job ids."""
+
+    def __init__(self, max_size: int = DEFAULT_MAX_QUEUED) -> None:
+        """Initialize a new instance of the `MemoryJobQueue` class.
+
+        Parameter
+            max_size (int): The number of queued jobs above which the new ones are rejected.
+        """
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_size)
+
+    def put_nowait(self, job_id: str) -> None:
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull as e:
+            raise JobQueueFullError(f'{self._queue.maxsize} jobs are already queued') from e
+
+    async def get(self) -> str:
+        return await self._queue.get()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+class JobRunner:
+    """Run the submitted jobs on a bounded pool of worker tasks and keep their results until they expire."""
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_queued: int = DEFAULT_MAX_QUEUED,
+        result_ttl: float = DEFAULT_RESULT_TTL,
+        queue_factory: Callable[[int], JobQueue] = MemoryJobQueue,
+    ) -> None:
+        """Initialize a new instance of the `JobRunner` class.
+
+        Parameter
+            max_workers (int): The number of jobs running at the same time.
+            max_queued (int): The number of jobs waiting for a worker above which the submissions are rejected.
+            result_ttl (float): The number of seconds a finished job is kept after it finished.
+            queue_factory (Callable[[int], JobQueue]): Build the queue of the job ids from `max_queued`, called in the
+                event loop of the workers.
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers should be at least 1')
+        self.max_workers: int = max_workers
+        self.max_queued: int = max_queued
+        self.result_ttl: float = result_ttl
+        self._queue_factory = queue_factory
+        self._queue: Optional[JobQueue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._workers: List[asyncio.Task[None]] = []
+        self._jobs: Dict[str, Job] = {}
+        self._functions: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._tasks: Dict[str, asyncio.Task[Any]] = {}
+        self._stats = JobStats()
+
+    def start(self) -> JobQueue:
+        """Start the workers in the running event loop, unless they already run in it, and return their queue."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._queue is not None:
+            return self._queue
+        self._loop = loop
+        queue = self._queue = self._queue_factory(self.max_queued)
+        self._workers = [loop.create_task(self._work(queue)) for _ in range(self.max_workers)]
+        return queue
+
+    async def aclose(self) -> None:
+        """Stop the workers and cancel the queued and running jobs."""
+        for task in [*self._workers, *self._tasks.values()]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._tasks.values(), return_exceptions=True)
+        for job in self._jobs.values():
+            if job.status not in FINISHED_STATUSES:
+                self._finish(job, 'cancelled')
+        self._functions.clear()
+        self._workers = []
+        self._loop = None
+        self._queue = None
+
+    def submit(self, kind: str, fn: Callable[[], Awaitable[Any]]) -> Job:
+        """Queue the call of `fn` and return its job.
+
+        Parameter
+            kind (str): What the job does, reported in its status.
+            fn (Callable[[], Awaitable[Any]]): The coroutine function whose result is the result of the job.
+
+        Raise
+            JobQueueFullError: When `max_queued` jobs are already waiting for a worker.
+        """
+        queue = self.start()
+        self._expire()
+        job = Job(kind=kind)
+        try:
+            queue.put_nowait(job.job_id)
+        except JobQueueFullError:
+            self._stats.rejected += 1
+            raise
+        self._jobs[job.job_id] = job
+        self._functions[job.job_id] = fn
+        self._stats.submitted += 1
+        return job.model_copy()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return the job, or None when it does not exist or has expired."""
+        self._expire()
+        job = self._jobs.get(job_id)
+        return job.model_copy() if job is not None else None
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancel the job if it is not finished yet and return it, or None when it does not exist or has expired."""
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == 'queued':
+            # Its id stays in the queue, the worker getting it skips it
+            del self._functions[job_id]
+            self._finish(job, 'cancelled')
+        elif job.status == 'running':
+            self._tasks[job_id].cancel()
+        return job.model_copy()
+
+    def stats(self) -> JobStats:
+        """Return a snapshot of the counters and of the number of queued and running jobs."""
+        statuses = [job.status for job in self._jobs.values()]
+        return self._stats.model_copy(update={'queued': statuses.count('queued'), 'running': statuses.count('running')})
+
+    def _finish(self, job: Job, status: JobStatus) -> None:
+        job.status = status
+        job.finished_at = time.time()
+        if status == 'succeeded':
+            self._stats.succeeded += 1
+        elif status == 'failed':
+            self._stats.failed += 1
+        else:
+            self._stats.cancelled += 1
+
+    def _expire(self) -> None:
+        now = time.time()
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._stats.expired += len(expired)
+
+    async def _work(self, queue: JobQueue) -> None:
+        while True:
+            job_id = await queue.get()
+            fn = self._functions.pop(job_id, None)
+            job = self._jobs.get(job_id)
+            if fn is None or job is None:
+                continue
+            job.status = 'running'
+            job.started_at = time.time()
+            # The job runs in its own task so that cancelling it does not cancel the worker
+            task = asyncio.ensure_future(fn())
+            self._tasks[job_id] = task
+            try:
+                await asyncio.wait([task])
+            finally:
+                del self._tasks[job_id]
+            if task.cancelled():
+                self._finish(job, 'cancelled')
+                continue
+            error = task.exception()
+            if error is not None:
+                logger.opt(exception=error).warning('Job {} of kind {} failed', job_id, job.kind)
+                job.errors = [_error_message(error)]
+                self._finish(job, 'failed')
+            else:
+                job.result = task.result()
+                self._finish(job, 'succeeded')
+
+
+def _error_message(error: BaseException) -> str:
+    # The HTTP errors of the endpoints carry their message in `detail`
+    detail = getattr(error, 'detail', None)
+    return str(detail) if detail is not None else f'{type(error).__name__}: {error}'
+
+
+def job_runner_from_env() -> JobRunner:
+    """Build the job runner described by the `LLM_GRAPHS_JOB*` environment variables.
+
+    `LLM_GRAPHS_JOB_WORKERS` is the number of jobs running at the same time, `LLM_GRAPHS_JOB_QUEUE_SIZE` the number of
+    jobs waiting for a worker and `LLM_GRAPHS_JOB_RESULT_TTL` the number of seconds the finished jobs are kept.
+    """
+    return JobRunner(
+        max_workers=int(os.environ.get('LLM_GRAPHS_JOB_WORKERS', DEFAULT_MAX_WORKERS)),
+        max_queued=int(os.environ.get('LLM_GRAPHS_JOB_QUEUE_SIZE', DEFAULT_MAX_QUEUED)),
+        result_ttl=float(os.environ.get('LLM_GRAPHS_JOB_RESULT_TTL', DEFAULT_RESULT_TTL)),
+    )
+
+
+_job_runner: Optional[JobRunner] = None
+_job_runner_lock = threading.Lock()
+
+
+def get_job_runner() -> JobRunner:
+    """Return the process-wide job runner, built from the environment on the first call."""
+    global _job_runner
+    with _job_runner_lock:
+        if _job_runner is None:
+            _job_runner = job_runner_from_env()
+        return _job_runner
+
+
+def set_job_runner(runner: JobRunner) -> Optional[JobRunner]:
+    """Replace the process-wide job runner. Return the previous runner."""
+    global _job_runner
+    with _job_runner_lock:
+        previous, _job_runner = _job_runner, runner
+    return previous
+
+
+def _job_gauges() -> Dict[Tuple[str, ...], float]:
+    runner = _job_runner
+    if runner is None:
+        return {}
+    return {(name,): value for name, value in runner.stats().model_dump().items()}
+
+
+register_callback_gauge(
+    'llm_graphs_jobs',
+    'Counters of the background jobs and number of queued and running jobs, by stat.',
+    _job_gauges,
+    ('stat',),
+)
@@ -2,34 +2,137 @@
 # mypy: disable-error-code="misc"
 from __future__ import annotations
 
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
 from typing import (
     Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
     List,
+    Optional,
 )
 
 from fastapi import (
     Body,
     FastAPI,
+    Header,
     HTTPException,
+    Response,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import (
+    HTMLResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from pydantic import BaseModel
 
-from llm_graphs.agents.rating_agent import (
+from api.coalescing import (
+    SingleFlight,
+    request_key,
+)
+from api.jobs import (
+    JobQueueFullError,
+    get_job_runner,
+)
+from api.sessions import (
+    Session,
+    SessionGraph,
+    get_session_store,
+)
+from llm_graphs.cache import get_cache
+from llm_graphs.cascade import (
+    CascadeSettings,
+    arate_graph_cascade,
+    cascade_stats,
+)
+from llm_graphs.clients import (
+    aclose_clients,
+    models_to_warm,
+    warm_clients,
+)
+from llm_graphs.defaults import (
     DEFAULT_MEANING_STR,
     default_goal_str,
 )
+from llm_graphs.draw_knowledge_graph import (
+    RenderOptions,
+    get_render_cache,
+    render_key,
+    render_with_key,
+)
+from llm_graphs.hedging import get_hedger
+from llm_graphs.layout_settings import LayoutSettings
+from llm_graphs.limits import get_limiter
+from llm_graphs.metrics import (
+    register_callback_gauge,
+    render_metrics,
+)
 from llm_graphs.models import (
     Feedback,
     KnowledgeGraph,
+    Link,
+    Node,
+    RatingBatch,
+)
+from llm_graphs.patch import (
+    DEFAULT_IMPROVE_MODE,
+    ImproveMode,
+)
+from llm_graphs.pipeline import (
+    BookGraphResult,
+    PipelineSettings,
+    abuild_book_graphs,
+)
+from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
 )
 from llm_graphs.step import (
-    generate_seed_graph,
-    new_graph_from_feedback,
-    rate_graph,
+    DEFAULT_MAX_CONCURRENCY,
+    GraphEvent,
+    agenerate_seed_graph,
+    anew_graph_from_feedback,
+    arate_graph_many,
+    astream_graph_from_feedback,
+    astream_seed_graph,
+)
+from llm_graphs.validation import (
+    aensure_valid_graph,
+    repair_graph,
+    validate_graph,
 )
 
-app = FastAPI()
+MAX_NUM_RATINGS = 10
+MAX_BATCH_SIZE = 1000
+MAX_BATCH_ROUNDS = 5
+MAX_BATCH_CONCURRENCY = 16
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # The clients of LLM_GRAPHS_WARM_CLIENTS are built in the background, the first requests do not pay their imports
+    models = models_to_warm()
+    warm_up = asyncio.create_task(asyncio.to_thread(warm_clients, models)) if models else None
+    yield
+    if warm_up is not None:
+        await asyncio.gather(warm_up, return_exceptions=True)
+    # The jobs still running need the clients, they are cancelled first
+    await get_job_runner().aclose()
+    await aclose_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+single_flight = SingleFlight()
+register_callback_gauge(
+    'llm_graphs_coalescing',
+    'Calls, collapsed calls and in-flight calls of the request coalescing, by stat.',
+    lambda: {(name,): value for name, value in single_flight.stats().model_dump().items()},
+    ('stat',),
+)
 origins = ['*']
 
 app.add_middleware(
@@ -44,6 +147,130 @@ app.add_middleware(
 class GenericReturn(BaseModel):
     output: Any
     success: bool
+    errors: List[str] = []
+
+
+async def _rate(
+    book_name: str,
+    graph: KnowledgeGraph,
+    *,
+    model_name: str,
+    num_ratings: int,
+    use_cache: bool,
+    graph_encoding: GraphEncoding,
+    rating_cascade: Optional[CascadeSettings] = None,
+) -> RatingBatch:
+    if not 1 <= num_ratings <= MAX_NUM_RATINGS:
+        raise HTTPException(status_code=422, detail=f'num_ratings should be between 1 and {MAX_NUM_RATINGS}')
+    if rating_cascade is not None:
+        # The cascade replaces `model_name` by its cheap model, and by its expensive model when it escalates
+        cascade_rating = await arate_graph_cascade(
+            goal_str=default_goal_str(book_name),
+            meaning_str=DEFAULT_MEANING_STR,
+            knowledge_graph=graph,
+            settings=rating_cascade,
+            num_ratings=num_ratings,
+            use_cache=use_cache,
+            graph_encoding=graph_encoding,
+        )
+        rating_batch = cascade_rating.rating_batch
+    else:
+        rating_batch = await arate_graph_many(
+            model=model_name,
+            goal_str=default_goal_str(book_name),
+            meaning_str=DEFAULT_MEANING_STR,
+            knowledge_graph=graph,
+            num_ratings=num_ratings,
+            use_cache=use_cache,
+            graph_encoding=graph_encoding,
+        )
+    if not rating_batch.feedbacks:
+        raise HTTPException(status_code=502, detail=rating_batch.errors)
+    return rating_batch
+
+
+def _graph_to_rate(graph: KnowledgeGraph, *, repair: bool) -> KnowledgeGraph:
+    # An invalid graph is repaired before being rated so that the rating is not spent on structural issues, or
+    # reported without spending a rating call when the repair is disabled or leaves no node
+    report = validate_graph(graph)
+    if report.is_valid:
+        return graph
+    repaired_graph = repair_graph(graph) if repair else None
+    if repaired_graph is None or not repaired_graph.nodes:
+        raise HTTPException(status_code=422, detail=report.model_dump()['issues'])
+    return repaired_graph
+
+
+async def _seed_graph(book_name: str, model_name: str, *, use_cache: bool, repair: bool) -> KnowledgeGraph:
+    generate = partial(
+        agenerate_seed_graph,
+        model=model_name,
+        goal_str=default_goal_str(book_name),
+        meaning_str=DEFAULT_MEANING_STR,
+    )
+    return await aensure_valid_graph(
+        await generate(use_cache=use_cache),
+        regenerate=partial(generate, use_cache=False),
+        repair=repair,
+    )
+
+
+async def _improved_graph(
+    book_name: str,
+    graph: KnowledgeGraph,
+    feedbacks: List[Feedback],
+    *,
+    model_name: str,
+    use_cache: bool,
+    repair: bool,
+    graph_encoding: GraphEncoding,
+    improve_mode: ImproveMode,
+) -> KnowledgeGraph:
+    generate = partial(
+        anew_graph_from_feedback,
+        model=model_name,
+        goal_str=default_goal_str(book_name),
+        meaning_str=DEFAULT_MEANING_STR,
+        last_knowledge_graph=graph,
+        last_feedbacks=feedbacks,
+        graph_encoding=graph_encoding,
+        improve_mode=improve_mode,
+    )
+    return await aensure_valid_graph(
+        await generate(use_cache=use_cache),
+        regenerate=partial(generate, use_cache=False),
+        repair=repair,
+    )
+
+
+def _server_sent_event(event: str, data: str) -> str:
+    return f'event: {event}\ndata: {data}\n\n'
+
+
+async def _graph_events(events: AsyncIterator[GraphEvent]) -> AsyncIterator[str]:
+    try:
+        async for event in events:
+            if isinstance(event, Node):
+                yield _server_sent_event('node', event.model_dump_json())
+            elif isinstance(event, Link):
+                yield _server_sent_event('link', event.model_dump_json())
+            else:
+                yield _server_sent_event('graph', GenericReturn(output=event, success=True).model_dump_json())
+    except Exception as e:
+        yield _server_sent_event('error', GenericReturn(output=None, success=False, errors=[str(e)]).model_dump_json())
+
+
+def _event_stream(events: AsyncIterator[GraphEvent]) -> StreamingResponse:
+    return StreamingResponse(
+        _graph_events(events),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def _ndjson(results: AsyncIterator[BookGraphResult]) -> AsyncIterator[str]:
+    async for result in results:
+        yield result.model_dump_json() + '\n'
 
 
 @app.get('/')
@@ -56,71 +283,663 @@ async def ping() -> GenericReturn:
     return GenericReturn(output='pong', success=True)
 
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/v1/cache/stats')
+async def cache_stats() -> GenericReturn:
+    cache = get_cache()
+    return GenericReturn(output=cache.stats() if cache is not None else None, success=True)
+
+
+@app.get('/v1/limits/stats')
+async def limits_stats() -> GenericReturn:
+    limiter = get_limiter()
+    return GenericReturn(output=limiter.stats() if limiter is not None else None, success=True)
+
+
+@app.get('/v1/hedging/stats')
+async def hedging_stats() -> GenericReturn:
+    hedger = get_hedger()
+    return GenericReturn(output=hedger.stats() if hedger is not None else None, success=True)
+
+
+@app.get('/v1/rating_cascade/stats')
+async def rating_cascade_stats() -> GenericReturn:
+    return GenericReturn(output=cascade_stats(), success=True)
+
+
+@app.get('/v1/coalescing/stats')
+async def coalescing_stats() -> GenericReturn:
+    return GenericReturn(output=single_flight.stats(), success=True)
+
+
+@app.post('/v1/book_graph/validate')
+async def validate_graph_endpoint(graph: KnowledgeGraph = Body(embed=True)) -> GenericReturn:
+    report = validate_graph(graph)
+    return GenericReturn(
+        output={'issues': report.issues, 'repaired_graph': graph if report.is_valid else repair_graph(graph)},
+        success=report.is_valid,
+    )
+
+
 @app.post('/book_graph/init')
 @app.post('/v1/book_graph/init')
-def generate_graph_endpoint(book_name: str = Body(), model_name: str = Body('gpt-4o')) -> GenericReturn:
-    graph = generate_seed_graph(model=model_name, goal_str=default_goal_str(book_name), meaning_str=DEFAULT_MEANING_STR)
-    return GenericReturn(output=graph, success=True)
+async def generate_graph_endpoint(
+    *,
+    book_name: str = Body(),
+    model_name: str = Body('gpt-4o'),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+) -> GenericReturn:
+    async def _generate() -> GenericReturn:
+        graph = await _seed_graph(book_name, model_name, use_cache=use_cache, repair=repair)
+        return GenericReturn(output=graph, success=True)
+
+    body = {'book_name': book_name, 'model_name': model_name, 'use_cache': use_cache, 'repair': repair}
+    return await single_flight.do(request_key('init', body), _generate)
 
 
 @app.post('/book_graph/rate')
 @app.post('/book_graph/v1/rate')
-def rate_graph_endpoint(
+async def rate_graph_endpoint(
+    *,
     book_name: str = Body(),
     graph: KnowledgeGraph = Body(),
     model_name: str = Body('gpt-4o'),
     num_ratings: int = Body(1),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    rating_cascade: Optional[CascadeSettings] = Body(None),
 ) -> GenericReturn:
-    if num_ratings != 1:
-        raise HTTPException(status_code=501, detail='Only one rating is supported at the moment')
-    rating = rate_graph(
-        model=model_name,
-        goal_str=default_goal_str(book_name),
-        meaning_str=DEFAULT_MEANING_STR,
-        knowledge_graph=graph,
-    )
-    return GenericReturn(output=[rating], success=True)
+    rated_graph = _graph_to_rate(graph, repair=repair)
+
+    async def _rate_graph() -> GenericReturn:
+        rating_batch = await _rate(
+            book_name,
+            rated_graph,
+            model_name=model_name,
+            num_ratings=num_ratings,
+            use_cache=use_cache,
+            graph_encoding=graph_encoding,
+            rating_cascade=rating_cascade,
+        )
+        return GenericReturn(output=rating_batch.feedbacks, success=True, errors=rating_batch.errors)
+
+    body = {
+        'book_name': book_name,
+        'graph': graph.model_dump(),
+        'model_name': model_name,
+        'num_ratings': num_ratings,
+        'use_cache': use_cache,
+        'repair': repair,
+        'graph_encoding': graph_encoding.model_dump(),
+        'rating_cascade': rating_cascade.model_dump() if rating_cascade is not None else None,
+    }
+    return await single_flight.do(request_key('rate', body), _rate_graph)
 
 
 @app.post('/book_graph/improve')
 @app.post('/book_graph/v1/improve')
-def improve_graph_endpoint(
+async def improve_graph_endpoint(
+    *,
     book_name: str = Body(),
     graph: KnowledgeGraph = Body(),
     feedbacks: List[Feedback] = Body(),
     model_name: str = Body('gpt-4o'),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    improve_mode: ImproveMode = Body(DEFAULT_IMPROVE_MODE),
 ) -> GenericReturn:
-    new_graph = new_graph_from_feedback(
-        model=model_name,
-        goal_str=default_goal_str(book_name),
-        meaning_str=DEFAULT_MEANING_STR,
-        last_knowledge_graph=graph,
-        last_feedbacks=feedbacks,
-    )
-    return GenericReturn(output=new_graph, success=True)
+    async def _improve() -> GenericReturn:
+        new_graph = await _improved_graph(
+            book_name,
+            graph,
+            feedbacks,
+            model_name=model_name,
+            use_cache=use_cache,
+            repair=repair,
+            graph_encoding=graph_encoding,
+            improve_mode=improve_mode,
+        )
+        return GenericReturn(output=new_graph, success=True)
+
+    body = {
+        'book_name': book_name,
+        'graph': graph.model_dump(),
+        'feedbacks': [feedback.model_dump() for feedback in feedbacks],
+        'model_name': model_name,
+        'use_cache': use_cache,
+        'repair': repair,
+        'graph_encoding': graph_encoding.model_dump(),
+        'improve_mode': improve_mode,
+    }
+    return await single_flight.do(request_key('improve', body), _improve)
 
 
 @app.post('/book_graph/rate_and_improve')
 @app.post('/book_graph/v1/rate_and_improve')
-def rate_and_improve_endpoint(
+async def rate_and_improve_endpoint(
+    *,
     book_name: str = Body(),
     graph: KnowledgeGraph = Body(),
     model_name: str = Body('gpt-4o'),
     num_ratings: int = Body(1),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    improve_mode: ImproveMode = Body(DEFAULT_IMPROVE_MODE),
+    rating_cascade: Optional[CascadeSettings] = Body(None),
 ) -> GenericReturn:
-    if num_ratings != 1:
-        raise HTTPException(status_code=501, detail='Only one rating is supported at the moment')
-    feedback = rate_graph(
-        model=model_name,
-        goal_str=default_goal_str(book_name),
-        meaning_str=DEFAULT_MEANING_STR,
-        knowledge_graph=graph,
+    rated_graph = _graph_to_rate(graph, repair=repair)
+
+    async def _rate_and_improve() -> GenericReturn:
+        rating_batch = await _rate(
+            book_name,
+            rated_graph,
+            model_name=model_name,
+            num_ratings=num_ratings,
+            use_cache=use_cache,
+            graph_encoding=graph_encoding,
+            rating_cascade=rating_cascade,
+        )
+        new_graph = await _improved_graph(
+            book_name,
+            rated_graph,
+            rating_batch.feedbacks,
+            model_name=model_name,
+            use_cache=use_cache,
+            repair=repair,
+            graph_encoding=graph_encoding,
+            improve_mode=improve_mode,
+        )
+        return GenericReturn(
+            output={'new_graph': new_graph, 'feedbacks': rating_batch.feedbacks},
+            success=True,
+            errors=rating_batch.errors,
+        )
+
+    body = {
+        'book_name': book_name,
+        'graph': graph.model_dump(),
+        'model_name': model_name,
+        'num_ratings': num_ratings,
+        'use_cache': use_cache,
+        'repair': repair,
+        'graph_encoding': graph_encoding.model_dump(),
+        'improve_mode': improve_mode,
+        'rating_cascade': rating_cascade.model_dump() if rating_cascade is not None else None,
+    }
+    return await single_flight.do(request_key('rate_and_improve', body), _rate_and_improve)
+
+
+@app.post('/v1/book_graph/init/stream')
+async def generate_graph_stream_endpoint(
+    *,
+    book_name: str = Body(),
+    model_name: str = Body('gpt-4o'),
+    use_cache: bool = Body(default=True),
+) -> StreamingResponse:
+    return _event_stream(
+        astream_seed_graph(
+            model=model_name,
+            goal_str=default_goal_str(book_name),
+            meaning_str=DEFAULT_MEANING_STR,
+            use_cache=use_cache,
+        ),
     )
-    new_graph = new_graph_from_feedback(
-        model=model_name,
-        goal_str=default_goal_str(book_name),
-        meaning_str=DEFAULT_MEANING_STR,
-        last_knowledge_graph=graph,
-        last_feedbacks=[feedback],
+
+
+@app.post('/book_graph/improve/stream')
+@app.post('/book_graph/v1/improve/stream')
+async def improve_graph_stream_endpoint(
+    *,
+    book_name: str = Body(),
+    graph: KnowledgeGraph = Body(),
+    feedbacks: List[Feedback] = Body(),
+    model_name: str = Body('gpt-4o'),
+    use_cache: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+) -> StreamingResponse:
+    return _event_stream(
+        astream_graph_from_feedback(
+            model=model_name,
+            goal_str=default_goal_str(book_name),
+            meaning_str=DEFAULT_MEANING_STR,
+            last_knowledge_graph=graph,
+            last_feedbacks=feedbacks,
+            use_cache=use_cache,
+            graph_encoding=graph_encoding,
+        ),
+    )
+
+
+@app.post('/v1/book_graph/batch')
+async def batch_graph_endpoint(
+    *,
+    book_names: List[str] = Body(),
+    rounds: int = Body(0),
+    model_name: str = Body('gpt-4o'),
+    num_ratings: int = Body(1),
+    max_concurrency: int = Body(DEFAULT_MAX_CONCURRENCY),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    improve_mode: ImproveMode = Body(DEFAULT_IMPROVE_MODE),
+    rating_cascade: Optional[CascadeSettings] = Body(None),
+) -> StreamingResponse:
+    if not 1 <= len(book_names) <= MAX_BATCH_SIZE:
+        raise HTTPException(status_code=422, detail=f'book_names should have between 1 and {MAX_BATCH_SIZE} books')
+    if not 0 <= rounds <= MAX_BATCH_ROUNDS:
+        raise HTTPException(status_code=422, detail=f'rounds should be between 0 and {MAX_BATCH_ROUNDS}')
+    if not 1 <= num_ratings <= MAX_NUM_RATINGS:
+        raise HTTPException(status_code=422, detail=f'num_ratings should be between 1 and {MAX_NUM_RATINGS}')
+    if not 1 <= max_concurrency <= MAX_BATCH_CONCURRENCY:
+        raise HTTPException(
+            status_code=422,
+            detail=f'max_concurrency should be between 1 and {MAX_BATCH_CONCURRENCY}',
+        )
+    settings = PipelineSettings(
+        rounds=rounds,
+        num_ratings=num_ratings,
+        model_for_generation=model_name,
+        model_for_rating=model_name,
+        use_cache=use_cache,
+        repair=repair,
+        graph_encoding=graph_encoding,
+        improve_mode=improve_mode,
+        rating_cascade=rating_cascade,
+    )
+    # One JSON line per book, in completion order, with the `index` of the book and its own success or errors
+    return StreamingResponse(
+        _ndjson(abuild_book_graphs(book_names, settings, max_concurrency)),
+        media_type='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.post('/v1/book_graph/layout')
+async def layout_graph_endpoint(
+    graph: KnowledgeGraph = Body(),
+    settings: LayoutSettings = Body(LayoutSettings()),
+) -> GenericReturn:
+    # Imported here as it pulls in NumPy
+    from llm_graphs.layout import compute_layout
+
+    try:
+        positions = await asyncio.to_thread(compute_layout, graph, settings)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    # Ready for the `x`, `y` and `physics` options of the vis-network nodes
+    return GenericReturn(
+        output=[{'id': node_id, 'x': x, 'y': y, 'physics': False} for node_id, (x, y) in positions.items()],
+        success=True,
+    )
+
+
+def _etag(key: str) -> str:
+    return f'"{key}"'
+
+
+def _etag_matches(if_none_match: Optional[str], key: str) -> bool:
+    if if_none_match is None:
+        return False
+    etags = [etag.strip().removeprefix('W/') for etag in if_none_match.split(',')]
+    return '*' in etags or _etag(key) in etags
+
+
+def _render_headers(key: str) -> Dict[str, str]:
+    # The pages are addressed by the hash of their content, a page under a key never changes
+    return {
+        'ETag': _etag(key),
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'Content-Location': f'/v1/book_graph/render/{key}',
+    }
+
+
+@app.post('/v1/book_graph/render', response_class=HTMLResponse)
+async def render_graph_endpoint(
+    graph: KnowledgeGraph = Body(),
+    options: RenderOptions = Body(RenderOptions()),
+    if_none_match: Optional[str] = Header(None),
+) -> Response:
+    key = render_key(graph, options)
+    if _etag_matches(if_none_match, key):
+        return Response(status_code=304, headers=_render_headers(key))
+    # Building a page is CPU bound, it runs in a thread so that the event loop keeps serving the other requests
+    try:
+        _, page = await asyncio.to_thread(render_with_key, graph, options)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    return HTMLResponse(page, headers=_render_headers(key))
+
+
+@app.get('/v1/book_graph/render/{key}', response_class=HTMLResponse)
+async def rendered_graph_endpoint(key: str, if_none_match: Optional[str] = Header(None)) -> Response:
+    if _etag_matches(if_none_match, key):
+        return Response(status_code=304, headers=_render_headers(key))
+    cache = get_render_cache()
+    page = cache.get(key) if cache is not None else None
+    if page is None:
+        raise HTTPException(status_code=404, detail='No rendered page under this key, render the graph again')
+    return HTMLResponse(page, headers=_render_headers(key))
+
+
+def _session(session_id: str) -> Session:
+    session = get_session_store().get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f'No session {session_id}, it may have expired')
+    return session
+
+
+def _session_entry(session: Session, ix: int) -> SessionGraph:
+    try:
+        return session.entry(ix)
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+
+
+@app.get('/v1/sessions/stats')
+async def sessions_stats() -> GenericReturn:
+    return GenericReturn(output=get_session_store().stats(), success=True)
+
+
+@app.post('/v1/sessions')
+async def create_session_endpoint(
+    *,
+    book_name: str = Body(),
+    graph: Optional[KnowledgeGraph] = Body(None),
+    model_name: str = Body('gpt-4o'),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    improve_mode: ImproveMode = Body(DEFAULT_IMPROVE_MODE),
+    rating_cascade: Optional[CascadeSettings] = Body(None),
+) -> GenericReturn:
+    session = Session(
+        book_name=book_name,
+        model_name=model_name,
+        graph_encoding=graph_encoding,
+        improve_mode=improve_mode,
+        rating_cascade=rating_cascade,
+    )
+    # An uploaded graph is validated once here, the graphs of a session are valid from then on
+    if graph is not None:
+        report = validate_graph(graph)
+        if not report.is_valid and not repair:
+            raise HTTPException(status_code=422, detail=report.model_dump()['issues'])
+        session = session.with_graph(graph if report.is_valid else repair_graph(graph))
+    session = get_session_store().save(session)
+    return GenericReturn(output=session.summary(), success=True)
+
+
+@app.get('/v1/sessions/{session_id}')
+async def session_endpoint(session_id: str) -> GenericReturn:
+    return GenericReturn(output=_session(session_id).summary(), success=True)
+
+
+@app.get('/v1/sessions/{session_id}/graphs/{ix}')
+async def session_graph_endpoint(session_id: str, ix: int) -> GenericReturn:
+    return GenericReturn(output=_session_entry(_session(session_id), ix), success=True)
+
+
+@app.delete('/v1/sessions/{session_id}')
+async def delete_session_endpoint(session_id: str) -> GenericReturn:
+    if not get_session_store().delete(session_id):
+        raise HTTPException(status_code=404, detail=f'No session {session_id}')
+    return GenericReturn(output=session_id, success=True)
+
+
+@app.post('/v1/sessions/{session_id}/init')
+async def session_init_endpoint(
+    *,
+    session_id: str,
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+) -> GenericReturn:
+    store = get_session_store()
+    # The updates of a session are serialized, each one starts from the session saved by the previous one
+    async with store.lock(session_id):
+        session = _session(session_id)
+        graph = await _seed_graph(session.book_name, session.model_name, use_cache=use_cache, repair=repair)
+        session = store.save(session.with_graph(graph))
+    return GenericReturn(output={'ix': len(session.history) - 1, 'graph': graph}, success=True)
+
+
+@app.post('/v1/sessions/{session_id}/rate')
+async def session_rate_endpoint(
+    *,
+    session_id: str,
+    ix: int = Body(-1),
+    num_ratings: int = Body(1),
+    use_cache: bool = Body(default=True),
+) -> GenericReturn:
+    store = get_session_store()
+    async with store.lock(session_id):
+        session = _session(session_id)
+        entry = _session_entry(session, ix)
+        rating_batch = await _rate(
+            session.book_name,
+            entry.graph,
+            model_name=session.model_name,
+            num_ratings=num_ratings,
+            use_cache=use_cache,
+            graph_encoding=session.graph_encoding,
+            rating_cascade=session.rating_cascade,
+        )
+        rated_entry = entry.model_copy(update={'rating': rating_batch.feedbacks, 'rating_errors': rating_batch.errors})
+        store.save(session.with_entry(ix, rated_entry))
+    return GenericReturn(output=rating_batch.feedbacks, success=True, errors=rating_batch.errors)
+
+
+@app.post('/v1/sessions/{session_id}/improve')
+async def session_improve_endpoint(
+    *,
+    session_id: str,
+    ix: int = Body(-1),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+) -> GenericReturn:
+    store = get_session_store()
+    async with store.lock(session_id):
+        session = _session(session_id)
+        entry = _session_entry(session, ix)
+        if entry.rating is None:
+            raise HTTPException(status_code=409, detail=f'The graph at index {ix} is not rated yet')
+        new_graph = await _improved_graph(
+            session.book_name,
+            entry.graph,
+            entry.rating,
+            model_name=session.model_name,
+            use_cache=use_cache,
+            repair=repair,
+            graph_encoding=session.graph_encoding,
+            improve_mode=session.improve_mode,
+        )
+        session = store.save(session.with_graph(new_graph))
+    return GenericReturn(output={'ix': len(session.history) - 1, 'graph': new_graph}, success=True)
+
+
+@app.post('/v1/sessions/{session_id}/rate_and_improve')
+async def session_rate_and_improve_endpoint(
+    *,
+    session_id: str,
+    ix: int = Body(-1),
+    num_ratings: int = Body(1),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+) -> GenericReturn:
+    store = get_session_store()
+    async with store.lock(session_id):
+        session = _session(session_id)
+        entry = _session_entry(session, ix)
+        rating_batch = await _rate(
+            session.book_name,
+            entry.graph,
+            model_name=session.model_name,
+            num_ratings=num_ratings,
+            use_cache=use_cache,
+            graph_encoding=session.graph_encoding,
+            rating_cascade=session.rating_cascade,
+        )
+        rated_entry = entry.model_copy(update={'rating': rating_batch.feedbacks, 'rating_errors': rating_batch.errors})
+        # The rating is kept even when the improvement fails
+        session = store.save(session.with_entry(ix, rated_entry))
+        new_graph = await _improved_graph(
+            session.book_name,
+            entry.graph,
+            rating_batch.feedbacks,
+            model_name=session.model_name,
+            use_cache=use_cache,
+            repair=repair,
+            graph_encoding=session.graph_encoding,
+            improve_mode=session.improve_mode,
+        )
+        session = store.save(session.with_graph(new_graph))
+    return GenericReturn(
+        output={'ix': len(session.history) - 1, 'new_graph': new_graph, 'feedbacks': rating_batch.feedbacks},
+        success=True,
+        errors=rating_batch.errors,
+    )
+
+
+def _submit(kind: str, fn: Callable[[], Awaitable[GenericReturn]], response: Response) -> GenericReturn:
+    try:
+        job = get_job_runner().submit(kind, fn)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e)) from e
+    response.headers['Location'] = f'/v1/jobs/{job.job_id}'
+    return GenericReturn(output=job, success=True)
+
+
+@app.get('/v1/jobs/stats')
+async def jobs_stats() -> GenericReturn:
+    return GenericReturn(output=get_job_runner().stats(), success=True)
+
+
+@app.get('/v1/jobs/{job_id}')
+async def job_endpoint(job_id: str) -> GenericReturn:
+    job = get_job_runner().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'No job {job_id}, it may have expired')
+    # Once succeeded, the result of the job is the answer of the synchronous endpoint
+    return GenericReturn(output=job, success=job.status != 'failed', errors=job.errors)
+
+
+@app.delete('/v1/jobs/{job_id}')
+async def cancel_job_endpoint(job_id: str) -> GenericReturn:
+    job = get_job_runner().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'No job {job_id}, it may have expired')
+    return GenericReturn(output=job, success=True)
+
+
+@app.post('/v1/jobs/book_graph/init', status_code=202)
+async def init_job_endpoint(
+    *,
+    response: Response,
+    book_name: str = Body(),
+    model_name: str = Body('gpt-4o'),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+) -> GenericReturn:
+    generate = partial(
+        generate_graph_endpoint,
+        book_name=book_name,
+        model_name=model_name,
+        use_cache=use_cache,
+        repair=repair,
+    )
+    return _submit('init', generate, response)
+
+
+@app.post('/v1/jobs/book_graph/rate', status_code=202)
+async def rate_job_endpoint(
+    *,
+    response: Response,
+    book_name: str = Body(),
+    graph: KnowledgeGraph = Body(),
+    model_name: str = Body('gpt-4o'),
+    num_ratings: int = Body(1),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    rating_cascade: Optional[CascadeSettings] = Body(None),
+) -> GenericReturn:
+    # The invalid requests are rejected before being queued
+    _graph_to_rate(graph, repair=repair)
+    if not 1 <= num_ratings <= MAX_NUM_RATINGS:
+        raise HTTPException(status_code=422, detail=f'num_ratings should be between 1 and {MAX_NUM_RATINGS}')
+    rate = partial(
+        rate_graph_endpoint,
+        book_name=book_name,
+        graph=graph,
+        model_name=model_name,
+        num_ratings=num_ratings,
+        use_cache=use_cache,
+        repair=repair,
+        graph_encoding=graph_encoding,
+        rating_cascade=rating_cascade,
+    )
+    return _submit('rate', rate, response)
+
+
+@app.post('/v1/jobs/book_graph/improve', status_code=202)
+async def improve_job_endpoint(
+    *,
+    response: Response,
+    book_name: str = Body(),
+    graph: KnowledgeGraph = Body(),
+    feedbacks: List[Feedback] = Body(),
+    model_name: str = Body('gpt-4o'),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    improve_mode: ImproveMode = Body(DEFAULT_IMPROVE_MODE),
+) -> GenericReturn:
+    improve = partial(
+        improve_graph_endpoint,
+        book_name=book_name,
+        graph=graph,
+        feedbacks=feedbacks,
+        model_name=model_name,
+        use_cache=use_cache,
+        repair=repair,
+        graph_encoding=graph_encoding,
+        improve_mode=improve_mode,
+    )
+    return _submit('improve', improve, response)
+
+
+@app.post('/v1/jobs/book_graph/rate_and_improve', status_code=202)
+async def rate_and_improve_job_endpoint(
+    *,
+    response: Response,
+    book_name: str = Body(),
+    graph: KnowledgeGraph = Body(),
+    model_name: str = Body('gpt-4o'),
+    num_ratings: int = Body(1),
+    use_cache: bool = Body(default=True),
+    repair: bool = Body(default=True),
+    graph_encoding: GraphEncoding = Body(DEFAULT_GRAPH_ENCODING),
+    improve_mode: ImproveMode = Body(DEFAULT_IMPROVE_MODE),
+    rating_cascade: Optional[CascadeSettings] = Body(None),
+) -> GenericReturn:
+    if not 1 <= num_ratings <= MAX_NUM_RATINGS:
+        raise HTTPException(status_code=422, detail=f'num_ratings should be between 1 and {MAX_NUM_RATINGS}')
+    rate_and_improve = partial(
+        rate_and_improve_endpoint,
+        book_name=book_name,
+        graph=graph,
+        model_name=model_name,
+        num_ratings=num_ratings,
+        use_cache=use_cache,
+        repair=repair,
+        graph_encoding=graph_encoding,
+        improve_mode=improve_mode,
+        rating_cascade=rating_cascade,
     )
-    return GenericReturn(output={'new_graph': new_graph, 'feedbacks': [feedback]}, success=True)
+    return _submit('rate_and_improve', rate_and_improve, response)
@@ -0,0 +1,285 @@
+"""Server-side sessions holding the graphs of a book, so that the clients send a session id instead of a graph.
+
+A session is the API equivalent of the history of a `RatingGraphCreator`: the graphs generated for a book, each with
+its rating once rated, addressed by their index. The sessions are kept in a bounded in-memory LRU and, when a SQLite
+database is configured, written through to it so that they survive restarts and evictions. With a time to live, each
+save also deletes the expired sessions from the database. The stored sessions are never mutated in place, an update
+saves a new copy with `SessionStore.save`.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from pydantic import (
+    BaseModel,
+    Field,
+)
+
+from llm_graphs.cascade import CascadeSettings
+from llm_graphs.metrics import register_callback_gauge
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+)
+from llm_graphs.patch import (
+    DEFAULT_IMPROVE_MODE,
+    ImproveMode,
+)
+from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
+)
+
+DEFAULT_MAX_SESSIONS = 1024
+
+
+class SessionGraph(BaseModel):
+    """A graph of a session and its rating, None until the graph is rated."""
+
+    graph: KnowledgeGraph
+    rating: Optional[List[Feedback]] = None
+    rating_errors: List[str] = []
+
+
+class Session(BaseModel):
+    """The settings of a session and the history of its graphs, the oldest first."""
+
+    session_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    book_name: str
+    model_name: str = 'gpt-4o'
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING
+    improve_mode: ImproveMode = DEFAULT_IMPROVE_MODE
+    rating_cascade: Optional[CascadeSettings] = None
+    history: List[SessionGraph] = []
+    created_at: float = Field(default_factory=time.time)
+    updated_at: float = Field(default_factory=time.time)
+
+    def entry(self, ix: int) -> SessionGraph:
+        """Return the graph at the given index, negative indices count from the last graph.
+
+        Raise
+            IndexError: When there is no graph at `ix`.
+        """
+        if not -len(self.history) <= ix < len(self.history):
+            raise IndexError(f'No graph at index {ix}, the session has {len(self.history)} graphs')
+        return self.history[ix]
+
+    def with_entry(self, ix: int, entry: SessionGraph) -> Session:
+        """Return a copy of the session with the graph at `ix` replaced by `entry`."""
+        self.entry(ix)
+        history = list(self.history)
+        history[ix] = entry
+        return self.model_copy(update={'history': history})
+
+    def with_graph(self, graph: KnowledgeGraph) -> Session:
+        """Return a copy of the session with `graph` appended to its history."""
+        return self.model_copy(update={'history': [*self.history, SessionGraph(graph=graph)]})
+
+    def summary(self) -> Dict[str, object]:
+        """Return the settings of the session and the number of graphs, without the graphs."""
+        return {**self.model_dump(exclude={'history'}), 'num_graphs': len(self.history)}
+
+
+class SessionStats(BaseModel):
+    """Counters of a `SessionStore`."""
+
+    hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    sessions: int = 0
+
+
+class SessionStore:
+    """Bounded LRU of the sessions, written through to a SQLite database when a path is given."""
+
+    def __init__(
+        self,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        path: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """Initialize a new instance of the `SessionStore` class.
+
+        Parameter
+            max_sessions (int): The number of sessions kept in memory above which the least recently used are evicted.
+            path (str): The path of the SQLite database persisting the sessions, created if it does not exist. The
+                sessions only live in memory when None.
+            ttl (float): The number of seconds a session stays valid after its last update, never expires when None.
+        """
+        self.max_sessions: int = max_sessions
+        self.path: Optional[str] = path
+        self.ttl: Optional[float] = ttl
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = SessionStats()
+        # One lock per session held by its updates, dropped once no request holds it
+        self._session_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._connection: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions '
+                '(session_id TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)',
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+
+    def _is_expired(self, session: Session) -> bool:
+        return self.ttl is not None and time.time() - session.updated_at > self.ttl
+
+    def _remember(self, session: Session) -> None:
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self._stats.evictions += 1
+
+    def _delete(self, session_id: str) -> bool:
+        deleted = self._sessions.pop(session_id, None) is not None
+        if self._connection is not None:
+            cursor = self._connection.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            deleted = deleted or cursor.rowcount > 0
+        return deleted
+
+    def create(self, book_name: str, **settings: object) -> Session:
+        """Create, save and return a new session of `book_name` with the given `Session` settings."""
+        return self.save(Session(book_name=book_name, **settings))
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Return the session, from the database when it is no longer in memory, or None when it does not exist."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None and self._connection is not None:
+                row = self._connection.execute(
+                    'SELECT value FROM sessions WHERE session_id = ?',
+                    (session_id,),
+                ).fetchone()
+                if row is not None:
+                    session = Session.model_validate_json(row[0])
+                    self._stats.loads += 1
+            if session is None:
+                self._stats.misses += 1
+                return None
+            if self._is_expired(session):
+                self._delete(session_id)
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return None
+            self._remember(session)
+            self._stats.hits += 1
+            return session
+
+    def save(self, session: Session) -> Session:
+        """Store `session` with its update time set to now and return the stored copy."""
+        session = session.model_copy(update={'updated_at': time.time()})
+        with self._lock:
+            self._remember(session)
+            if self._connection is not None:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO sessions (session_id, value, updated_at) VALUES (?, ?, ?)',
+                    (session.session_id, session.model_dump_json(), session.updated_at),
+                )
+                self._purge_expired(session.updated_at)
+        return session
+
+    def _purge_expired(self, now: float) -> None:
+        # The expired sessions that are never read again would otherwise stay in the database forever
+        if self._connection is None or self.ttl is None:
+            return
+        cursor = self._connection.execute('DELETE FROM sessions WHERE updated_at < ?', (now - self.ttl,))
+        self._stats.expirations += max(cursor.rowcount, 0)
+
+    def delete(self, session_id: str) -> bool:
+        """Delete the session, return whether it existed."""
+        with self._lock:
+            return self._delete(session_id)
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        """Return the lock serializing the updates of a session, so that concurrent updates are not lost."""
+        with self._lock:
+            session_lock = self._session_locks.get(session_id)
+            if session_lock is None:
+                session_lock = asyncio.Lock()
+                self._session_locks[session_id] = session_lock
+            return session_lock
+
+    def stats(self) -> SessionStats:
+        """Return a snapshot of the counters and the number of sessions in memory."""
+        with self._lock:
+            return self._stats.model_copy(update={'sessions': len(self._sessions)})
+
+    def close(self) -> None:
+        """Close the database connection, if any."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+
+
+def session_store_from_env() -> SessionStore:
+    """Build the session store described by the `LLM_GRAPHS_SESSIONS*` environment variables.
+
+    `LLM_GRAPHS_SESSIONS` selects the persistence (`memory`, the default, or `sqlite`), `LLM_GRAPHS_SESSIONS_PATH` the
+    SQLite database, `LLM_GRAPHS_SESSIONS_MAX` the number of sessions kept in memory and `LLM_GRAPHS_SESSIONS_TTL` the
+    time to live in seconds.
+    """
+    backend = os.environ.get('LLM_GRAPHS_SESSIONS', 'memory').lower()
+    ttl_str = os.environ.get('LLM_GRAPHS_SESSIONS_TTL')
+    ttl = float(ttl_str) if ttl_str else None
+    max_sessions = int(os.environ.get('LLM_GRAPHS_SESSIONS_MAX', DEFAULT_MAX_SESSIONS))
+    if backend == 'memory':
+        return SessionStore(max_sessions=max_sessions, ttl=ttl)
+    if backend == 'sqlite':
+        path = os.environ.get('LLM_GRAPHS_SESSIONS_PATH', 'llm_graphs_sessions.sqlite3')
+        return SessionStore(max_sessions=max_sessions, path=path, ttl=ttl)
+    raise ValueError(f'Unknown session backend {backend}, expected one of memory or sqlite')
+
+
+_session_store: Optional[SessionStore] = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Return the process-wide session store, built from the environment on the first call."""
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = session_store_from_env()
+        return _session_store
+
+
+def set_session_store(store: SessionStore) -> Optional[SessionStore]:
+    """Replace the process-wide session store. Return the previous store."""
+    global _session_store
+    with _session_store_lock:
+        previous, _session_store = _session_store, store
+    return previous
+
+
+def _session_gauges() -> Dict[Tuple[str, ...], float]:
+    store = _session_store
+    if store is None:
+        return {}
+    return {(name,): value for name, value in store.stats().model_dump().items()}
+
+
+register_callback_gauge(
+    'llm_graphs_sessions',
+    'Counters of the session store and number of sessions in memory, by stat.',
+    _session_gauges,
+    ('stat',),
+)
@@ -0,0 +1 @@
+"""Load and latency benchmarks running against a local stand-in of the OpenAI API, see `benchmarks.load`."""
@@ -0,0 +1,346 @@
+"""Local stand-in of the OpenAI chat completions API, answering the instructor tool calls with canned payloads.
+
+The server answers `POST /v1/chat/completions` after a latency drawn from a configurable distribution, fails a
+configurable share of the calls with 429 or 500, and streams the tool call arguments in chunks when asked to, so the
+clients, the rate limiter and the API can be exercised without network access or API costs.
+
+    python -m benchmarks.fake_openai --port 8100 --latency-mean 0.2 --error-rate 0.01
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import threading
+import time
+from itertools import count
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
+
+import uvicorn
+from fastapi import (
+    FastAPI,
+    Request,
+)
+from fastapi.responses import (
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+from pydantic import BaseModel
+
+from llm_graphs.prompts import CHARS_PER_TOKEN
+
+Payload = Callable[[random.Random], Dict[str, Any]]
+
+
+class FakeServerSettings(BaseModel):
+    """Behaviour of the fake server.
+
+    `latency_mean` is the mean response time in seconds, `latency_sigma` the standard deviation of its logarithm for
+    the lognormal distribution. `error_rate` is the share of calls failing with 500 and `rate_limit_rate` the share of
+    calls rejected with 429 and a `Retry-After-Ms` of `retry_after_ms`.
+    """
+
+    latency_distribution: Literal['constant', 'uniform', 'exponential', 'lognormal'] = 'lognormal'
+    latency_mean: float = 0.05
+    latency_sigma: float = 0.5
+    error_rate: float = 0
+    rate_limit_rate: float = 0
+    retry_after_ms: int = 50
+    stream_chunks: int = 8
+    seed: Optional[int] = None
+
+
+def sample_latency(settings: FakeServerSettings, rng: random.Random) -> float:
+    """Return a response time drawn from the distribution of `settings`."""
+    mean = settings.latency_mean
+    if mean <= 0:
+        return 0
+    if settings.latency_distribution == 'constant':
+        return mean
+    if settings.latency_distribution == 'uniform':
+        return rng.uniform(0, 2 * mean)
+    if settings.latency_distribution == 'exponential':
+        return rng.expovariate(1 / mean)
+    sigma = settings.latency_sigma
+    return rng.lognormvariate(math.log(mean) - sigma**2 / 2, sigma)
+
+
+def knowledge_graph_payload(rng: random.Random, num_nodes: int = 10) -> Dict[str, Any]:
+    """Return a connected graph without loops, with about two links per node."""
+    nodes = [
+        {'node_id': i, 'name': f'Concept {i}', 'description': f'Description of concept {i}'} for i in range(num_nodes)
+    ]
+    pairs = [(i, j) for i in range(num_nodes) for j in (i + 1, i + 2) if j < num_nodes]
+    links = [
+        {
+            'link_id': link_id,
+            'name': f'relates {i} to {j}',
+            'node_id_from': i,
+            'node_id_to': j,
+            'description': f'Concept {i} represents a part of concept {j}',
+        }
+        for link_id, (i, j) in enumerate(pairs)
+    ]
+    return {
+        'nodes': nodes,
+        'links': links,
+        'name': f'Graph {rng.randrange(1_000_000)}',
+        'reasoning': 'The concepts are chained from the most general to the most specific.',
+    }
+
+
+def feedback_payload(rng: random.Random) -> Dict[str, Any]:
+    """Return a rating between 3 and 9."""
+    return {'rating': rng.randint(3, 9), 'opinion': 'The graph is clear but some links could be more specific.'}
+
+
+def graph_patch_payload(rng: random.Random) -> Dict[str, Any]:
+    """Return a patch of the graph of `knowledge_graph_payload`, relabelling a link and adding a linked node."""
+    return {
+        'edits': [
+            {'operation': 'relabel_link', 'link_id': rng.randrange(17), 'name': 'is a part of'},
+            {'operation': 'add_node', 'node_id': 10, 'name': 'Concept 10', 'description': 'Description of concept 10'},
+            {
+                'operation': 'add_link',
+                'link_id': 17,
+                'node_id_from': 9,
+                'node_id_to': 10,
+                'name': 'relates 9 to 10',
+                'description': 'Concept 9 represents a part of concept 10',
+            },
+        ],
+        'reasoning': 'The last concept is detailed by a new one.',
+    }
+
+
+# The payload of each response model, by the tool name instructor gives it, the name of the model
+PAYLOADS: Dict[str, Payload] = {
+    'KnowledgeGraph': knowledge_graph_payload,
+    'Feedback': feedback_payload,
+    'GraphPatch': graph_patch_payload,
+}
+
+
+class FakeServerStats(BaseModel):
+    """Counters of the fake server."""
+
+    requests: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    streams: int = 0
+
+
+def _tool_name(body: Dict[str, Any]) -> Optional[str]:
+    tool_choice = body.get('tool_choice')
+    tools = body.get('tools') or []
+    name: Optional[str] = None
+    if isinstance(tool_choice, dict):
+        name = tool_choice.get('function', {}).get('name')
+    elif tools:
+        name = tools[0]['function']['name']
+    return name
+
+
+def _usage(body: Dict[str, Any], arguments: str) -> Dict[str, int]:
+    prompt_tokens = len(json.dumps(body.get('messages', []))) // CHARS_PER_TOKEN
+    completion_tokens = len(arguments) // CHARS_PER_TOKEN
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+
+
+class FakeServer:
+    """State and route handlers of the fake server."""
+
+    def __init__(self, settings: Optional[FakeServerSettings] = None) -> None:
+        """Initialize the server, its random draws being seeded by `settings.seed`."""
+        self.settings: FakeServerSettings = settings or FakeServerSettings()
+        self.rng = random.Random(self.settings.seed)
+        self.stats = FakeServerStats()
+        self._ids = count()
+
+    def _completion(self, body: Dict[str, Any], name: str, arguments: str) -> Dict[str, Any]:
+        return {
+            'id': f'chatcmpl-fake-{next(self._ids)}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [
+                {
+                    'index': 0,
+                    'finish_reason': 'stop',
+                    'message': {
+                        'role': 'assistant',
+                        'content': None,
+                        'tool_calls': [
+                            {'id': 'call_0', 'type': 'function', 'function': {'name': name, 'arguments': arguments}},
+                        ],
+                    },
+                },
+            ],
+            'usage': _usage(body, arguments),
+        }
+
+    async def _chunks(self, body: Dict[str, Any], name: str, arguments: str, latency: float) -> AsyncIterator[str]:
+        completion_id = f'chatcmpl-fake-{next(self._ids)}'
+
+        def _chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+            return f'data: {json.dumps(chunk)}\n\n'
+
+        # The first chunk takes a third of the latency, like the time to first token of a real model
+        await asyncio.sleep(latency / 3)
+        yield _chunk(
+            {
+                'role': 'assistant',
+                'tool_calls': [
+                    {'index': 0, 'id': 'call_0', 'type': 'function', 'function': {'name': name, 'arguments': ''}},
+                ],
+            },
+        )
+        num_chunks = max(1, self.settings.stream_chunks)
+        size = math.ceil(len(arguments) / num_chunks)
+        for start in range(0, len(arguments), size):
+            await asyncio.sleep(2 * latency / 3 / num_chunks)
+            yield _chunk({'tool_calls': [{'index': 0, 'function': {'arguments': arguments[start : start + size]}}]})
+        yield _chunk({}, finish_reason='stop')
+        yield 'data: [DONE]\n\n'
+
+    async def _failure(self, latency: float) -> Optional[Response]:
+        """Return the 429 or 500 answered to a call drawn to fail, None for the other calls."""
+        draw = self.rng.random()
+        if draw < self.settings.rate_limit_rate:
+            self.stats.rate_limited += 1
+            await asyncio.sleep(latency / 10)
+            return JSONResponse(
+                {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error', 'code': 'rate_limit_exceeded'}},
+                status_code=429,
+                headers={'retry-after-ms': str(self.settings.retry_after_ms)},
+            )
+        if draw < self.settings.rate_limit_rate + self.settings.error_rate:
+            self.stats.errors += 1
+            await asyncio.sleep(latency)
+            return JSONResponse({'error': {'message': 'Internal error', 'type': 'server_error'}}, status_code=500)
+        return None
+
+    async def chat_completions(self, request: Request) -> Response:
+        """Answer a chat completion with the canned payload of its tool, streamed when asked to."""
+        body = await request.json()
+        self.stats.requests += 1
+        latency = sample_latency(self.settings, self.rng)
+        failure = await self._failure(latency)
+        if failure is not None:
+            return failure
+        name = _tool_name(body) or ''
+        # The streamed calls ask for the partial version of the response model
+        payload = PAYLOADS.get(name.removeprefix('Partial'))
+        if payload is None:
+            return JSONResponse(
+                {'error': {'message': f'No canned payload for the tool {name}', 'type': 'invalid_request_error'}},
+                status_code=400,
+            )
+        arguments = json.dumps(payload(self.rng))
+        if body.get('stream'):
+            self.stats.streams += 1
+            return StreamingResponse(self._chunks(body, name, arguments, latency), media_type='text/event-stream')
+        await asyncio.sleep(latency)
+        return JSONResponse(self._completion(body, name, arguments))
+
+    async def server_stats(self) -> FakeServerStats:
+        """Return the counters of the server."""
+        return self.stats
+
+
+def create_app(settings: Optional[FakeServerSettings] = None) -> FastAPI:
+    """Return the ASGI app of the fake server."""
+    server = FakeServer(settings)
+    app = FastAPI()
+    app.state.stats = server.stats
+    app.add_api_route('/v1/chat/completions', server.chat_completions, methods=['POST'])
+    app.add_api_route('/chat/completions', server.chat_completions, methods=['POST'])
+    app.add_api_route('/stats', server.server_stats, methods=['GET'])
+    return app
+
+
+def free_port() -> int:
+    """Return a TCP port free on localhost."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return int(sock.getsockname()[1])
+
+
+def serve_in_thread(app: FastAPI, port: Optional[int] = None) -> Tuple[uvicorn.Server, str]:
+    """Serve `app` on localhost from a daemon thread, return the server and its base url once it accepts calls.
+
+    Stop the server with `server.should_exit = True`.
+    """
+    port = port or free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError(f'The server did not start on port {port}')
+        time.sleep(0.01)
+    return server, f'http://127.0.0.1:{port}/v1'
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.fake_openai', description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8100)
+    add_server_arguments(parser)
+    return parser
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options of `FakeServerSettings` to `parser`."""
+    defaults = FakeServerSettings()
+    parser.add_argument(
+        '--latency-distribution',
+        choices=['constant', 'uniform', 'exponential', 'lognormal'],
+        default=defaults.latency_distribution,
+    )
+    parser.add_argument('--latency-mean', type=float, default=defaults.latency_mean, help='Seconds.')
+    parser.add_argument('--latency-sigma', type=float, default=defaults.latency_sigma)
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate, help='Share of 500 responses.')
+    parser.add_argument('--rate-limit-rate', type=float, default=defaults.rate_limit_rate, help='Share of 429.')
+    parser.add_argument('--retry-after-ms', type=int, default=defaults.retry_after_ms)
+    parser.add_argument('--stream-chunks', type=int, default=defaults.stream_chunks)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def server_settings(args: argparse.Namespace) -> FakeServerSettings:
+    """Return the settings given by the options added by `add_server_arguments`."""
+    return FakeServerSettings(**{name: getattr(args, name) for name in FakeServerSettings.model_fields})
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Serve the fake server until interrupted."""
+    args = _parser().parse_args(argv)
+    uvicorn.run(create_app(server_settings(args)), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""Load and latency benchmarks of the API endpoints and of the agent loops, against the fake OpenAI server.
+
+Each scenario is run at increasing concurrency levels, and the requests per second, the p50/p95/p99 latencies and the
+peak memory of each level are reported. The results can be saved and compared with a baseline, the command failing
+when the throughput drops or the p99 latency grows by more than the tolerance.
+
+    python -m benchmarks.load --levels 1,8,32 --requests 200 --output bench.json
+    python -m benchmarks.load --baseline bench.json --tolerance 0.25
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import httpx
+from loguru import logger
+from pydantic import BaseModel
+
+from benchmarks.fake_openai import (
+    add_server_arguments,
+    create_app,
+    knowledge_graph_payload,
+    serve_in_thread,
+    server_settings,
+)
+
+Call = Callable[[httpx.AsyncClient, int], Awaitable[None]]
+
+GRAPH = knowledge_graph_payload(random.Random(0))
+FEEDBACKS = [{'rating': 6, 'opinion': 'The links could be more specific.'}]
+
+
+class LevelResult(BaseModel):
+    """Measures of a scenario at one concurrency level, the latencies being in milliseconds."""
+
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    seconds: float
+    rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    peak_rss_mb: float
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Return the nearest-rank percentile of sorted values, 0 when there is none."""
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def peak_rss_mb() -> float:
+    """Return the peak resident memory of the process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+async def run_level(
+    scenario: str,
+    call: Call,
+    client: httpx.AsyncClient,
+    concurrency: int,
+    num_requests: int,
+) -> LevelResult:
+    """Run `num_requests` calls with `concurrency` workers and measure them."""
+    requests = iter(range(num_requests))
+    latencies: List[float] = []
+    errors = 0
+
+    async def _worker() -> None:
+        nonlocal errors
+        for i in requests:
+            start = time.perf_counter()
+            try:
+                await call(client, i)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return LevelResult(
+        scenario=scenario,
+        concurrency=concurrency,
+        requests=num_requests,
+        errors=errors,
+        seconds=seconds,
+        rps=len(latencies) / seconds if seconds > 0 else 0,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p95_ms=percentile(latencies, 0.95) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+async def _post(client: httpx.AsyncClient, path: str, body: Dict[str, object]) -> httpx.Response:
+    response = await client.post(path, json=body)
+    response.raise_for_status()
+    return response
+
+
+async def api_init(client: httpx.AsyncClient, i: int) -> None:
+    """Generate a seed graph through the API, a distinct book per call so that nothing is coalesced."""
+    await _post(client, '/v1/book_graph/init', {'book_name': f'Book {i}', 'use_cache': False})
+
+
+async def api_init_stream(client: httpx.AsyncClient, i: int) -> None:
+    """Stream a seed graph through the API until the graph event."""
+    body = {'book_name': f'Book {i}', 'use_cache': False}
+    async with client.stream('POST', '/v1/book_graph/init/stream', json=body) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line == 'event: error':
+                raise RuntimeError('The stream failed')
+
+
+async def api_rate(client: httpx.AsyncClient, i: int) -> None:
+    """Rate a graph three times through the API."""
+    body = {'book_name': f'Book {i}', 'graph': GRAPH, 'num_ratings': 3, 'use_cache': False}
+    await _post(client, '/book_graph/rate', body)
+
+
+async def api_improve(client: httpx.AsyncClient, i: int) -> None:
+    """Improve a graph from feedbacks through the API."""
+    body = {'book_name': f'Book {i}', 'graph': GRAPH, 'feedbacks': FEEDBACKS, 'use_cache': False}
+    await _post(client, '/book_graph/improve', body)
+
+
+async def api_rate_and_improve(client: httpx.AsyncClient, i: int) -> None:
+    """Rate and improve a graph through the API."""
+    body = {'book_name': f'Book {i}', 'graph': GRAPH, 'use_cache': False}
+    await _post(client, '/book_graph/rate_and_improve', body)
+
+
+async def api_batch(client: httpx.AsyncClient, i: int) -> None:
+    """Build the graphs of four books with one round of improvement through the batch endpoint."""
+    body = {'book_names': [f'Book {i}.{j}' for j in range(4)], 'rounds': 1, 'use_cache': False}
+    async with client.stream('POST', '/v1/book_graph/batch', json=body) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line and not json.loads(line)['success']:
+                raise RuntimeError('A book of the batch failed')
+
+
+async def agent_rate_and_generate(_: httpx.AsyncClient, i: int) -> None:
+    """Generate, rate and improve a graph with `RatingGraphCreator`, in a worker thread as the agent is sync."""
+    # Imported once OPENAI_BASE_URL points to the fake server
+    from llm_graphs.agents.rating_agent import RatingGraphCreator
+
+    def _run() -> None:
+        creator = RatingGraphCreator(f'Book {i}')
+        creator.generate_initial_graph()
+        creator.rate_and_generate(num_ratings=2)
+
+    await asyncio.to_thread(_run)
+
+
+async def agent_beam_search(_: httpx.AsyncClient, i: int) -> None:
+    """Run a small beam search."""
+    # Imported once OPENAI_BASE_URL points to the fake server
+    from llm_graphs.agents.beam_search import (
+        BeamSearchSettings,
+        abeam_search,
+    )
+
+    await abeam_search(f'Book {i}', BeamSearchSettings(num_seeds=3, beam_width=2, num_rounds=1))
+
+
+SCENARIOS: Dict[str, Call] = {
+    'api_init': api_init,
+    'api_init_stream': api_init_stream,
+    'api_rate': api_rate,
+    'api_improve': api_improve,
+    'api_rate_and_improve': api_rate_and_improve,
+    'api_batch': api_batch,
+    'agent_rate_and_generate': agent_rate_and_generate,
+    'agent_beam_search': agent_beam_search,
+}
+
+
+async def run_benchmarks(scenarios: List[str], levels: List[int], num_requests: int) -> List[LevelResult]:
+    """Run every scenario at every level, the fake server being already set as the OpenAI base url."""
+    # Imported once OPENAI_BASE_URL points to the fake server
+    from api.main import app
+    from llm_graphs.cache import set_cache
+
+    # Every call has to reach the fake server
+    set_cache(None)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max(levels)))
+    results: List[LevelResult] = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://api', timeout=None) as client:
+        for scenario in scenarios:
+            # The first call creates the clients and connections, it is not measured
+            await SCENARIOS[scenario](client, -1)
+            for concurrency in levels:
+                result = await run_level(scenario, SCENARIOS[scenario], client, concurrency, num_requests)
+                print(_format_row(result), flush=True)
+                results.append(result)
+    return results
+
+
+def _format_row(result: LevelResult) -> str:
+    return (
+        f'{result.scenario:<24} c={result.concurrency:<4} {result.rps:8.1f} req/s'
+        f'  p50 {result.p50_ms:7.1f} ms  p95 {result.p95_ms:7.1f} ms  p99 {result.p99_ms:7.1f} ms'
+        f'  errors {result.errors:<4} peak rss {result.peak_rss_mb:6.1f} MB'
+    )
+
+
+def compare(results: List[LevelResult], baseline: List[LevelResult], tolerance: float) -> List[str]:
+    """Return the regressions of `results` against `baseline`: lower throughput or higher p99 beyond `tolerance`."""
+    by_key: Dict[Tuple[str, int], LevelResult] = {(result.scenario, result.concurrency): result for result in baseline}
+    regressions: List[str] = []
+    for result in results:
+        reference = by_key.get((result.scenario, result.concurrency))
+        if reference is None:
+            continue
+        name = f'{result.scenario} at concurrency {result.concurrency}'
+        if result.rps < reference.rps * (1 - tolerance):
+            regressions.append(f'{name}: {result.rps:.1f} req/s against {reference.rps:.1f} req/s')
+        if result.p99_ms > reference.p99_ms * (1 + tolerance):
+            regressions.append(f'{name}: p99 {result.p99_ms:.1f} ms against {reference.p99_ms:.1f} ms')
+        if result.errors > reference.errors:
+            regressions.append(f'{name}: {result.errors} errors against {reference.errors}')
+    return regressions
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load', description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS), help='Comma separated scenarios.')
+    parser.add_argument('--levels', type=str, default='1,8,32', help='Comma separated concurrency levels.')
+    parser.add_argument('--requests', type=int, default=100, help='Requests per scenario and level.')
+    parser.add_argument('--output', type=Path, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', type=Path, help='Fail on regressions against this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression.')
+    parser.add_argument('--verbose', action='store_true', help='Keep the logs of the agents.')
+    add_server_arguments(parser)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmarks, return the exit code."""
+    args = _parser().parse_args(argv)
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'Unknown scenarios {sorted(unknown)}, expected some of {list(SCENARIOS)}')
+    levels = [int(level) for level in args.levels.split(',')]
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level='WARNING')
+
+    server, base_url = serve_in_thread(create_app(server_settings(args)))
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    try:
+        results = asyncio.run(run_benchmarks(scenarios, levels, args.requests))
+    finally:
+        server.should_exit = True
+
+    if args.output is not None:
+        args.output.write_text(json.dumps([result.model_dump() for result in results], indent=2))
+    if args.baseline is not None:
+        baseline = [LevelResult.model_validate(result) for result in json.loads(args.baseline.read_text())]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
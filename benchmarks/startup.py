@@ -0,0 +1,111 @@
+"""Cold start benchmark of the API: the time to import `api.main` in a fresh interpreter.
+
+Each run imports the app in a new process, so nothing is cached but the bytecode, and reports how long the import took
+and which of the heavy dependencies were loaded. The command fails when the median import time exceeds the budget or
+when a dependency that should load on first use was imported eagerly.
+
+    python -m benchmarks.startup --runs 5 --budget 1.5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import (
+    List,
+    Optional,
+)
+
+from pydantic import BaseModel
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_MODULE = 'api.main'
+DEFAULT_BUDGET_SECONDS = 1.5
+# Loaded on first use by the clients, the renderer and the layout, never by importing the app
+LAZY_MODULES = ('openai', 'instructor', 'httpx', 'pyvis', 'IPython', 'networkx', 'numpy')
+
+_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {lazy_modules!r} if name in sys.modules]}}))
+'''
+
+
+class StartupRun(BaseModel):
+    """One cold import, `loaded` being the lazy dependencies found in `sys.modules` after it."""
+
+    seconds: float
+    loaded: List[str]
+
+
+class StartupResult(BaseModel):
+    """Cold imports of a module, the times being in seconds."""
+
+    module: str
+    runs: List[StartupRun]
+    median: float
+    best: float
+
+
+def import_once(module: str = DEFAULT_MODULE) -> StartupRun:
+    """Import `module` in a new interpreter and return how long it took."""
+    env = {**os.environ, 'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY', 'sk-fake')}
+    output = subprocess.run(
+        [sys.executable, '-c', _SCRIPT.format(module=module, lazy_modules=LAZY_MODULES)],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return StartupRun.model_validate(json.loads(output.strip().splitlines()[-1]))
+
+
+def measure(module: str = DEFAULT_MODULE, runs: int = 5) -> StartupResult:
+    """Import `module` `runs` times, each one in a new interpreter."""
+    results = [import_once(module) for _ in range(runs)]
+    seconds = [run.seconds for run in results]
+    return StartupResult(module=module, runs=results, median=statistics.median(seconds), best=min(seconds))
+
+
+def check(result: StartupResult, budget: float) -> List[str]:
+    """Return the regressions of `result`: an import slower than the budget or lazy dependencies loaded eagerly."""
+    regressions = []
+    if result.median > budget:
+        regressions.append(f'{result.module}: median import {result.median:.3f} s over the {budget:.3f} s budget')
+    loaded = sorted({name for run in result.runs for name in run.loaded})
+    if loaded:
+        regressions.append(f'{result.module}: {", ".join(loaded)} imported eagerly')
+    return regressions
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description=__doc__.splitlines()[0])
+    parser.add_argument('--module', type=str, default=DEFAULT_MODULE, help='The module to import.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of cold imports.')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_SECONDS, help='Allowed median seconds.')
+    parser.add_argument('--output', type=Path, help='Write the result to this JSON file.')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmark, return the exit code."""
+    args = _parser().parse_args(argv)
+    result = measure(args.module, args.runs)
+    print(f'{result.module}: median {result.median:.3f} s, best {result.best:.3f} s over {len(result.runs)} runs')
+    if args.output is not None:
+        args.output.write_text(result.model_dump_json(indent=2))
+    regressions = check(result, args.budget)
+    for regression in regressions:
+        print(f'Regression: {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
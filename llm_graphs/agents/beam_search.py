@@ -0,0 +1,262 @@
+"""Beam search over knowledge graphs: generate, rate and improve several candidate graphs in parallel."""
+from __future__ import annotations
+
+import asyncio
+import time
+from statistics import mean
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    List,
+    Optional,
+    TypeVar,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.defaults import (
+    DEFAULT_MEANING_STR,
+    GPT_3_5_TURBO,
+    GPT_4O,
+    default_goal_str,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+)
+from llm_graphs.patch import (
+    DEFAULT_IMPROVE_MODE,
+    ImproveMode,
+)
+from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
+)
+from llm_graphs.step import (
+    DEFAULT_MAX_CONCURRENCY,
+    agenerate_seed_graph,
+    anew_graph_from_feedback,
+    arate_graph,
+)
+from llm_graphs.usage import (
+    Usage,
+    track_usage,
+)
+from llm_graphs.validation import (
+    repair_graph,
+    validate_graph,
+)
+
+if TYPE_CHECKING:
+    from instructor import AsyncInstructor
+
+T = TypeVar('T')
+
+
+class BeamSearchSettings(BaseModel):
+    """Settings of a beam search.
+
+    `num_seeds` seed graphs are generated and rated, then each round improves the `beam_width` best rated graphs and
+    rates the new graphs. The search stops after `num_rounds` rounds, or once `max_seconds` or `max_tokens` is
+    exceeded.
+    """
+
+    num_seeds: int = 4
+    beam_width: int = 2
+    num_rounds: int = 2
+    num_ratings: int = 1
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    max_seconds: Optional[float] = None
+    max_tokens: Optional[int] = None
+    model_for_generation: str = GPT_4O
+    model_for_rating: str = GPT_3_5_TURBO
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING
+    improve_mode: ImproveMode = DEFAULT_IMPROVE_MODE
+
+
+class BeamCandidate(BaseModel):
+    """A graph of the search tree, `parent_id` being the candidate it was improved from and `depth` its round."""
+
+    candidate_id: int
+    parent_id: Optional[int]
+    depth: int
+    graph: KnowledgeGraph
+    ratings: List[Feedback] = []
+    rating_errors: List[str] = []
+
+    @property
+    def mean_rating(self) -> Optional[float]:
+        """Return the mean of the ratings, None when the graph has no rating."""
+        return mean(feedback.rating for feedback in self.ratings) if self.ratings else None
+
+
+class BeamSearchResult(BaseModel):
+    """The best graph found and the whole search tree."""
+
+    best: BeamCandidate
+    candidates: List[BeamCandidate]
+    usage: Usage
+    elapsed_seconds: float
+    stop_reason: str
+
+    def lineage(self, candidate_id: Optional[int] = None) -> List[BeamCandidate]:
+        """Return the candidates from the seed to the given candidate, the best one by default."""
+        by_id = {candidate.candidate_id: candidate for candidate in self.candidates}
+        candidate: Optional[BeamCandidate] = by_id[self.best.candidate_id if candidate_id is None else candidate_id]
+        lineage: List[BeamCandidate] = []
+        while candidate is not None:
+            lineage.append(candidate)
+            candidate = by_id[candidate.parent_id] if candidate.parent_id is not None else None
+        return lineage[::-1]
+
+
+def _top(candidates: List[BeamCandidate], num: int) -> List[BeamCandidate]:
+    rated = [candidate for candidate in candidates if candidate.mean_rating is not None]
+    return sorted(rated, key=lambda candidate: (-(candidate.mean_rating or 0), candidate.candidate_id))[:num]
+
+
+class _BeamSearch:
+    def __init__(
+        self,
+        book_name: str,
+        settings: BeamSearchSettings,
+        client: Optional[AsyncInstructor],
+        usage: Usage,
+    ) -> None:
+        self.goal_str = default_goal_str(book_name)
+        self.settings = settings
+        self.client = client
+        self.usage = usage
+        self.candidates: List[BeamCandidate] = []
+        self._semaphore = asyncio.Semaphore(settings.max_concurrency)
+        self._start = time.monotonic()
+
+    async def _limited(self, call: Awaitable[T]) -> T:
+        async with self._semaphore:
+            return await call
+
+    def elapsed_seconds(self) -> float:
+        return time.monotonic() - self._start
+
+    def stop_reason(self) -> Optional[str]:
+        if self.settings.max_seconds is not None and self.elapsed_seconds() >= self.settings.max_seconds:
+            return 'max_seconds'
+        if self.settings.max_tokens is not None and self.usage.total_tokens >= self.settings.max_tokens:
+            return 'max_tokens'
+        return None
+
+    def _add(self, graphs: List[KnowledgeGraph | BaseException], parents: List[Optional[int]], depth: int) -> None:
+        for graph, parent_id in zip(graphs, parents):
+            if isinstance(graph, KnowledgeGraph):
+                self.candidates.append(
+                    BeamCandidate(
+                        candidate_id=len(self.candidates),
+                        parent_id=parent_id,
+                        depth=depth,
+                        # Structural issues are repaired locally instead of being left to the ratings
+                        graph=graph if validate_graph(graph).is_valid else repair_graph(graph),
+                    ),
+                )
+
+    async def seed(self) -> List[BeamCandidate]:
+        graphs = await asyncio.gather(
+            *(
+                self._limited(
+                    agenerate_seed_graph(
+                        model=self.settings.model_for_generation,
+                        goal_str=self.goal_str,
+                        meaning_str=DEFAULT_MEANING_STR,
+                        client=self.client,
+                        # The seeds share the same prompt, only the first one may come from the cache
+                        use_cache=i == 0,
+                    ),
+                )
+                for i in range(self.settings.num_seeds)
+            ),
+            return_exceptions=True,
+        )
+        self._add(list(graphs), [None] * len(graphs), 0)
+        return self.candidates[:]
+
+    async def improve(self, beam: List[BeamCandidate], depth: int) -> List[BeamCandidate]:
+        num_candidates = len(self.candidates)
+        graphs = await asyncio.gather(
+            *(
+                self._limited(
+                    anew_graph_from_feedback(
+                        model=self.settings.model_for_generation,
+                        goal_str=self.goal_str,
+                        meaning_str=DEFAULT_MEANING_STR,
+                        last_knowledge_graph=candidate.graph,
+                        last_feedbacks=candidate.ratings,
+                        client=self.client,
+                        graph_encoding=self.settings.graph_encoding,
+                        improve_mode=self.settings.improve_mode,
+                        # A parent surviving a round is improved again, from the cache it would give the same child
+                        use_cache=False,
+                    ),
+                )
+                for candidate in beam
+            ),
+            return_exceptions=True,
+        )
+        self._add(list(graphs), [candidate.candidate_id for candidate in beam], depth)
+        return self.candidates[num_candidates:]
+
+    async def rate(self, candidates: List[BeamCandidate]) -> None:
+        calls = [(candidate, i) for candidate in candidates for i in range(self.settings.num_ratings)]
+        ratings = await asyncio.gather(
+            *(
+                self._limited(
+                    arate_graph(
+                        model=self.settings.model_for_rating,
+                        goal_str=self.goal_str,
+                        meaning_str=DEFAULT_MEANING_STR,
+                        knowledge_graph=candidate.graph,
+                        client=self.client,
+                        use_cache=i == 0,
+                        graph_encoding=self.settings.graph_encoding,
+                    ),
+                )
+                for candidate, i in calls
+            ),
+            return_exceptions=True,
+        )
+        for (candidate, _), rating in zip(calls, ratings):
+            if isinstance(rating, Feedback):
+                candidate.ratings.append(rating)
+            else:
+                candidate.rating_errors.append(str(rating))
+
+
+async def abeam_search(
+    book_name: str,
+    settings: Optional[BeamSearchSettings] = None,
+    client: Optional[AsyncInstructor] = None,
+) -> BeamSearchResult:
+    """Search for the best rated graph of a book by improving several candidate graphs in parallel."""
+    settings = settings or BeamSearchSettings()
+    with track_usage() as usage:
+        search = _BeamSearch(book_name, settings, client, usage)
+        frontier = await search.seed()
+        await search.rate(frontier)
+        beam = _top(frontier, settings.beam_width)
+        if not beam:
+            raise RuntimeError('None of the seed graphs could be generated and rated')
+        stop_reason = 'num_rounds'
+        for depth in range(1, settings.num_rounds + 1):
+            reason = search.stop_reason()
+            if reason is not None:
+                stop_reason = reason
+                break
+            children = await search.improve(beam, depth)
+            await search.rate(children)
+            # Parents stay in the race so that a round can never make the beam worse
+            beam = _top(beam + children, settings.beam_width)
+    return BeamSearchResult(
+        best=_top(search.candidates, 1)[0],
+        candidates=search.candidates,
+        usage=usage,
+        elapsed_seconds=search.elapsed_seconds(),
+        stop_reason=stop_reason,
+    )
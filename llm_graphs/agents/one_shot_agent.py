@@ -1,17 +1,18 @@
 """The main function."""
 from __future__ import annotations
 
-from functools import lru_cache
-from typing import List
+from typing import (
+    TYPE_CHECKING,
+    List,
+)
 
-# Pydantic to specify LLM output schema
-import instructor
-from openai import OpenAI
-from openai.types.chat import ChatCompletionMessageParam  # noqa: TCH002
-
-# Plotting utils
-from llm_graphs.draw_knowledge_graph import draw_with_pyvis
+from llm_graphs.clients import get_client
+from llm_graphs.draw_knowledge_graph import save_html
 from llm_graphs.models import KnowledgeGraph
+from llm_graphs.step import complete
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
 
 
 def _from_prompt(
@@ -22,8 +23,8 @@ def _from_prompt(
 
     The function first generates some text using the OpenAI API, then uses the
     Pydantic model `KnowledgeGraph` to parse the resulting text as a graph.
-    The function is memoized using functools.lru_cache to avoid generating
-    the same graph multiple times.
+    Responses go through the response cache of `llm_graphs.cache` to avoid
+    generating the same graph multiple times.
 
     Parameters
     ----------
@@ -37,24 +38,18 @@ def _from_prompt(
     KnowledgeGraph
         The generated graph representing the book.
     """
-    if model not in ['gpt-3.5-turbo', 'gpt-4', 'gpt-4-turbo']:
-        raise ValueError('Model must be either gpt-3.5-turbo or gpt-4')
-    client = instructor.from_openai(OpenAI())
-    return client.chat.completions.create(
-        model=model,
-        response_model=KnowledgeGraph,
-        messages=messages,
-    )
+    if model not in ['gpt-3.5-turbo', 'gpt-4', 'gpt-4-turbo', 'gpt-4o']:
+        raise ValueError('Model must be one of gpt-3.5-turbo, gpt-4, gpt-4-turbo or gpt-4o')
+    return complete(get_client(model), model, KnowledgeGraph, messages)
 
 
-@lru_cache(maxsize=None)
 def from_book_summary(book_title: str, model: str = 'gpt-4') -> KnowledgeGraph:
     """Return a KnowledgeGraph object for a given book title using the OpenAI API.
 
     The function first generates some text using the OpenAI API, then uses the
     Pydantic model `KnowledgeGraph` to parse the resulting text as a graph.
-    The function is memoized using functools.lru_cache to avoid generating
-    the same graph multiple times.
+    The response is cached by the response cache of `llm_graphs.cache` to
+    avoid generating the same graph multiple times.
 
     Parameters
     ----------
@@ -98,4 +93,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
     # generate the knowledge graph
     knowledge_graph = from_book_summary(book_title=args.book_title, model=args.model)
-    draw_with_pyvis(knowledge_graph)
+    print(save_html(knowledge_graph, f'{knowledge_graph.name}.html'))  # noqa: T201
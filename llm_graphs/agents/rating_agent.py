@@ -1,61 +1,180 @@
 """Module to iteratively generate and rate knowledge graphs for a given book."""
 # pylint: disable=BLE001,B904
-# TODO: add logging
-# TODO: the multiple ratings should be done in parallel either by providing an argument to the api of by using some async call
 
 from __future__ import annotations
 
+import asyncio
+import time
+from functools import partial
+from statistics import mean
 from typing import (
+    TYPE_CHECKING,
     Any,
+    Callable,
+    Dict,
     List,
+    NotRequired,
     Optional,
     TypedDict,
 )
 
-import instructor
-from openai import OpenAI
+from loguru import logger
+from pydantic import BaseModel
 
+from llm_graphs.cascade import (
+    CascadeSettings,
+    rate_graph_cascade,
+)
+from llm_graphs.clients import get_client
+
+# The defaults were defined here, they are still importable from this module
+from llm_graphs.defaults import (  # noqa: F401
+    DEFAULT_MEANING_STR,
+    GPT_3_5_TURBO,
+    GPT_4,
+    GPT_4O,
+    default_goal_str,
+)
 from llm_graphs.draw_knowledge_graph import draw_with_pyvis
 from llm_graphs.models import (
     Feedback,
     KnowledgeGraph,
+    RatingBatch,
+)
+from llm_graphs.patch import (
+    DEFAULT_IMPROVE_MODE,
+    ImproveMode,
+)
+from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
+    PromptSizeReport,
+    improve_prompt_size_report,
+    rate_prompt_size_report,
 )
 from llm_graphs.step import (
+    DEFAULT_MAX_CONCURRENCY,
     generate_seed_graph,
     new_graph_from_feedback,
-    rate_graph,
+    rate_graph_many,
+)
+from llm_graphs.usage import (
+    Usage,
+    track_usage,
 )
+from llm_graphs.validation import ensure_valid_graph
 
-GraphDict = TypedDict('GraphDict', {'graph': KnowledgeGraph, 'rating': Optional[List[Feedback]]})
+if TYPE_CHECKING:
+    from instructor import AsyncInstructor
 
-GPT_4O = 'gpt-4o'
-GPT_3_5_TURBO = 'gpt-3.5-turbo'
-GPT_4 = 'gpt-4'
+    from llm_graphs.agents.beam_search import (
+        BeamSearchResult,
+        BeamSearchSettings,
+    )
 
-DEFAULT_MEANING_STR = (
-    '- the resulting graph will be visually appealing and give a good global understanding of the structure of the book it explains.\n'
-    '- The graph will focus on the concepts and relation between the characters and/or the concepts in the book, not tell the story of the book\n'
-    '- Every link description should be of the form close to "<link_description> represent  <reason>" you are allowed not to follow exactly this pattern though\n'
+GraphDict = TypedDict(
+    'GraphDict',
+    {
+        'graph': KnowledgeGraph,
+        'rating': Optional[List[Feedback]],
+        'rating_errors': NotRequired[List[str]],
+        'latency_seconds': NotRequired[float],
+        'usage': NotRequired[Usage],
+    },
 )
 
 
-def default_goal_str(book_name: str) -> str:
-    """Returns the goal string for the graph creator."""
-    return f'Generate a graph that will help the reader to understand the structure of the book {book_name}'
+class RefineResult(BaseModel):
+    """Outcome of `RatingGraphCreator.refine_until`.
+
+    `ix` is the index of the best graph in the history, as accepted by `get_graph`, and `rating` its mean rating.
+    """
+
+    graph: KnowledgeGraph
+    rating: float
+    ix: int
+    iterations: int
+    stop_reason: str
+    usage: Usage
+    elapsed_seconds: float
+
+
+class _RefineLimits(BaseModel):
+    """When `RatingGraphCreator.refine_until` stops, see its parameters."""
+
+    target_rating: float
+    patience: int
+    max_iterations: int
+    max_calls: Optional[int]
+    max_tokens: Optional[int]
+    max_seconds: Optional[float]
+    num_ratings: int
+
+    def stop_reason(
+        self,
+        best_rating: float,
+        since_improvement: int,
+        iterations: int,
+        usage: Usage,
+        elapsed_seconds: float,
+        last: GraphDict,
+    ) -> Optional[str]:
+        """Return why the loop stops after rating `last`, None when it goes on with an improved graph.
+
+        The cost of the next iteration is estimated from the last one.
+        """
+        last_usage = last.get('usage', Usage())
+        if best_rating >= self.target_rating:
+            return 'target_rating'
+        if since_improvement >= self.patience:
+            return 'plateau'
+        if iterations >= self.max_iterations:
+            return 'max_iterations'
+        if self.max_calls is not None and usage.calls + max(last_usage.calls, 1 + self.num_ratings) > self.max_calls:
+            return 'max_calls'
+        if self.max_tokens is not None and usage.total_tokens + last_usage.total_tokens > self.max_tokens:
+            return 'max_tokens'
+        if self.max_seconds is not None and elapsed_seconds + last.get('latency_seconds', 0.0) > self.max_seconds:
+            return 'max_seconds'
+        return None
 
 
 class RatingGraphCreator:
     """Class to iteratively generate and rate knowledge graphs for a given book."""
 
-    def __init__(self, book_name: str) -> None:
+    def __init__(
+        self,
+        book_name: str,
+        *,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        repair: bool = True,
+        max_regenerations: int = 1,
+        graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+        improve_mode: ImproveMode = DEFAULT_IMPROVE_MODE,
+        rating_cascade: Optional[CascadeSettings] = None,
+    ) -> None:
         """Initialize a new instance of the `RatingGraphCreator` class.
 
         Parameter
             book_name (str): The name of the book.
+            max_concurrency (int): The maximum number of ratings requested at the same time.
+            repair (bool): Whether to repair locally the generated graphs breaking the graph constraints.
+            max_regenerations (int): How many times an invalid graph that cannot be repaired is requested again.
+            graph_encoding (GraphEncoding): How the graphs are written in the rate and improve prompts.
+            improve_mode (ImproveMode): Whether the improved graphs are written again in full or patched.
+            rating_cascade (CascadeSettings): When set, the graphs are rated by its cheap model first and by its
+                expensive model only when the cheap ratings are uncertain, instead of by the model given to the
+                rating methods.
         """
-        self._client = instructor.from_openai(OpenAI())
+        self._client = get_client()
         self._graphs_history: List[GraphDict] = []
         self.book_name: str = book_name
+        self.max_concurrency: int = max_concurrency
+        self.repair: bool = repair
+        self.max_regenerations: int = max_regenerations
+        self.graph_encoding: GraphEncoding = graph_encoding
+        self.improve_mode: ImproveMode = improve_mode
+        self.rating_cascade: Optional[CascadeSettings] = rating_cascade
 
     def get_graph(self, ix: int) -> KnowledgeGraph:
         """Return the graph at the given index."""
@@ -81,36 +200,89 @@ class RatingGraphCreator:
 
     def generate_initial_graph(self, model: str = GPT_4O) -> KnowledgeGraph:
         """Generate the initial graph."""
+        generate = partial(
+            generate_seed_graph,
+            model=model,
+            goal_str=default_goal_str(self.book_name),
+            meaning_str=DEFAULT_MEANING_STR,
+            client=self._client,
+        )
         try:
-            knowledge_graph = generate_seed_graph(
-                model=model,
-                goal_str=default_goal_str(self.book_name),
-                meaning_str=DEFAULT_MEANING_STR,
-                client=self._client,
+            knowledge_graph = ensure_valid_graph(
+                generate(),
+                # The cached response would be the same invalid graph
+                regenerate=partial(generate, use_cache=False),
+                repair=self.repair,
+                max_regenerations=self.max_regenerations,
             )
             self._graphs_history.append({'graph': knowledge_graph, 'rating': None})
         except Exception as e:
+            logger.exception('Failed to generate the initial graph of {}', self.book_name)
             raise RuntimeError(f'Failed to generate initial graph: {e}')
+        logger.info(
+            'Generated the initial graph of {} with {} nodes and {} links',
+            self.book_name,
+            len(knowledge_graph.nodes),
+            len(knowledge_graph.links),
+        )
         return self.get_graph(-1)
 
-    def _rate_graph_from_ix(self, ix: int, model: str = GPT_3_5_TURBO, num_ratings: int = 1) -> List[Feedback]:
-        """Rate the graph."""
+    def _rate_graph_from_ix(self, ix: int, model: str = GPT_3_5_TURBO, num_ratings: int = 1) -> RatingBatch:
+        """Rate the graph, running the ratings concurrently."""
         knowledge_graph = self.get_graph(ix)
-        return [
-            rate_graph(
-                model=model,
+        if self.rating_cascade is not None:
+            cascade_rating = rate_graph_cascade(
                 goal_str=default_goal_str(self.book_name),
                 meaning_str=DEFAULT_MEANING_STR,
                 knowledge_graph=knowledge_graph,
+                settings=self.rating_cascade,
+                num_ratings=num_ratings,
+                max_concurrency=self.max_concurrency,
                 client=self._client,
+                graph_encoding=self.graph_encoding,
             )
-            for _ in range(num_ratings)
-        ]
+            if cascade_rating.reasons:
+                logger.info(
+                    'Escalated the rating of the graph of {} to {}: {}',
+                    self.book_name,
+                    cascade_rating.model,
+                    ', '.join(cascade_rating.reasons),
+                )
+            return cascade_rating.rating_batch
+        return rate_graph_many(
+            model=model,
+            goal_str=default_goal_str(self.book_name),
+            meaning_str=DEFAULT_MEANING_STR,
+            knowledge_graph=knowledge_graph,
+            num_ratings=num_ratings,
+            max_concurrency=self.max_concurrency,
+            client=self._client,
+            graph_encoding=self.graph_encoding,
+        )
 
     def rate_this_graph(self, model: str = GPT_3_5_TURBO, num_ratings: int = 1) -> None:
-        """Rate the last generated graph."""
-        rate_graph = self._rate_graph_from_ix(-1, model, num_ratings=num_ratings)
-        self._graphs_history[-1]['rating'] = rate_graph
+        """Rate the last generated graph.
+
+        Ratings that fail are recorded in the history as `rating_errors`, the graph is only left unrated when all
+        the ratings fail.
+        """
+        rating_batch = self._rate_graph_from_ix(-1, model, num_ratings=num_ratings)
+        if rating_batch.errors:
+            logger.warning(
+                '{} ratings of the graph of {} failed: {}',
+                len(rating_batch.errors),
+                self.book_name,
+                rating_batch.errors,
+            )
+        if not rating_batch.feedbacks:
+            raise RuntimeError(f'All the ratings failed: {rating_batch.errors}')
+        self._graphs_history[-1]['rating'] = rating_batch.feedbacks
+        self._graphs_history[-1]['rating_errors'] = rating_batch.errors
+        logger.info(
+            'Rated the graph of {}: {}',
+            self.book_name,
+            ', '.join(str(feedback.rating) for feedback in rating_batch.feedbacks),
+        )
 
     def generate_new_graph_from_feedback(self, model: str = GPT_4O) -> KnowledgeGraph:
         """Generate a new graph based on the feedback from the last graph."""
@@ -119,15 +291,31 @@ class RatingGraphCreator:
         last_feedbacks: Optional[List[Feedback]] = self._graphs_history[-1]['rating']
         if not last_feedbacks:
             raise ValueError('You need to rate the last graph before generating a new one')
-        new_knowledge_graph = new_graph_from_feedback(
+        generate = partial(
+            new_graph_from_feedback,
             model=model,
             goal_str=default_goal_str(self.book_name),
             meaning_str=DEFAULT_MEANING_STR,
             last_knowledge_graph=last_knowledge_graph,
             last_feedbacks=last_feedbacks,
             client=self._client,
+            graph_encoding=self.graph_encoding,
+            improve_mode=self.improve_mode,
+        )
+        new_knowledge_graph = ensure_valid_graph(
+            generate(),
+            regenerate=partial(generate, use_cache=False),
+            repair=self.repair,
+            max_regenerations=self.max_regenerations,
         )
         self._graphs_history.append({'graph': new_knowledge_graph, 'rating': None})
+        logger.info(
+            'Generated graph {} of {} with {} nodes and {} links',
+            len(self._graphs_history),
+            self.book_name,
+            len(new_knowledge_graph.nodes),
+            len(new_knowledge_graph.links),
+        )
         return new_knowledge_graph
 
     def rate_and_generate(
@@ -141,6 +329,153 @@ class RatingGraphCreator:
         self.generate_new_graph_from_feedback(model_for_generation)
         return self.get_graph(-1)
 
+    def _track_step(self, step: Callable[[], Any]) -> None:
+        """Run a step and add its latency and usage to the last graph of the history."""
+        start = time.monotonic()
+        with track_usage() as usage:
+            step()
+        entry = self._graphs_history[-1]
+        entry['latency_seconds'] = entry.get('latency_seconds', 0.0) + time.monotonic() - start
+        entry['usage'] = entry.get('usage', Usage()) + usage
+
+    def refine_until(
+        self,
+        target_rating: float = 9,
+        patience: int = 2,
+        max_iterations: int = 10,
+        max_calls: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        model_for_rating: str = GPT_3_5_TURBO,
+        model_for_generation: str = GPT_4O,
+        num_ratings: int = 1,
+    ) -> RefineResult:
+        """Rate and improve the graph until it is good enough, stops improving or the budget is spent.
+
+        Each iteration rates the last graph, generating the initial graph first if needed, and improves it from the
+        ratings. The loop stops once the mean rating reaches `target_rating`, after `patience` iterations without a
+        better rating, after `max_iterations` rated graphs, or before an iteration that would exceed `max_calls`,
+        `max_tokens` or `max_seconds`, the cost of an iteration being estimated from the previous one. The latency and
+        usage of each graph are recorded in the history.
+
+        Parameter
+            target_rating (float): The mean rating to reach.
+            patience (int): How many iterations without a better rating are allowed.
+            max_iterations (int): The maximum number of graphs to rate.
+            max_calls (int): The maximum number of LLM calls, cached responses not included.
+            max_tokens (int): The maximum number of prompt and completion tokens.
+            max_seconds (float): The maximum duration of the loop.
+            model_for_rating (str): The model rating the graphs.
+            model_for_generation (str): The model generating the graphs.
+            num_ratings (int): The number of ratings of each graph.
+
+        Returns
+            RefineResult: The best rated graph seen, which is not necessarily the last one.
+        """
+        if patience < 1 or max_iterations < 1:
+            raise ValueError('patience and max_iterations should be at least 1')
+        limits = _RefineLimits(
+            target_rating=target_rating,
+            patience=patience,
+            max_iterations=max_iterations,
+            max_calls=max_calls,
+            max_tokens=max_tokens,
+            max_seconds=max_seconds,
+            num_ratings=num_ratings,
+        )
+        start = time.monotonic()
+        best_ix, best_rating = -1, float('-inf')
+        iterations, since_improvement = 0, 0
+        with track_usage() as usage:
+            if not self._graphs_history:
+                self._track_step(partial(self.generate_initial_graph, model_for_generation))
+            while True:
+                if not self._graphs_history[-1]['rating']:
+                    self._track_step(partial(self.rate_this_graph, model_for_rating, num_ratings))
+                iterations += 1
+                rating = mean(feedback.rating for feedback in self._graphs_history[-1]['rating'] or [])
+                if rating > best_rating:
+                    best_ix, best_rating, since_improvement = len(self._graphs_history) - 1, rating, 0
+                else:
+                    since_improvement += 1
+                stop_reason = limits.stop_reason(
+                    best_rating,
+                    since_improvement,
+                    iterations,
+                    usage,
+                    time.monotonic() - start,
+                    self._graphs_history[-1],
+                )
+                if stop_reason is not None:
+                    break
+                self._track_step(partial(self.generate_new_graph_from_feedback, model_for_generation))
+        logger.info(
+            'Stopped refining the graph of {} after {} iterations ({}), best rating {}',
+            self.book_name,
+            iterations,
+            stop_reason,
+            best_rating,
+        )
+        return RefineResult(
+            graph=self._graphs_history[best_ix]['graph'],
+            rating=best_rating,
+            ix=best_ix - len(self._graphs_history),
+            iterations=iterations,
+            stop_reason=stop_reason,
+            usage=usage,
+            elapsed_seconds=time.monotonic() - start,
+        )
+
+    def beam_search(
+        self,
+        settings: Optional[BeamSearchSettings] = None,
+        client: Optional[AsyncInstructor] = None,
+    ) -> BeamSearchResult:
+        """Search for the best graph with a beam search and replace the history by its lineage.
+
+        The candidate graphs of each round are generated and rated concurrently, see
+        `llm_graphs.agents.beam_search`. The settings left unset take the `max_concurrency`, `graph_encoding` and
+        `improve_mode` of the creator. The search starts from new seed graphs, so the history becomes the lineage of
+        the best graph, from its seed to itself. This runs its own event loop, use `abeam_search` from async code.
+        """
+        # Imported here to avoid a circular import
+        from llm_graphs.agents.beam_search import (
+            BeamSearchSettings,
+            abeam_search,
+        )
+
+        settings = settings or BeamSearchSettings()
+        creator_settings = {
+            'max_concurrency': self.max_concurrency,
+            'graph_encoding': self.graph_encoding,
+            'improve_mode': self.improve_mode,
+        }
+        settings = settings.model_copy(
+            update={name: value for name, value in creator_settings.items() if name not in settings.model_fields_set},
+        )
+        result = asyncio.run(abeam_search(self.book_name, settings, client))
+        self._graphs_history = [
+            {'graph': candidate.graph, 'rating': candidate.ratings, 'rating_errors': candidate.rating_errors}
+            for candidate in result.lineage()
+        ]
+        return result
+
+    def prompt_size_report(self, ix: int = -1) -> Dict[str, PromptSizeReport]:
+        """Return the size of the prompts sent to rate the graph at the given index and to improve it."""
+        knowledge_graph = self.get_graph(ix)
+        goal_str = default_goal_str(self.book_name)
+        reports = {'rate': rate_prompt_size_report(goal_str, DEFAULT_MEANING_STR, knowledge_graph, self.graph_encoding)}
+        feedbacks = self.get_rating(ix)
+        if feedbacks:
+            reports['improve'] = improve_prompt_size_report(
+                goal_str,
+                DEFAULT_MEANING_STR,
+                knowledge_graph,
+                feedbacks,
+                self.graph_encoding,
+            )
+        return reports
+
     def plot(self, ix: int = -1) -> Any:
         """Plot the knowledge graph at the given index."""
         last_knowledge_graph: KnowledgeGraph = self.get_graph(ix)
@@ -0,0 +1,312 @@
+"""Offline batch runner generating the graphs of many books.
+
+    python -m llm_graphs.batch titles.csv graphs.jsonl --workers 8 --max-iterations 3
+
+The titles are read from a JSONL file (one string or one object with a `book_name` or `title` key per line) or from
+a CSV file (a `book_name` or `title` column, the first column otherwise). One `BookGraphResult` per title is appended
+to the output JSONL file as soon as the title is done, so the output file is also the checkpoint: running the same
+command again skips the titles that already succeeded and retries the failed ones.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import partial
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from pydantic import (
+    BaseModel,
+    ValidationError,
+)
+
+from llm_graphs.agents.one_shot_agent import from_book_summary
+from llm_graphs.agents.rating_agent import RatingGraphCreator
+from llm_graphs.defaults import (
+    GPT_3_5_TURBO,
+    GPT_4O,
+)
+from llm_graphs.pipeline import BookGraphResult
+from llm_graphs.step import DEFAULT_MAX_CONCURRENCY
+from llm_graphs.usage import track_usage
+
+TITLE_KEYS = ('book_name', 'title')
+
+BuildFn = Callable[[int, str], BookGraphResult]
+
+
+class BatchStats(BaseModel):
+    """Progress of a batch run, the titles done in a previous run being `skipped`."""
+
+    total: int
+    skipped: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    elapsed_seconds: float = 0
+
+    @property
+    def done(self) -> int:
+        """Return the number of titles done in this run."""
+        return self.succeeded + self.failed
+
+    def throughput(self) -> float:
+        """Return the number of titles done per second in this run."""
+        return self.done / self.elapsed_seconds if self.elapsed_seconds > 0 else 0
+
+    def eta_seconds(self) -> Optional[float]:
+        """Return the estimated number of seconds left, None before the first title is done."""
+        throughput = self.throughput()
+        return (self.total - self.skipped - self.done) / throughput if throughput > 0 else None
+
+    def display(self) -> str:
+        """Return a one-line summary of the progress."""
+        eta = self.eta_seconds()
+        return (
+            f'{self.skipped + self.done}/{self.total} titles ({self.failed} failed, {self.skipped} skipped)'
+            f' - {self.throughput() * 60:.1f} titles/min - ETA {_duration(eta) if eta is not None else "?"}'
+        )
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:d}:{minutes:02d}:{seconds:02d}'
+
+
+def _title_from_record(record: object) -> str:
+    if isinstance(record, str):
+        return record
+    if isinstance(record, dict):
+        for key in TITLE_KEYS:
+            title = record.get(key)
+            if isinstance(title, str):
+                return title
+    raise ValueError(f'No title in {record!r}, expected a string or an object with one of the keys {TITLE_KEYS}')
+
+
+def read_titles(path: Path) -> List[str]:
+    """Return the titles of a JSONL or CSV file, in the order of the file."""
+    with path.open(newline='', encoding='utf-8') as f:
+        if path.suffix.lower() == '.csv':
+            reader = csv.reader(f)
+            header = next(reader, [])
+            columns = [column.strip().lower() for column in header]
+            key = next((key for key in TITLE_KEYS if key in columns), None)
+            if key is None:
+                # No known header, the first column holds the titles and the first row is a title
+                return [row[0] for row in [header, *reader] if row and row[0].strip()]
+            return [row[columns.index(key)] for row in reader if row and row[columns.index(key)].strip()]
+        return [_title_from_record(json.loads(line)) for line in f if line.strip()]
+
+
+def read_finished(output_path: Path) -> Set[int]:
+    """Return the input indices of the titles that succeeded in the output file.
+
+    Lines that cannot be parsed, such as a line cut by a crash, are ignored and their titles are run again.
+    """
+    finished: Set[int] = set()
+    if not output_path.exists():
+        return finished
+    with output_path.open(encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = BookGraphResult.model_validate_json(line)
+            except ValidationError:
+                continue
+            # A later failure of a title does not cancel an earlier success
+            if result.success:
+                finished.add(result.index)
+    return finished
+
+
+def _open_output(output_path: Path) -> TextIO:
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    needs_newline = output_path.exists() and output_path.stat().st_size > 0
+    if needs_newline:
+        with output_path.open('rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    output = output_path.open('a', encoding='utf-8')
+    if needs_newline:
+        # Terminate the line cut by a crash so that the next result starts on its own line
+        output.write('\n')
+    return output
+
+
+def _safe_build(build: BuildFn, index: int, book_name: str) -> BookGraphResult:
+    start = time.monotonic()
+    with track_usage() as usage:
+        try:
+            return build(index, book_name)
+        except Exception as e:
+            return BookGraphResult(
+                index=index,
+                book_name=book_name,
+                success=False,
+                errors=[str(e)],
+                usage=usage,
+                elapsed_seconds=time.monotonic() - start,
+            )
+
+
+def run_batch(
+    titles: List[str],
+    output_path: Path,
+    build: BuildFn,
+    max_workers: int = DEFAULT_MAX_CONCURRENCY,
+    on_progress: Optional[Callable[[BatchStats], None]] = None,
+) -> BatchStats:
+    """Build the graph of every title not finished yet in `output_path`, appending the results as they complete.
+
+    Parameter
+        titles (List[str]): The titles, the index of a title in this list identifying it in the output.
+        output_path (Path): The output JSONL file, read first to skip the titles that already succeeded.
+        build (BuildFn): The function building the graph of the title at an index.
+        max_workers (int): The number of titles built at the same time.
+        on_progress (Callable): Called with the progress after each title.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers should be at least 1')
+    finished = read_finished(output_path)
+    todo: Iterator[Tuple[int, str]] = ((ix, title) for ix, title in enumerate(titles) if ix not in finished)
+    stats = BatchStats(total=len(titles), skipped=len(finished.intersection(range(len(titles)))))
+    start = time.monotonic()
+    with _open_output(output_path) as output, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running: Dict[Future[BookGraphResult], int] = {}
+        while True:
+            # Only a bounded number of titles is submitted ahead, whatever the size of the input
+            while len(running) < 2 * max_workers:
+                item = next(todo, None)
+                if item is None:
+                    break
+                running[executor.submit(_safe_build, build, *item)] = item[0]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                result = future.result()
+                output.write(result.model_dump_json() + '\n')
+                output.flush()
+                os.fsync(output.fileno())
+                if result.success:
+                    stats.succeeded += 1
+                else:
+                    stats.failed += 1
+                stats.elapsed_seconds = time.monotonic() - start
+                if on_progress is not None:
+                    on_progress(stats)
+    stats.elapsed_seconds = time.monotonic() - start
+    return stats
+
+
+def build_with_rating_agent(
+    index: int,
+    book_name: str,
+    max_iterations: int = 3,
+    target_rating: float = 9,
+    patience: int = 2,
+    num_ratings: int = 1,
+    model_for_generation: str = GPT_4O,
+    model_for_rating: str = GPT_3_5_TURBO,
+) -> BookGraphResult:
+    """Build the graph of a book with `RatingGraphCreator.refine_until`, keeping the best rated graph."""
+    creator = RatingGraphCreator(book_name, max_concurrency=num_ratings)
+    result = creator.refine_until(
+        target_rating=target_rating,
+        patience=patience,
+        max_iterations=max_iterations,
+        model_for_rating=model_for_rating,
+        model_for_generation=model_for_generation,
+        num_ratings=num_ratings,
+    )
+    return BookGraphResult(
+        index=index,
+        book_name=book_name,
+        success=True,
+        graph=result.graph,
+        feedbacks=creator.get_rating(result.ix) or [],
+        usage=result.usage,
+        elapsed_seconds=result.elapsed_seconds,
+    )
+
+
+def build_one_shot(index: int, book_name: str, model: str = 'gpt-4') -> BookGraphResult:
+    """Build the graph of a book with a single call, see `llm_graphs.agents.one_shot_agent`."""
+    start = time.monotonic()
+    with track_usage() as usage:
+        graph = from_book_summary(book_name, model=model)
+    return BookGraphResult(
+        index=index,
+        book_name=book_name,
+        success=True,
+        graph=graph,
+        usage=usage,
+        elapsed_seconds=time.monotonic() - start,
+    )
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m llm_graphs.batch', description=__doc__.splitlines()[0])
+    parser.add_argument('input', type=Path, help='The JSONL or CSV file of titles.')
+    parser.add_argument('output', type=Path, help='The JSONL file the results are appended to.')
+    parser.add_argument('--mode', choices=['rating', 'one-shot'], default='rating', help='How the graphs are built.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_CONCURRENCY, help='Titles built at the same time.')
+    parser.add_argument('--max-iterations', type=int, default=3, help='Graphs rated per title in rating mode.')
+    parser.add_argument('--target-rating', type=float, default=9, help='Rating stopping a title in rating mode.')
+    parser.add_argument('--patience', type=int, default=2, help='Iterations without improvement in rating mode.')
+    parser.add_argument('--num-ratings', type=int, default=1, help='Ratings per graph in rating mode.')
+    parser.add_argument('--model', type=str, default=GPT_4O, help='The model generating the graphs.')
+    parser.add_argument('--rating-model', type=str, default=GPT_3_5_TURBO, help='The model rating the graphs.')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the batch runner with the command line arguments, return the exit code."""
+    args = _parser().parse_args(argv)
+    build: BuildFn
+    if args.mode == 'one-shot':
+        build = partial(build_one_shot, model=args.model)
+    else:
+        build = partial(
+            build_with_rating_agent,
+            max_iterations=args.max_iterations,
+            target_rating=args.target_rating,
+            patience=args.patience,
+            num_ratings=args.num_ratings,
+            model_for_generation=args.model,
+            model_for_rating=args.rating_model,
+        )
+    titles = read_titles(args.input)
+    stats = run_batch(
+        titles,
+        args.output,
+        build,
+        max_workers=args.workers,
+        on_progress=lambda stats: print(stats.display(), file=sys.stderr, flush=True),  # noqa: T201
+    )
+    print(stats.display(), file=sys.stderr)  # noqa: T201
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""Content-addressed cache for the LLM responses of the step functions.
+
+Responses are stored as the JSON dump of their response model, under a hash of the model name, the response model
+schema and the rendered messages, so a cached response is only reused for the exact same request.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from collections import OrderedDict
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.metrics import register_callback_gauge
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class CacheStats(BaseModel):
+    """Counters of a response cache."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    entries: int = 0
+    size_bytes: int = 0
+
+
+@lru_cache(maxsize=None)
+def _schema_digest(response_model: Type[BaseModel]) -> str:
+    schema = json.dumps(response_model.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+
+def cache_key(model: str, response_model: Type[BaseModel], messages: List[ChatCompletionMessageParam]) -> str:
+    """Return the key of a request: a hash of the model, the response model schema and the messages."""
+    payload = json.dumps(
+        {
+            'model': model,
+            'response_model': f'{response_model.__name__}:{_schema_digest(response_model)}',
+            'messages': messages,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache(ABC):
+    """Interface of the response cache backends."""
+
+    def __init__(self, ttl: Optional[float] = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        """Initialize the counters shared by the backends.
+
+        Parameter
+            ttl (float): The number of seconds an entry stays valid, entries never expire when None.
+            max_bytes (int): The total size of the stored responses above which the least recently used are evicted.
+        """
+        self.ttl: Optional[float] = ttl
+        self.max_bytes: int = max_bytes
+        self._lock = threading.Lock()
+        self._stats = CacheStats()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the response stored under `key`, or None."""
+
+    @abstractmethod
+    def set(self, key: str, value: bytes) -> None:
+        """Store a response under `key`."""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Remove every entry."""
+
+    @abstractmethod
+    def stats(self) -> CacheStats:
+        """Return a snapshot of the counters."""
+
+
+class MemoryCache(ResponseCache):
+    """In-process LRU cache bounded in number of entries and in bytes."""
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: Optional[float] = None,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ) -> None:
+        """Initialize a new instance of the `MemoryCache` class.
+
+        Parameter
+            max_entries (int): The number of entries above which the least recently used are evicted.
+            ttl (float): The number of seconds an entry stays valid, entries never expire when None.
+            max_bytes (int): The total size of the stored responses above which the least recently used are evicted.
+        """
+        super().__init__(ttl=ttl, max_bytes=max_bytes)
+        self.max_entries: int = max_entries
+        self._entries: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+        self._size_bytes = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats.misses += 1
+                return None
+            created_at, value = entry
+            if self._is_expired(created_at):
+                self._pop(key)
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time.time(), value)
+            self._size_bytes += len(value)
+            while self._entries and (len(self._entries) > self.max_entries or self._size_bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self._stats.evictions += 1
+
+    def _pop(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._size_bytes -= len(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._stats.model_copy(update={'entries': len(self._entries), 'size_bytes': self._size_bytes})
+
+
+class SQLiteCache(ResponseCache):
+    """On-disk cache persisting the responses across restarts in a SQLite database."""
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        """Initialize a new instance of the `SQLiteCache` class.
+
+        Parameter
+            path (str): The path of the SQLite database, created if it does not exist.
+            ttl (float): The number of seconds an entry stays valid, entries never expire when None.
+            max_bytes (int): The total size of the stored responses above which the least recently used are evicted.
+        """
+        super().__init__(ttl=ttl, max_bytes=max_bytes)
+        self.path: str = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+            'created_at REAL NOT NULL, accessed_at REAL NOT NULL)',
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        # Running total of the stored sizes, so that a write does not sum the whole table to know whether to evict
+        (self._size_bytes,) = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection.execute('SELECT value, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._stats.misses += 1
+                return None
+            value, created_at = row
+            if self._is_expired(created_at):
+                self._delete(key, len(value))
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return None
+            self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._stats.hits += 1
+            return bytes(value)
+
+    def set(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, value, len(value), now, now),
+            )
+            self._size_bytes += len(value) - (row[0] if row is not None else 0)
+            if self._size_bytes > self.max_bytes:
+                self._evict()
+
+    def _delete(self, key: str, size: int) -> None:
+        self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+        self._size_bytes -= size
+
+    def _evict(self) -> None:
+        rows = self._connection.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall()
+        for key, size in rows:
+            if self._size_bytes <= self.max_bytes:
+                break
+            self._delete(key, size)
+            self._stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+            self._size_bytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            (entries,) = self._connection.execute('SELECT COUNT(*) FROM responses').fetchone()
+            return self._stats.model_copy(update={'entries': entries, 'size_bytes': self._size_bytes})
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+
+def cache_from_env() -> Optional[ResponseCache]:
+    """Build the cache described by the `LLM_GRAPHS_CACHE*` environment variables.
+
+    `LLM_GRAPHS_CACHE` selects the backend (`memory`, the default, `sqlite` or `none`), `LLM_GRAPHS_CACHE_PATH` the
+    SQLite database, `LLM_GRAPHS_CACHE_TTL` the time to live in seconds and `LLM_GRAPHS_CACHE_MAX_BYTES` the size
+    bound.
+    """
+    backend = os.environ.get('LLM_GRAPHS_CACHE', 'memory').lower()
+    ttl_str = os.environ.get('LLM_GRAPHS_CACHE_TTL')
+    ttl = float(ttl_str) if ttl_str else None
+    max_bytes = int(os.environ.get('LLM_GRAPHS_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return MemoryCache(ttl=ttl, max_bytes=max_bytes)
+    if backend == 'sqlite':
+        path = os.environ.get('LLM_GRAPHS_CACHE_PATH', 'llm_graphs_cache.sqlite3')
+        return SQLiteCache(path, ttl=ttl, max_bytes=max_bytes)
+    raise ValueError(f'Unknown cache backend {backend}, expected one of memory, sqlite or none')
+
+
+_cache: Optional[ResponseCache] = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[ResponseCache]:
+    """Return the process-wide response cache, or None when caching is disabled."""
+    global _cache, _cache_loaded
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache = cache_from_env()
+            _cache_loaded = True
+        return _cache
+
+
+def set_cache(cache: Optional[ResponseCache]) -> Optional[ResponseCache]:
+    """Replace the process-wide response cache, None disables caching. Return the previous cache."""
+    previous = get_cache()
+    global _cache
+    with _cache_lock:
+        _cache = cache
+    return previous
+
+
+def _cache_gauges() -> Dict[Tuple[str, ...], float]:
+    cache = _cache
+    if cache is None:
+        return {}
+    return {(name,): value for name, value in cache.stats().model_dump().items()}
+
+
+register_callback_gauge(
+    'llm_graphs_cache',
+    'Counters and size of the response cache, by stat.',
+    _cache_gauges,
+    ('stat',),
+)
@@ -0,0 +1,252 @@
+"""Cascade of rating models: a cheap model rates first and an expensive one only when the cheap ratings are uncertain.
+
+The cheap ratings are kept when their mean is clearly low or clearly high, they agree with each other and their
+opinions pass a quality check. Otherwise the graph is rated again by the expensive model, whose ratings replace the
+cheap ones. The number of calls and the latency of each tier and the reasons of the escalations are recorded in the
+metrics and in `cascade_stats`.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+)
+
+from pydantic import (
+    BaseModel,
+    Field,
+)
+
+from llm_graphs.defaults import (
+    GPT_3_5_TURBO,
+    GPT_4O,
+)
+from llm_graphs.metrics import (
+    RATING_ESCALATIONS,
+    RATING_TIER_DURATION,
+)
+from llm_graphs.models import (
+    KnowledgeGraph,
+    RatingBatch,
+)
+from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
+)
+from llm_graphs.step import (
+    DEFAULT_MAX_CONCURRENCY,
+    arate_graph_many,
+    rate_graph_many,
+)
+
+if TYPE_CHECKING:
+    from instructor import (
+        AsyncInstructor,
+        Instructor,
+    )
+
+Tier = Literal['cheap', 'expensive']
+EscalationReason = Literal['failed', 'mid_range', 'disagreement', 'quality']
+
+# The same cap as the number of ratings of a request, each cheap rating being a concurrent call
+MAX_CHEAP_NUM_RATINGS = 10
+
+
+class CascadeSettings(BaseModel):
+    """The models of the cascade and when the cheap ratings are escalated to the expensive model.
+
+    The cheap ratings are confident when their mean is at most `confident_below` or at least `confident_above`, they
+    disagree when the highest and the lowest differ by more than `max_spread`, and an opinion fails the quality check
+    when it has fewer than `min_opinion_words` words or its rating is not between 0 and 10. `cheap_num_ratings` is
+    between 1 and `MAX_CHEAP_NUM_RATINGS`.
+    """
+
+    cheap_model: str = GPT_3_5_TURBO
+    expensive_model: str = GPT_4O
+    cheap_num_ratings: int = Field(2, ge=1, le=MAX_CHEAP_NUM_RATINGS)
+    confident_below: float = 4
+    confident_above: float = 7
+    max_spread: int = 2
+    min_opinion_words: int = 12
+
+
+class CascadeRating(BaseModel):
+    """The ratings kept by the cascade, `model` being the model that made them.
+
+    `reasons` are why the cheap ratings were escalated, empty when they were kept. When all the expensive ratings fail,
+    the cheap ratings are kept along with the errors of both tiers.
+    """
+
+    rating_batch: RatingBatch
+    model: str
+    reasons: List[EscalationReason] = []
+
+
+class TierStats(BaseModel):
+    """Rating calls of one tier of the cascade, each one requesting one or more ratings."""
+
+    calls: int = 0
+    seconds: float = 0
+
+
+class CascadeStats(BaseModel):
+    """Counters of the rating cascades of the process."""
+
+    cheap: TierStats = TierStats()
+    expensive: TierStats = TierStats()
+    escalations: Dict[str, int] = {}
+
+
+_stats = CascadeStats()
+_stats_lock = threading.Lock()
+
+
+def cascade_stats() -> CascadeStats:
+    """Return a snapshot of the counters of the rating cascades."""
+    with _stats_lock:
+        return _stats.model_copy(deep=True)
+
+
+@contextmanager
+def _timed_tier(tier: Tier) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        RATING_TIER_DURATION.observe(seconds, tier=tier)
+        with _stats_lock:
+            tier_stats = getattr(_stats, tier)
+            tier_stats.calls += 1
+            tier_stats.seconds += seconds
+
+
+def escalation_reasons(rating_batch: RatingBatch, settings: CascadeSettings) -> List[EscalationReason]:
+    """Return why the ratings of the cheap model should be escalated to the expensive one, empty when they are kept."""
+    feedbacks = rating_batch.feedbacks
+    if not feedbacks:
+        return ['failed']
+    reasons: List[EscalationReason] = []
+    ratings = [feedback.rating for feedback in feedbacks]
+    mean_rating = sum(ratings) / len(ratings)
+    if settings.confident_below < mean_rating < settings.confident_above:
+        reasons.append('mid_range')
+    if max(ratings) - min(ratings) > settings.max_spread:
+        reasons.append('disagreement')
+    if any(
+        not 0 <= feedback.rating <= 10 or len(feedback.opinion.split()) < settings.min_opinion_words
+        for feedback in feedbacks
+    ):
+        reasons.append('quality')
+    return reasons
+
+
+def _escalate(reasons: List[EscalationReason]) -> None:
+    with _stats_lock:
+        for reason in reasons:
+            _stats.escalations[reason] = _stats.escalations.get(reason, 0) + 1
+    for reason in reasons:
+        RATING_ESCALATIONS.inc(reason=reason)
+
+
+def _escalated(
+    cheap_batch: RatingBatch,
+    expensive_batch: RatingBatch,
+    settings: CascadeSettings,
+    reasons: List[EscalationReason],
+) -> CascadeRating:
+    if not expensive_batch.feedbacks and cheap_batch.feedbacks:
+        rating_batch = cheap_batch.model_copy(update={'errors': cheap_batch.errors + expensive_batch.errors})
+        return CascadeRating(rating_batch=rating_batch, model=settings.cheap_model, reasons=reasons)
+    return CascadeRating(rating_batch=expensive_batch, model=settings.expensive_model, reasons=reasons)
+
+
+def rate_graph_cascade(
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    settings: Optional[CascadeSettings] = None,
+    num_ratings: int = 1,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    *,
+    client: Optional[Instructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> CascadeRating:
+    """Rate the graph with the cheap model, and with the expensive one when the cheap ratings are uncertain.
+
+    Parameter
+        goal_str (str): The goal of the graph.
+        meaning_str (str): What the nodes and links mean.
+        knowledge_graph (KnowledgeGraph): The graph to rate.
+        settings (CascadeSettings): The models and the escalation thresholds, the defaults when None.
+        num_ratings (int): The number of ratings of the expensive model, the cheap model makes
+            `settings.cheap_num_ratings`.
+        max_concurrency (int): The maximum number of ratings requested at the same time.
+        client (Instructor): The client of both models, the pooled client of each model when None.
+        use_cache (bool): Whether the first rating of each model may come from the response cache.
+        graph_encoding (GraphEncoding): How the graph is written in the prompt.
+    """
+    settings = settings or CascadeSettings()
+    rate = partial(
+        rate_graph_many,
+        goal_str=goal_str,
+        meaning_str=meaning_str,
+        knowledge_graph=knowledge_graph,
+        max_concurrency=max_concurrency,
+        client=client,
+        use_cache=use_cache,
+        graph_encoding=graph_encoding,
+    )
+    with _timed_tier('cheap'):
+        cheap_batch = rate(model=settings.cheap_model, num_ratings=settings.cheap_num_ratings)
+    reasons = escalation_reasons(cheap_batch, settings)
+    if not reasons:
+        return CascadeRating(rating_batch=cheap_batch, model=settings.cheap_model)
+    _escalate(reasons)
+    with _timed_tier('expensive'):
+        expensive_batch = rate(model=settings.expensive_model, num_ratings=num_ratings)
+    return _escalated(cheap_batch, expensive_batch, settings, reasons)
+
+
+async def arate_graph_cascade(
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    settings: Optional[CascadeSettings] = None,
+    num_ratings: int = 1,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> CascadeRating:
+    """Async counterpart of `rate_graph_cascade`."""
+    settings = settings or CascadeSettings()
+    rate = partial(
+        arate_graph_many,
+        goal_str=goal_str,
+        meaning_str=meaning_str,
+        knowledge_graph=knowledge_graph,
+        max_concurrency=max_concurrency,
+        client=client,
+        use_cache=use_cache,
+        graph_encoding=graph_encoding,
+    )
+    with _timed_tier('cheap'):
+        cheap_batch = await rate(model=settings.cheap_model, num_ratings=settings.cheap_num_ratings)
+    reasons = escalation_reasons(cheap_batch, settings)
+    if not reasons:
+        return CascadeRating(rating_batch=cheap_batch, model=settings.cheap_model)
+    _escalate(reasons)
+    with _timed_tier('expensive'):
+        expensive_batch = await rate(model=settings.expensive_model, num_ratings=num_ratings)
+    return _escalated(cheap_batch, expensive_batch, settings, reasons)
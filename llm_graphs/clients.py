@@ -0,0 +1,253 @@
+"""Process-wide registry of pooled LLM clients.
+
+Building an `OpenAI` client creates a new httpx connection pool, so creating one per call means a new TLS handshake
+per call. The registry hands out one instructor client per (base url, api key, model family) and keeps its
+connections alive between calls. httpx, openai and instructor are only imported when the first client is built, so
+importing this module stays cheap.
+"""
+from __future__ import annotations
+
+import hashlib
+import importlib.util
+import os
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.limits import get_limiter
+from llm_graphs.metrics import PARSE_ERRORS
+
+if TYPE_CHECKING:
+    from instructor import (
+        AsyncInstructor,
+        Instructor,
+    )
+    from openai import (
+        DefaultAsyncHttpxClient,
+        DefaultHttpxClient,
+        Timeout,
+    )
+
+ClientKey = Tuple[Optional[str], str, str]
+
+_ENV_PREFIX = 'LLM_GRAPHS_'
+
+
+class ClientSettings(BaseModel):
+    """Connection pool and timeout settings shared by the pooled clients.
+
+    `max_retries` are the retries of the OpenAI SDK, only used while the rate limiter of `llm_graphs.limits` is
+    disabled.
+    """
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60.0
+    connect_timeout: float = 10.0
+    timeout: float = 120.0
+    max_retries: int = 2
+    http2: bool = True
+
+    @classmethod
+    def from_env(cls) -> ClientSettings:
+        """Return the settings, overridden by the `LLM_GRAPHS_<FIELD>` environment variables."""
+        overrides = {
+            name: os.environ[f'{_ENV_PREFIX}{name.upper()}']
+            for name in cls.model_fields
+            if f'{_ENV_PREFIX}{name.upper()}' in os.environ
+        }
+        return cls.model_validate(overrides)
+
+
+def model_family(model: Optional[str]) -> str:
+    """Return the family of a model, e.g. `gpt` for `gpt-4o`."""
+    if not model:
+        return 'default'
+    return model.split('-', 1)[0].lower()
+
+
+def http2_available() -> bool:
+    """Return whether the optional `h2` package needed by httpx for HTTP/2 is installed."""
+    return importlib.util.find_spec('h2') is not None
+
+
+class ClientRegistry:
+    """Hand out one pooled instructor client per (base url, api key, model family)."""
+
+    def __init__(self, settings: Optional[ClientSettings] = None) -> None:
+        """Initialize a new instance of the `ClientRegistry` class.
+
+        Parameter
+            settings (ClientSettings): The pool settings, read from the environment when not given.
+        """
+        self.settings: ClientSettings = settings or ClientSettings.from_env()
+        self._lock = threading.Lock()
+        self._clients: Dict[ClientKey, Instructor] = {}
+        self._async_clients: Dict[ClientKey, AsyncInstructor] = {}
+        self._http_clients: List[DefaultHttpxClient] = []
+        self._async_http_clients: List[DefaultAsyncHttpxClient] = []
+
+    def _key(self, model: Optional[str], base_url: Optional[str], api_key: Optional[str]) -> ClientKey:
+        resolved_api_key = api_key or os.environ.get('OPENAI_API_KEY') or ''
+        # Only keep a digest of the api key so it does not end up in reprs or tracebacks
+        api_key_digest = hashlib.sha256(resolved_api_key.encode()).hexdigest()[:16]
+        return base_url or os.environ.get('OPENAI_BASE_URL'), api_key_digest, model_family(model)
+
+    def _http_client_options(self) -> Dict[str, Any]:
+        # openai does not re-export `Limits`, take it from its own defaults so it matches the httpx module the SDK
+        # builds its clients with
+        from openai._constants import DEFAULT_CONNECTION_LIMITS
+
+        limits = type(DEFAULT_CONNECTION_LIMITS)(
+            max_connections=self.settings.max_connections,
+            max_keepalive_connections=self.settings.max_keepalive_connections,
+            keepalive_expiry=self.settings.keepalive_expiry,
+        )
+        return {'limits': limits, 'timeout': self._timeout(), 'http2': self.settings.http2 and http2_available()}
+
+    def _max_retries(self) -> int:
+        # The rate limiter retries the calls itself, the SDK retrying them too would multiply the attempts
+        return 0 if get_limiter() is not None else self.settings.max_retries
+
+    def _timeout(self) -> Timeout:
+        from openai import Timeout
+
+        return Timeout(self.settings.timeout, connect=self.settings.connect_timeout)
+
+    def get_client(
+        self,
+        model: Optional[str] = None,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+    ) -> Instructor:
+        """Return the pooled sync client for the given model, creating it on first use."""
+        import instructor
+        from openai import (
+            DefaultHttpxClient,
+            OpenAI,
+        )
+
+        key = self._key(model, base_url, api_key)
+        with self._lock:
+            if key not in self._clients:
+                http_client = DefaultHttpxClient(**self._http_client_options())
+                self._http_clients.append(http_client)
+                self._clients[key] = instructor.from_openai(
+                    OpenAI(
+                        base_url=base_url,
+                        api_key=api_key,
+                        http_client=http_client,
+                        max_retries=self._max_retries(),
+                        timeout=self._timeout(),
+                    ),
+                )
+                self._count_parse_errors(self._clients[key], key)
+            return self._clients[key]
+
+    def get_async_client(
+        self,
+        model: Optional[str] = None,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+    ) -> AsyncInstructor:
+        """Return the pooled async client for the given model, creating it on first use."""
+        import instructor
+        from openai import (
+            AsyncOpenAI,
+            DefaultAsyncHttpxClient,
+        )
+
+        key = self._key(model, base_url, api_key)
+        with self._lock:
+            if key not in self._async_clients:
+                http_client = DefaultAsyncHttpxClient(**self._http_client_options())
+                self._async_http_clients.append(http_client)
+                self._async_clients[key] = instructor.from_openai(
+                    AsyncOpenAI(
+                        base_url=base_url,
+                        api_key=api_key,
+                        http_client=http_client,
+                        max_retries=self._max_retries(),
+                        timeout=self._timeout(),
+                    ),
+                )
+                self._count_parse_errors(self._async_clients[key], key)
+            return self._async_clients[key]
+
+    @staticmethod
+    def _count_parse_errors(client: Instructor | AsyncInstructor, key: ClientKey) -> None:
+        # Each response failing its response model validation is retried by instructor
+        client.on('parse:error', lambda _: PARSE_ERRORS.inc(model_family=key[2]))
+
+    def warm(self, models: List[str]) -> None:
+        """Build the sync and async clients of `models` ahead of their first call.
+
+        The first client pays for importing httpx, openai and instructor, which would otherwise land on the first
+        request. No connection is opened.
+        """
+        for model in models:
+            self.get_client(model)
+            self.get_async_client(model)
+
+    def close(self) -> None:
+        """Close the sync connection pools, the next call to `get_client` builds a new client."""
+        with self._lock:
+            http_clients, self._http_clients = self._http_clients, []
+            self._clients.clear()
+        for http_client in http_clients:
+            http_client.close()
+
+    async def aclose(self) -> None:
+        """Close every connection pool, sync and async."""
+        with self._lock:
+            async_http_clients, self._async_http_clients = self._async_http_clients, []
+            self._async_clients.clear()
+        for http_client in async_http_clients:
+            await http_client.aclose()
+        self.close()
+
+
+_default_registry: Optional[ClientRegistry] = None
+_default_registry_lock = threading.Lock()
+
+
+def default_registry() -> ClientRegistry:
+    """Return the process-wide client registry."""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ClientRegistry()
+        return _default_registry
+
+
+def get_client(model: Optional[str] = None) -> Instructor:
+    """Return the pooled sync client of the process-wide registry."""
+    return default_registry().get_client(model)
+
+
+def get_async_client(model: Optional[str] = None) -> AsyncInstructor:
+    """Return the pooled async client of the process-wide registry."""
+    return default_registry().get_async_client(model)
+
+
+def models_to_warm() -> List[str]:
+    """Return the models of the comma separated `LLM_GRAPHS_WARM_CLIENTS` environment variable, none by default."""
+    return [model.strip() for model in os.environ.get('LLM_GRAPHS_WARM_CLIENTS', '').split(',') if model.strip()]
+
+
+def warm_clients(models: Optional[List[str]] = None) -> None:
+    """Build the clients of `models` in the process-wide registry, the models of `models_to_warm` when None."""
+    default_registry().warm(models_to_warm() if models is None else models)
+
+
+async def aclose_clients() -> None:
+    """Close the connection pools of the process-wide registry."""
+    await default_registry().aclose()
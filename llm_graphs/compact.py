@@ -0,0 +1,273 @@
+"""Compact, array-backed representation of knowledge graphs.
+
+A `KnowledgeGraph` holds one pydantic object per node and link and finds a node by scanning the node list. A
+`CompactGraph` stores the same data in a few flat arrays: strings are interned in a `StringTable` (which can be
+shared by many graphs), nodes are addressed by their position, and the outgoing and incoming links of every node
+are stored in CSR form (an offsets array and a flat array of neighbours).
+"""
+from __future__ import annotations
+
+from array import array
+from collections import deque
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+
+class StringTable:
+    """Intern strings as integer references, so the strings shared by several graphs are stored once."""
+
+    __slots__ = ('_index', '_strings')
+
+    def __init__(self) -> None:
+        """Initialize an empty string table."""
+        self._strings: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def add(self, value: str) -> int:
+        """Return the reference of `value`, adding it to the table if needed."""
+        ref = self._index.get(value)
+        if ref is None:
+            ref = len(self._strings)
+            self._strings.append(value)
+            self._index[value] = ref
+        return ref
+
+    def __getitem__(self, ref: int) -> str:
+        return self._strings[ref]
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+
+def _csr(num_nodes: int, sources: array[int], targets: array[int]) -> Tuple[array[int], array[int], array[int]]:
+    """Return the offsets, neighbours and link positions of the links grouped by source, skipping dangling links."""
+    offsets = array('i', [0] * (num_nodes + 1))
+    for source, target in zip(sources, targets):
+        if source >= 0 and target >= 0:
+            offsets[source + 1] += 1
+    for ix in range(num_nodes):
+        offsets[ix + 1] += offsets[ix]
+    neighbours = array('i', [0] * offsets[num_nodes])
+    link_ixs = array('i', [0] * offsets[num_nodes])
+    cursor = array('i', offsets[:num_nodes])
+    for link_ix, (source, target) in enumerate(zip(sources, targets)):
+        if source >= 0 and target >= 0:
+            neighbours[cursor[source]] = target
+            link_ixs[cursor[source]] = link_ix
+            cursor[source] += 1
+    return offsets, neighbours, link_ixs
+
+
+class CompactGraph:
+    """Read-only, array-backed view of a `KnowledgeGraph` with O(1) lookups by node id."""
+
+    __slots__ = (
+        'strings',
+        'name_ref',
+        'reasoning_ref',
+        'node_ids',
+        'node_name_refs',
+        'node_description_refs',
+        'link_ids',
+        'link_name_refs',
+        'link_description_refs',
+        'link_from_ids',
+        'link_to_ids',
+        '_index',
+        '_out_offsets',
+        '_out_nodes',
+        '_out_links',
+        '_in_offsets',
+        '_in_nodes',
+        '_in_links',
+    )
+
+    def __init__(self, knowledge_graph: KnowledgeGraph, strings: Optional[StringTable] = None) -> None:
+        """Build the compact representation of `knowledge_graph`.
+
+        Parameter
+            knowledge_graph (KnowledgeGraph): The graph to represent.
+            strings (StringTable): The string table to intern the names and descriptions in, a new one when None.
+        """
+        self.strings: StringTable = strings if strings is not None else StringTable()
+        self.name_ref: int = self.strings.add(knowledge_graph.name)
+        self.reasoning_ref: int = self.strings.add(knowledge_graph.reasoning)
+
+        nodes = knowledge_graph.nodes
+        self.node_ids = array('q', (node.node_id for node in nodes))
+        self.node_name_refs = array('i', (self.strings.add(node.name) for node in nodes))
+        self.node_description_refs = array('i', (self.strings.add(node.description) for node in nodes))
+        self._index: Dict[int, int] = {}
+        for ix, node_id in enumerate(self.node_ids):
+            # The first node wins when an id is duplicated, as in `llm_graphs.validation`
+            self._index.setdefault(node_id, ix)
+
+        links = knowledge_graph.links
+        self.link_ids = array('q', (link.link_id for link in links))
+        self.link_name_refs = array('i', (self.strings.add(link.name) for link in links))
+        self.link_description_refs = array('i', (self.strings.add(link.description) for link in links))
+        self.link_from_ids = array('q', (link.node_id_from for link in links))
+        self.link_to_ids = array('q', (link.node_id_to for link in links))
+
+        # Dangling links are kept for the round-trip but left out of the adjacency
+        sources = array('i', (self._index.get(node_id, -1) for node_id in self.link_from_ids))
+        targets = array('i', (self._index.get(node_id, -1) for node_id in self.link_to_ids))
+        self._out_offsets, self._out_nodes, self._out_links = _csr(len(nodes), sources, targets)
+        self._in_offsets, self._in_nodes, self._in_links = _csr(len(nodes), targets, sources)
+
+    @classmethod
+    def from_knowledge_graph(
+        cls,
+        knowledge_graph: KnowledgeGraph,
+        strings: Optional[StringTable] = None,
+    ) -> CompactGraph:
+        """Return the compact representation of `knowledge_graph`."""
+        return cls(knowledge_graph, strings)
+
+    def to_knowledge_graph(self) -> KnowledgeGraph:
+        """Return the `KnowledgeGraph` this graph was built from."""
+        return KnowledgeGraph(
+            nodes=[self._node(ix) for ix in range(len(self.node_ids))],
+            links=[self._link(ix) for ix in range(len(self.link_ids))],
+            name=self.strings[self.name_ref],
+            reasoning=self.strings[self.reasoning_ref],
+        )
+
+    @property
+    def name(self) -> str:
+        """Return the name of the graph."""
+        return self.strings[self.name_ref]
+
+    @property
+    def num_nodes(self) -> int:
+        """Return the number of nodes."""
+        return len(self.node_ids)
+
+    @property
+    def num_links(self) -> int:
+        """Return the number of links, dangling links included."""
+        return len(self.link_ids)
+
+    def __contains__(self, node_id: int) -> bool:
+        return node_id in self._index
+
+    def index_of(self, node_id: int) -> int:
+        """Return the position of the node `node_id`."""
+        try:
+            return self._index[node_id]
+        except KeyError:
+            raise KeyError(f'No node with id {node_id}') from None
+
+    def _node(self, ix: int) -> Node:
+        return Node(
+            node_id=self.node_ids[ix],
+            name=self.strings[self.node_name_refs[ix]],
+            description=self.strings[self.node_description_refs[ix]],
+        )
+
+    def _link(self, ix: int) -> Link:
+        return Link(
+            link_id=self.link_ids[ix],
+            name=self.strings[self.link_name_refs[ix]],
+            node_id_from=self.link_from_ids[ix],
+            node_id_to=self.link_to_ids[ix],
+            description=self.strings[self.link_description_refs[ix]],
+        )
+
+    def node(self, node_id: int) -> Node:
+        """Return the node `node_id`."""
+        return self._node(self.index_of(node_id))
+
+    def node_name(self, node_id: int) -> str:
+        """Return the name of the node `node_id`."""
+        return self.strings[self.node_name_refs[self.index_of(node_id)]]
+
+    def successors(self, node_id: int) -> List[int]:
+        """Return the ids of the nodes the links of `node_id` point to."""
+        ix = self.index_of(node_id)
+        return [self.node_ids[target] for target in self._out_nodes[self._out_offsets[ix] : self._out_offsets[ix + 1]]]
+
+    def predecessors(self, node_id: int) -> List[int]:
+        """Return the ids of the nodes with a link pointing to `node_id`."""
+        ix = self.index_of(node_id)
+        return [self.node_ids[source] for source in self._in_nodes[self._in_offsets[ix] : self._in_offsets[ix + 1]]]
+
+    def out_links(self, node_id: int) -> List[Link]:
+        """Return the links starting from `node_id`."""
+        ix = self.index_of(node_id)
+        return [self._link(link_ix) for link_ix in self._out_links[self._out_offsets[ix] : self._out_offsets[ix + 1]]]
+
+    def in_links(self, node_id: int) -> List[Link]:
+        """Return the links pointing to `node_id`."""
+        ix = self.index_of(node_id)
+        return [self._link(link_ix) for link_ix in self._in_links[self._in_offsets[ix] : self._in_offsets[ix + 1]]]
+
+    def neighbours(self, node_id: int) -> List[int]:
+        """Return the ids of the nodes linked to `node_id` in either direction, without duplicates."""
+        return list(dict.fromkeys(self.successors(node_id) + self.predecessors(node_id)))
+
+    def out_degree(self, node_id: int) -> int:
+        """Return the number of links starting from `node_id`."""
+        ix = self.index_of(node_id)
+        return self._out_offsets[ix + 1] - self._out_offsets[ix]
+
+    def in_degree(self, node_id: int) -> int:
+        """Return the number of links pointing to `node_id`."""
+        ix = self.index_of(node_id)
+        return self._in_offsets[ix + 1] - self._in_offsets[ix]
+
+    def degree(self, node_id: int) -> int:
+        """Return the number of links starting from or pointing to `node_id`."""
+        return self.out_degree(node_id) + self.in_degree(node_id)
+
+    def degrees(self) -> array[int]:
+        """Return the degree of every node, in the order of the nodes."""
+        return array(
+            'i',
+            (
+                self._out_offsets[ix + 1] - self._out_offsets[ix] + self._in_offsets[ix + 1] - self._in_offsets[ix]
+                for ix in range(self.num_nodes)
+            ),
+        )
+
+    def link_ends(self) -> Tuple[array[int], array[int]]:
+        """Return the positions of the source and target nodes of the links, grouped by source, dangling links excluded."""
+        sources = array('i')
+        for ix in range(self.num_nodes):
+            sources.extend([ix] * (self._out_offsets[ix + 1] - self._out_offsets[ix]))
+        return sources, array('i', self._out_nodes)
+
+    def components(self) -> List[List[int]]:
+        """Return the node ids of each weakly connected component, in the order of their first node."""
+        seen = bytearray(self.num_nodes)
+        components: List[List[int]] = []
+        for start in range(self.num_nodes):
+            if seen[start] or self._index[self.node_ids[start]] != start:
+                continue
+            seen[start] = 1
+            component: List[int] = []
+            queue = deque([start])
+            while queue:
+                ix = queue.popleft()
+                component.append(self.node_ids[ix])
+                for neighbour in self._adjacent(ix):
+                    if not seen[neighbour]:
+                        seen[neighbour] = 1
+                        queue.append(neighbour)
+            components.append(component)
+        return components
+
+    def _adjacent(self, ix: int) -> Iterable[int]:
+        yield from self._out_nodes[self._out_offsets[ix] : self._out_offsets[ix + 1]]
+        yield from self._in_nodes[self._in_offsets[ix] : self._in_offsets[ix + 1]]
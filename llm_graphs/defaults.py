@@ -0,0 +1,17 @@
+"""Defaults shared by the agents, the pipelines and the API: the model names and the goal of the book graphs."""
+from __future__ import annotations
+
+GPT_4O = 'gpt-4o'
+GPT_3_5_TURBO = 'gpt-3.5-turbo'
+GPT_4 = 'gpt-4'
+
+DEFAULT_MEANING_STR = (
+    '- the resulting graph will be visually appealing and give a good global understanding of the structure of the book it explains.\n'
+    '- The graph will focus on the concepts and relation between the characters and/or the concepts in the book, not tell the story of the book\n'
+    '- Every link description should be of the form close to "<link_description> represent  <reason>" you are allowed not to follow exactly this pattern though\n'
+)
+
+
+def default_goal_str(book_name: str) -> str:
+    """Returns the goal string for the graph creator."""
+    return f'Generate a graph that will help the reader to understand the structure of the book {book_name}'
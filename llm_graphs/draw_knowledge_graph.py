@@ -1,35 +1,191 @@
+"""Rendering of the knowledge graphs as interactive pyvis HTML pages, in memory.
+
+The pages are built with `Network.generate_html`, never written to disk, and kept in a render cache under a hash of
+the graph and of the render options, so rendering the same graph twice costs a dictionary lookup. The nodes are placed
+on the server by `llm_graphs.layout` and the physics simulation of the browsers is disabled, unless the options ask
+for the live Barnes-Hut simulation of vis.js.
+"""
 from __future__ import annotations
 
-from typing import Any
+import hashlib
+import html
+import json
+import threading
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Literal,
+    Optional,
+    Tuple,
+)
 
-from pyvis.network import Network  # mypy: ignore-errors
+from pydantic import BaseModel
 
+from llm_graphs.cache import (
+    MemoryCache,
+    ResponseCache,
+)
+from llm_graphs.layout_settings import LayoutSettings
+from llm_graphs.metrics import register_callback_gauge
 from llm_graphs.models import KnowledgeGraph
 
+DEFAULT_RENDER_CACHE_ENTRIES = 256
+DEFAULT_RENDER_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class RenderOptions(BaseModel):
+    """Options of the HTML rendering of a graph.
+
+    `cdn_resources` is `remote` to load vis.js from a CDN or `in_line` to embed it in the page, which is then
+    self-contained but larger. The nodes are fixed at the positions computed with `layout`, or, when it is None, placed
+    by the physics simulation of the browser with the `gravity` and `overlap` of its Barnes-Hut solver.
+    """
+
+    width: str = '800px'
+    height: str = '600px'
+    directed: bool = True
+    cdn_resources: Literal['remote', 'in_line'] = 'remote'
+    gravity: float = -1000
+    overlap: float = 100
+    layout: Optional[LayoutSettings] = LayoutSettings()
+
+
+def render_key(knowledge_graph: KnowledgeGraph, options: Optional[RenderOptions] = None) -> str:
+    """Return the hash identifying the page of `knowledge_graph` rendered with `options`."""
+    options = options or RenderOptions()
+    payload = json.dumps({'graph': knowledge_graph.model_dump(), 'options': options.model_dump()}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def build_network(knowledge_graph: KnowledgeGraph, options: Optional[RenderOptions] = None) -> Any:  # noqa: ANN401
+    """Return the `pyvis.network.Network` of a knowledge graph, pyvis having no type hints.
+
+    Parameter
+        knowledge_graph (KnowledgeGraph): The knowledge graph object to visualize.
+        options (RenderOptions): The render options, the defaults when None.
+    """
+    # Imported here as it pulls in IPython and networkx
+    from pyvis.network import Network
+
+    # Imported here as it pulls in NumPy
+    from llm_graphs.layout import compute_layout
+
+    options = options or RenderOptions()
+    net = Network(
+        directed=options.directed,
+        width=options.width,
+        height=options.height,
+        cdn_resources=options.cdn_resources,
+    )
+
+    positions = compute_layout(knowledge_graph, options.layout) if options.layout is not None else {}
+
+    # Add nodes to the network, at their fixed position when the layout is computed here
+    for node in knowledge_graph.nodes:
+        position = positions.get(node.node_id)
+        coordinates = {'x': position[0], 'y': position[1], 'physics': False} if position is not None else {}
+        net.add_node(
+            node.node_id,
+            label=node.name,
+            title=node.description.replace('.', '.\n'),
+            shape='box',
+            **coordinates,
+        )
+
+    # Add edges to the network
+    for link in knowledge_graph.links:
+        net.add_edge(link.node_id_from, link.node_id_to, label=link.name, title=link.description.replace('.', '.\n'))
+
+    # Set layout options
+    if options.layout is None:
+        net.barnes_hut(gravity=options.gravity, overlap=options.overlap)
+    else:
+        # The dynamic edges need the simulation, the continuous ones are drawn from the node positions only
+        net.toggle_physics(status=False)
+        net.set_edge_smooth('continuous')
+    return net
+
+
+def render_html(knowledge_graph: KnowledgeGraph, options: Optional[RenderOptions] = None) -> bytes:
+    """Return the HTML page of a knowledge graph, from the render cache when it was already rendered.
+
+    Parameter
+        knowledge_graph (KnowledgeGraph): The knowledge graph object to visualize.
+        options (RenderOptions): The render options, the defaults when None.
+    """
+    return render_with_key(knowledge_graph, options)[1]
 
-def draw_with_pyvis(knowledge_graph: KnowledgeGraph) -> Any:  # noqa: D417,ANN401
+
+def render_with_key(knowledge_graph: KnowledgeGraph, options: Optional[RenderOptions] = None) -> Tuple[str, bytes]:
+    """Return the render key and the HTML page of a knowledge graph, see `render_html`."""
+    key = render_key(knowledge_graph, options)
+    cache = get_render_cache()
+    page = cache.get(key) if cache is not None else None
+    if page is None:
+        page = build_network(knowledge_graph, options).generate_html().encode()
+        if cache is not None:
+            cache.set(key, page)
+    return key, page
+
+
+def save_html(knowledge_graph: KnowledgeGraph, path: str | Path, options: Optional[RenderOptions] = None) -> Path:
+    """Write the HTML page of a knowledge graph to `path` and return it."""
+    path = Path(path)
+    path.write_bytes(render_html(knowledge_graph, options))
+    return path
+
+
+def draw_with_pyvis(knowledge_graph: KnowledgeGraph, options: Optional[RenderOptions] = None) -> Any:  # noqa: ANN401
     """Draws a knowledge graph using Pyvis library.
 
     Parameters
     ----------
         knowledge_graph (KnowledgeGraph): The knowledge graph object to visualize.
+        options (RenderOptions): The render options, the defaults when None.
 
     Returns
     -------
-        str: The path to the HTML file where the network is displayed.
+        IPython.display.IFrame: The page inlined in an iframe, displayed by the notebooks without any file written.
     """
-    net = Network(notebook=True, directed=True, width='800px', height='600px')
+    from IPython.display import IFrame
 
-    # Add nodes to the network
-    for node in knowledge_graph.nodes:
-        net.add_node(node.node_id, label=node.name, title=node.description.replace('.', '.\n'), shape='box')
+    options = options or RenderOptions()
+    page = render_html(knowledge_graph, options).decode()
+    return IFrame('', width=options.width, height=options.height, extras=[f'srcdoc="{html.escape(page)}"'])
 
-    # Add edges to the network
-    for link in knowledge_graph.links:
-        net.add_edge(link.node_id_from, link.node_id_to, label=link.name, title=link.description.replace('.', '.\n'))
 
-    # Set layout options
-    net.barnes_hut(gravity=-1000, overlap=100)
+_render_cache: Optional[ResponseCache] = MemoryCache(
+    max_entries=DEFAULT_RENDER_CACHE_ENTRIES,
+    max_bytes=DEFAULT_RENDER_CACHE_BYTES,
+)
+_render_cache_lock = threading.Lock()
+
+
+def get_render_cache() -> Optional[ResponseCache]:
+    """Return the process-wide render cache, or None when the pages are rendered on every call."""
+    with _render_cache_lock:
+        return _render_cache
+
+
+def set_render_cache(cache: Optional[ResponseCache]) -> Optional[ResponseCache]:
+    """Replace the process-wide render cache, None disables it. Return the previous cache."""
+    global _render_cache
+    with _render_cache_lock:
+        previous, _render_cache = _render_cache, cache
+    return previous
+
+
+def _render_cache_gauges() -> Dict[Tuple[str, ...], float]:
+    cache = _render_cache
+    if cache is None:
+        return {}
+    return {(name,): value for name, value in cache.stats().model_dump().items()}
+
 
-    # Display the network
-    return net.show(f'{knowledge_graph.name}.html')
+register_callback_gauge(
+    'llm_graphs_render_cache',
+    'Counters and size of the cache of the rendered HTML pages, by stat.',
+    _render_cache_gauges,
+    ('stat',),
+)
@@ -0,0 +1,232 @@
+"""Hedged LLM calls, cutting the tail latency of the async step functions.
+
+When a call has not returned after a high percentile of the latencies recently observed for its model, a second
+identical call is sent and the first one to succeed is kept, the other one being cancelled. The extra calls are capped
+by a budget growing by `max_hedge_ratio` per call, so hedging adds at most that fraction of calls over time whatever
+the latencies. Hedging is opt-in: it is disabled until a `Hedger` is set with `set_hedger` or `LLM_GRAPHS_HEDGING=1`.
+"""
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.metrics import LLM_HEDGES
+
+T = TypeVar('T')
+
+
+class HedgeSettings(BaseModel):
+    """When the calls to one model are hedged.
+
+    The second call is sent after the `percentile` of the last `window` latencies, clamped between `min_delay` and
+    `max_delay`, and only once `min_samples` latencies were observed.
+    """
+
+    percentile: float = 95
+    window: int = 200
+    min_samples: int = 20
+    min_delay: float = 0.5
+    max_delay: Optional[float] = None
+    max_hedge_ratio: float = 0.05
+    max_burst: float = 5
+
+
+class HedgeStats(BaseModel):
+    """Counters of the hedging of one model."""
+
+    calls: int = 0
+    hedged: int = 0
+    hedge_wins: int = 0
+    primary_wins: int = 0
+    rate_capped: int = 0
+    delay_seconds: Optional[float] = None
+
+
+class ModelHedger:
+    """Hedging of the calls to one model, from the latencies of its recent calls."""
+
+    def __init__(self, settings: Optional[HedgeSettings] = None, model: str = '') -> None:
+        """Initialize the latency window and the hedge budget.
+
+        Parameter
+            settings (HedgeSettings): When the calls are hedged, the defaults when None.
+            model (str): The model of the calls, the label of the metrics.
+        """
+        self.settings: HedgeSettings = settings or HedgeSettings()
+        self.model: str = model
+        self._latencies: Deque[float] = deque(maxlen=self.settings.window)
+        self._budget: float = 0
+        self._lock = threading.Lock()
+        self._stats = HedgeStats()
+
+    def delay(self) -> Optional[float]:
+        """Return how long a call runs alone before being hedged, None while too few latencies were observed."""
+        with self._lock:
+            return self._delay()
+
+    def _delay(self) -> Optional[float]:
+        if len(self._latencies) < self.settings.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        rank = math.ceil(self.settings.percentile / 100 * len(latencies))
+        delay = max(latencies[min(max(rank, 1), len(latencies)) - 1], self.settings.min_delay)
+        return min(delay, self.settings.max_delay) if self.settings.max_delay is not None else delay
+
+    def observe(self, latency: float) -> None:
+        """Add the latency in seconds of a successful call to the window."""
+        with self._lock:
+            self._latencies.append(latency)
+
+    def stats(self) -> HedgeStats:
+        """Return a snapshot of the counters and of the current hedge delay."""
+        with self._lock:
+            return self._stats.model_copy(update={'delay_seconds': self._delay()})
+
+    def _start_call(self) -> Optional[float]:
+        with self._lock:
+            self._stats.calls += 1
+            self._budget = min(self._budget + self.settings.max_hedge_ratio, self.settings.max_burst)
+            return self._delay()
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self._budget < 1:
+                self._stats.rate_capped += 1
+                LLM_HEDGES.inc(model=self.model, outcome='rate_capped')
+                return False
+            self._budget -= 1
+            self._stats.hedged += 1
+            return True
+
+    def _record_winner(self, *, hedge_won: bool) -> None:
+        outcome = 'hedge_won' if hedge_won else 'primary_won'
+        with self._lock:
+            if hedge_won:
+                self._stats.hedge_wins += 1
+            else:
+                self._stats.primary_wins += 1
+        LLM_HEDGES.inc(model=self.model, outcome=outcome)
+
+    async def _timed(self, fn: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        result = await fn()
+        self.observe(time.perf_counter() - start)
+        return result
+
+    async def acall(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Return the result of `fn`, called a second time when the first call is slower than the hedge delay.
+
+        The first call to succeed wins and the other one is cancelled. When one call fails the other one is awaited,
+        and the error of the first call is raised when both fail.
+        """
+        delay = self._start_call()
+        primary = asyncio.ensure_future(self._timed(fn))
+        if delay is None:
+            return await primary
+        pending: Set[asyncio.Future[T]] = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done or not self._take_budget():
+                return await primary
+            hedge = asyncio.ensure_future(self._timed(fn))
+            pending.add(hedge)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if not task.cancelled() and task.exception() is None), None)
+                if winner is not None:
+                    self._record_winner(hedge_won=winner is hedge)
+                    return winner.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class Hedger:
+    """The hedging of every model, created on first use with the settings of the model or the default ones."""
+
+    def __init__(
+        self,
+        default_settings: Optional[HedgeSettings] = None,
+        model_settings: Optional[Dict[str, HedgeSettings]] = None,
+    ) -> None:
+        """Initialize the hedging.
+
+        Parameter
+            default_settings (HedgeSettings): The hedging of the models without their own settings.
+            model_settings (Dict[str, HedgeSettings]): The hedging of specific models.
+        """
+        self.default_settings: HedgeSettings = default_settings or HedgeSettings()
+        self.model_settings: Dict[str, HedgeSettings] = dict(model_settings or {})
+        self._hedgers: Dict[str, ModelHedger] = {}
+        self._lock = threading.Lock()
+
+    def for_model(self, model: str) -> ModelHedger:
+        """Return the hedging of `model`."""
+        with self._lock:
+            hedger = self._hedgers.get(model)
+            if hedger is None:
+                hedger = ModelHedger(self.model_settings.get(model, self.default_settings), model)
+                self._hedgers[model] = hedger
+            return hedger
+
+    def stats(self) -> Dict[str, HedgeStats]:
+        """Return the counters of every model."""
+        with self._lock:
+            hedgers = dict(self._hedgers)
+        return {model: hedger.stats() for model, hedger in hedgers.items()}
+
+
+def hedger_from_env() -> Optional[Hedger]:
+    """Build the hedging described by the `LLM_GRAPHS_HEDGING*` environment variables.
+
+    `LLM_GRAPHS_HEDGING=1` enables the hedging, `LLM_GRAPHS_HEDGE_PERCENTILE` sets the latency percentile after which a
+    call is hedged and `LLM_GRAPHS_HEDGE_MAX_RATIO` the fraction of extra calls.
+    """
+    if os.environ.get('LLM_GRAPHS_HEDGING', '').lower() not in ('1', 'true'):
+        return None
+    defaults = HedgeSettings()
+    settings = HedgeSettings(
+        percentile=float(os.environ.get('LLM_GRAPHS_HEDGE_PERCENTILE', defaults.percentile)),
+        max_hedge_ratio=float(os.environ.get('LLM_GRAPHS_HEDGE_MAX_RATIO', defaults.max_hedge_ratio)),
+    )
+    return Hedger(settings)
+
+
+_hedger: Optional[Hedger] = None
+_hedger_loaded = False
+_hedger_lock = threading.Lock()
+
+
+def get_hedger() -> Optional[Hedger]:
+    """Return the process-wide hedging, or None when the calls are not hedged."""
+    global _hedger, _hedger_loaded
+    with _hedger_lock:
+        if not _hedger_loaded:
+            _hedger = hedger_from_env()
+            _hedger_loaded = True
+        return _hedger
+
+
+def set_hedger(hedger: Optional[Hedger]) -> Optional[Hedger]:
+    """Replace the process-wide hedging, None disables it. Return the previous hedging."""
+    previous = get_hedger()
+    global _hedger
+    with _hedger_lock:
+        _hedger = hedger
+    return previous
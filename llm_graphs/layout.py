@@ -0,0 +1,290 @@
+"""Server-side layout of the knowledge graphs, computed once with NumPy instead of by a physics simulation in every
+browser displaying the graph.
+
+Two layouts are available. The force-directed layout is a Fruchterman-Reingold simulation where, on large graphs, the
+repulsion of the nodes far away is approximated Barnes-Hut style by the centres of mass of the cells of a quadtree. The
+layered layout places the nodes of a graph without loops on rows by their depth and orders each row by the
+barycenters of the neighbours to reduce the crossings. The positions only depend on the nodes and links ids, so they
+are cached under a hash of the ids and survive edits of the names and descriptions.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import threading
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    cast,
+)
+
+import numpy as np
+import numpy.typing as npt
+
+from llm_graphs.cache import (
+    MemoryCache,
+    ResponseCache,
+)
+from llm_graphs.compact import CompactGraph
+from llm_graphs.layout_settings import LayoutSettings
+from llm_graphs.metrics import register_callback_gauge
+from llm_graphs.models import KnowledgeGraph
+
+Positions = Dict[int, Tuple[float, float]]
+FloatArray = npt.NDArray[np.float64]
+IntArray = npt.NDArray[np.int64]
+
+DEFAULT_LAYOUT_CACHE_ENTRIES = 1024
+# Distances are in units of the ideal distance between linked nodes during the force simulation
+_MIN_DISTANCE_SQUARED = 1e-4
+_GRAVITY = 0.05
+
+
+def _edges(knowledge_graph: KnowledgeGraph) -> Tuple[List[int], IntArray, IntArray]:
+    """Return the node ids, and the sources and targets of the links as indices in the node ids.
+
+    Duplicated nodes, dangling links and self-loops are ignored.
+    """
+    compact = CompactGraph(knowledge_graph)
+    # The links of a duplicated node id all point to its first node, so the other nodes of that id are dropped
+    first = np.fromiter(
+        (compact.index_of(node_id) == ix for ix, node_id in enumerate(compact.node_ids)),
+        dtype=bool,
+        count=compact.num_nodes,
+    )
+    renumbered = np.cumsum(first) - 1
+    link_sources, link_targets = (np.frombuffer(ends, dtype=np.intc) for ends in compact.link_ends())
+    not_loop = link_sources != link_targets
+    node_ids = [node_id for node_id, is_first in zip(compact.node_ids, first) if is_first]
+    sources = renumbered[link_sources[not_loop]].astype(np.int64)
+    targets = renumbered[link_targets[not_loop]].astype(np.int64)
+    return node_ids, sources, targets
+
+
+def _exact_repulsion(pos: FloatArray) -> FloatArray:
+    delta = pos[:, None, :] - pos[None, :, :]
+    distance_squared = np.maximum(np.einsum('ijk,ijk->ij', delta, delta), _MIN_DISTANCE_SQUARED)
+    np.fill_diagonal(distance_squared, np.inf)
+    return cast(FloatArray, (delta / distance_squared[..., None]).sum(axis=1))
+
+
+def _pair_forces(
+    pos: FloatArray,
+    first: IntArray,
+    second: FloatArray,
+    weight: npt.NDArray[np.float64 | np.int64],
+) -> FloatArray:
+    """Return the sum over the pairs of the repulsion of `second`, of mass `weight`, on `first`."""
+    delta = pos[first] - second
+    distance_squared = np.maximum(np.einsum('ij,ij->i', delta, delta), _MIN_DISTANCE_SQUARED)
+    scale = weight / distance_squared
+    return np.stack([np.bincount(first, weights=delta[:, axis] * scale, minlength=len(pos)) for axis in (0, 1)], axis=1)
+
+
+def _tree_repulsion(pos: FloatArray, leaf_size: int = 8) -> FloatArray:
+    """Return the repulsion forces approximated Barnes-Hut style on a quadtree of regular grids.
+
+    At each level of the tree, a node is pushed by the centres of mass of the cells of its interaction list: the
+    children of the neighbours of the parent of its cell which are not neighbours of its cell. The nodes of the
+    neighbouring leaves push it exactly, for O(n log n) work.
+    """
+    num_nodes = len(pos)
+    depth = max(2, math.ceil(math.log(max(num_nodes / leaf_size, 1), 4)))
+    size = 2**depth
+    # The outliers are clipped to the border cells, so that a few far away nodes do not crowd the others in a cell
+    low, high = np.percentile(pos, [1, 99], axis=0)
+    leaf_xy = np.clip(((pos - low) / np.maximum(high - low, 1e-9) * size).astype(np.int64), 0, size - 1)
+    forces = np.zeros_like(pos)
+    nodes = np.arange(num_nodes)
+    window = np.array([(dx, dy) for dx in range(-2, 4) for dy in range(-2, 4)])
+
+    for level in range(2, depth + 1):
+        level_size = 2**level
+        cell_xy = leaf_xy >> (depth - level)
+        cell = cell_xy[:, 0] * level_size + cell_xy[:, 1]
+        counts = np.bincount(cell, minlength=level_size * level_size)
+        # bincount sums the weights as floats
+        centres = cast(
+            FloatArray,
+            np.stack([np.bincount(cell, weights=pos[:, axis], minlength=len(counts)) for axis in (0, 1)], axis=1),
+        )
+        centres /= np.maximum(counts, 1)[:, None]
+        candidate_xy = 2 * (cell_xy >> 1)[:, None, :] + window[None, :, :]
+        listed = ((candidate_xy >= 0) & (candidate_xy < level_size)).all(axis=2) & (
+            np.abs(candidate_xy - cell_xy[:, None, :]).max(axis=2) > 1
+        )
+        first, slot = np.nonzero(listed)
+        candidate = candidate_xy[first, slot, 0] * level_size + candidate_xy[first, slot, 1]
+        occupied = counts[candidate] > 0
+        first, candidate = first[occupied], candidate[occupied]
+        forces += _pair_forces(pos, first, centres[candidate], counts[candidate])
+
+    # The pairs of nodes in neighbouring leaves, from the nodes sorted by leaf
+    leaf = leaf_xy[:, 0] * size + leaf_xy[:, 1]
+    order = np.argsort(leaf, kind='stable')
+    counts = np.bincount(leaf, minlength=size * size)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour_xy = leaf_xy + (dx, dy)
+            inside = ((neighbour_xy >= 0) & (neighbour_xy < size)).all(axis=1)
+            neighbour = np.where(inside, neighbour_xy[:, 0] * size + neighbour_xy[:, 1], 0)
+            lengths = np.where(inside, counts[neighbour], 0)
+            first = np.repeat(nodes, lengths)
+            offsets = np.arange(len(first)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            second = order[np.repeat(starts[neighbour], lengths) + offsets]
+            distinct = first != second
+            forces += _pair_forces(pos, first[distinct], pos[second[distinct]], np.ones(int(distinct.sum())))
+    return forces
+
+
+def force_layout(num_nodes: int, sources: IntArray, targets: IntArray, settings: LayoutSettings) -> FloatArray:
+    """Return the positions of a Fruchterman-Reingold layout, as a nodes x 2 array in pixels centred on 0."""
+    if num_nodes == 0:
+        return np.zeros((0, 2))
+    rng = np.random.default_rng(settings.seed)
+    pos = rng.uniform(-1, 1, size=(num_nodes, 2)) * math.sqrt(num_nodes)
+    repulsion: Callable[[FloatArray], FloatArray] = _exact_repulsion
+    if num_nodes > settings.exact_max_nodes:
+        repulsion = _tree_repulsion
+    initial_temperature = max(1.0, math.sqrt(num_nodes) / 4)
+    for iteration in range(settings.iterations):
+        forces = repulsion(pos) - _GRAVITY * pos
+        # Linked nodes attract each other with a force growing as the square of their distance
+        delta = pos[sources] - pos[targets]
+        attraction = delta * np.sqrt(np.einsum('ij,ij->i', delta, delta))[:, None]
+        np.add.at(forces, sources, -attraction)
+        np.add.at(forces, targets, attraction)
+        # Each node moves along its force by at most the temperature, which cools down linearly
+        temperature = initial_temperature * (1 - iteration / settings.iterations)
+        norms = np.maximum(np.sqrt(np.einsum('ij,ij->i', forces, forces)), 1e-9)
+        pos += forces * (np.minimum(norms, temperature) / norms)[:, None]
+    return cast(FloatArray, (pos - pos.mean(axis=0)) * settings.node_spacing)
+
+
+def layer_indices(num_nodes: int, sources: IntArray, targets: IntArray) -> Optional[IntArray]:
+    """Return the depth of each node, the length of the longest path reaching it, or None if the graph has a loop."""
+    children: List[List[int]] = [[] for _ in range(num_nodes)]
+    for source, target in zip(sources.tolist(), targets.tolist()):
+        children[source].append(target)
+    indegree = np.bincount(targets, minlength=num_nodes)
+    layer = np.zeros(num_nodes, dtype=np.int64)
+    ready = [i for i in range(num_nodes) if indegree[i] == 0]
+    visited = 0
+    while ready:
+        node = ready.pop()
+        visited += 1
+        for child in children[node]:
+            layer[child] = max(layer[child], layer[node] + 1)
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                ready.append(child)
+    return layer if visited == num_nodes else None
+
+
+def _rank_within_layers(layer: IntArray, key: FloatArray) -> FloatArray:
+    """Return the rank of each node within its layer when the layers are sorted by `key`, minus half the layer size."""
+    order = np.lexsort((key, layer))
+    sizes = np.bincount(layer)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.empty(len(layer), dtype=np.float64)
+    rank[order] = np.arange(len(layer)) - starts[layer[order]]
+    return cast(FloatArray, rank - (sizes[layer] - 1) / 2)
+
+
+def layered_layout(
+    layer: IntArray,
+    sources: IntArray,
+    targets: IntArray,
+    settings: LayoutSettings,
+) -> FloatArray:
+    """Return the positions of a layered layout, as a nodes x 2 array in pixels, the first layer at the top."""
+    num_nodes = len(layer)
+    if num_nodes == 0:
+        return np.zeros((0, 2))
+    x = _rank_within_layers(layer, np.arange(num_nodes, dtype=np.float64))
+    for sweep in range(settings.ordering_sweeps):
+        # Alternately order each layer by the mean position of the parents, then of the children
+        ends, neighbours = (targets, sources) if sweep % 2 == 0 else (sources, targets)
+        degree = np.bincount(ends, minlength=num_nodes)
+        total = np.bincount(ends, weights=x[neighbours], minlength=num_nodes)
+        barycenter = np.where(degree > 0, total / np.maximum(degree, 1), x)
+        x = _rank_within_layers(layer, barycenter)
+    return np.stack([x * settings.node_spacing, layer * settings.layer_spacing], axis=1)
+
+
+def layout_key(knowledge_graph: KnowledgeGraph, settings: LayoutSettings) -> str:
+    """Return the hash of the node ids, the links and the settings, the only inputs of a layout."""
+    payload = json.dumps(
+        {
+            'nodes': [node.node_id for node in knowledge_graph.nodes],
+            'links': [[link.node_id_from, link.node_id_to] for link in knowledge_graph.links],
+            'settings': settings.model_dump(),
+        },
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def compute_layout(knowledge_graph: KnowledgeGraph, settings: Optional[LayoutSettings] = None) -> Positions:
+    """Return the position of each node of a graph, by node id, from the layout cache when it was already computed.
+
+    Parameter
+        knowledge_graph (KnowledgeGraph): The graph to lay out.
+        settings (LayoutSettings): The layout settings, the defaults when None.
+    """
+    settings = settings or LayoutSettings()
+    key = layout_key(knowledge_graph, settings)
+    cache = get_layout_cache()
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return {node_id: (x, y) for node_id, x, y in json.loads(cached)}
+
+    node_ids, sources, targets = _edges(knowledge_graph)
+    layer = layer_indices(len(node_ids), sources, targets) if settings.algorithm != 'force' else None
+    if layer is not None:
+        pos = layered_layout(layer, sources, targets, settings)
+    elif settings.algorithm == 'layered':
+        raise ValueError(f'The graph {knowledge_graph.name} has a loop, it has no layered layout')
+    else:
+        pos = force_layout(len(node_ids), sources, targets, settings)
+    positions = {node_id: (round(float(x), 1), round(float(y), 1)) for node_id, (x, y) in zip(node_ids, pos)}
+    if cache is not None:
+        cache.set(key, json.dumps([[node_id, x, y] for node_id, (x, y) in positions.items()]).encode())
+    return positions
+
+
+_layout_cache: Optional[ResponseCache] = MemoryCache(max_entries=DEFAULT_LAYOUT_CACHE_ENTRIES)
+_layout_cache_lock = threading.Lock()
+
+
+def get_layout_cache() -> Optional[ResponseCache]:
+    """Return the process-wide layout cache, or None when the layouts are computed on every call."""
+    with _layout_cache_lock:
+        return _layout_cache
+
+
+def set_layout_cache(cache: Optional[ResponseCache]) -> Optional[ResponseCache]:
+    """Replace the process-wide layout cache, None disables it. Return the previous cache."""
+    global _layout_cache
+    with _layout_cache_lock:
+        previous, _layout_cache = _layout_cache, cache
+    return previous
+
+
+def _layout_cache_gauges() -> Dict[Tuple[str, ...], float]:
+    cache = _layout_cache
+    if cache is None:
+        return {}
+    return {(name,): value for name, value in cache.stats().model_dump().items()}
+
+
+register_callback_gauge(
+    'llm_graphs_layout_cache',
+    'Counters and size of the cache of the graph layouts, by stat.',
+    _layout_cache_gauges,
+    ('stat',),
+)
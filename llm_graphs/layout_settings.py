@@ -0,0 +1,25 @@
+"""Settings of the graph layouts, kept apart from `llm_graphs.layout` so that using them does not import NumPy."""
+from __future__ import annotations
+
+from typing import Literal
+
+from pydantic import BaseModel
+
+LayoutAlgorithm = Literal['auto', 'force', 'layered']
+
+
+class LayoutSettings(BaseModel):
+    """Settings of the layout of a graph, the distances being in pixels.
+
+    `algorithm` is `layered` for the rows of the layered layout, `force` for the force-directed layout, or `auto` to
+    use the layered layout when the graph has no loop. The force-directed layout approximates the repulsion between
+    far away nodes when the graph has more than `exact_max_nodes` nodes.
+    """
+
+    algorithm: LayoutAlgorithm = 'auto'
+    node_spacing: float = 180
+    layer_spacing: float = 150
+    iterations: int = 150
+    exact_max_nodes: int = 300
+    ordering_sweeps: int = 8
+    seed: int = 0
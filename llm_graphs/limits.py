@@ -0,0 +1,553 @@
+"""Client-side rate limiting, retries and adaptive concurrency for the LLM calls of the step functions.
+
+Each model gets a `ModelLimiter` combining:
+
+- token buckets on the requests and tokens per minute, the tokens of a call being estimated from its messages before
+  the call and corrected with the actual usage after it,
+- an AIMD concurrency cap, halved when the provider answers 429 or 5xx and grown by about one per window of
+  successful calls,
+- retries with jittered exponential backoff, waiting at least as long as the `Retry-After` header asks.
+
+The limiters are shared by the sync and async calls, so the API and `RatingGraphCreator` draw from the same budget.
+Limiting is opt-in: it is disabled until a `RateLimiter` is set with `set_limiter` or `LLM_GRAPHS_LIMITS=1`.
+"""
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.metrics import (
+    LLM_RETRIES,
+    register_callback_gauge,
+)
+from llm_graphs.prompts import estimate_tokens
+
+if TYPE_CHECKING:
+    import openai
+    from openai.types.chat import ChatCompletionMessageParam
+
+T = TypeVar('T')
+
+Outcome = Literal['success', 'overload', 'error']
+
+
+class LimitSettings(BaseModel):
+    """Limits of the calls to one model, None meaning unlimited."""
+
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    expected_completion_tokens: int = 1000
+    max_retries: int = 4
+    base_delay: float = 0.5
+    max_delay: float = 60
+    initial_concurrency: int = 16
+    min_concurrency: int = 1
+    max_concurrency: int = 64
+
+
+class LimiterStats(BaseModel):
+    """Counters of the limiter of one model."""
+
+    calls: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    failures: int = 0
+    throttled_seconds: float = 0
+    concurrency_limit: float = 0
+    in_flight: int = 0
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate_per_minute`, holding at most one minute of tokens.
+
+    `reserve` takes the tokens right away, possibly going into debt, and returns how long the caller has to wait for
+    the debt to be paid back, so callers are served in order and nobody waits while holding the lock.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None) -> None:
+        """Initialize a full bucket."""
+        if rate_per_minute <= 0:
+            raise ValueError('rate_per_minute should be positive')
+        self.rate: float = rate_per_minute / 60
+        self.capacity: float = capacity if capacity is not None else rate_per_minute
+        self._tokens: float = self.capacity
+        self._updated_at: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` tokens and return the number of seconds to wait before using them."""
+        with self._lock:
+            self._refill()
+            # A request bigger than the bucket would wait forever, it only waits for a full bucket
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Take `amount` more tokens, or give them back when negative, once the actual cost of a call is known."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+
+def _resolve(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveConcurrency:
+    """Concurrency cap adjusted with additive increase and multiplicative decrease.
+
+    Sync callers wait on a `threading.Event` and async callers on a future of their event loop, so the cap can be
+    shared by threads and event loops.
+    """
+
+    def __init__(self, initial: int = 16, minimum: int = 1, maximum: int = 64, decrease: float = 0.5) -> None:
+        """Initialize the cap at `initial` calls."""
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError('The concurrency limits should satisfy 1 <= minimum <= initial <= maximum')
+        self.minimum: int = minimum
+        self.maximum: int = maximum
+        self.decrease: float = decrease
+        self._limit: float = initial
+        self._in_flight: int = 0
+        self._waiters: Deque[Callable[[], None]] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> float:
+        """Return the current cap."""
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        """Return the number of calls holding a slot."""
+        return self._in_flight
+
+    def _acquire_or_wait(self, wake: Callable[[], None]) -> bool:
+        with self._lock:
+            if self._in_flight < int(self._limit):
+                self._in_flight += 1
+                return True
+            self._waiters.append(wake)
+            return False
+
+    def _wake(self) -> None:
+        with self._lock:
+            num_free = int(self._limit) - self._in_flight
+            wakes = [self._waiters.popleft() for _ in range(min(num_free, len(self._waiters)))]
+        for wake in wakes:
+            wake()
+
+    def _discard(self, wake: Callable[[], None]) -> bool:
+        with self._lock:
+            try:
+                self._waiters.remove(wake)
+            except ValueError:
+                return False
+            return True
+
+    def acquire(self) -> None:
+        """Wait for a slot."""
+        while True:
+            event = threading.Event()
+            if self._acquire_or_wait(event.set):
+                return
+            event.wait()
+
+    async def aacquire(self) -> None:
+        """Async counterpart of `acquire`."""
+        loop = asyncio.get_running_loop()
+        while True:
+            future: asyncio.Future[None] = loop.create_future()
+
+            def _wake(future: asyncio.Future[None] = future) -> None:
+                try:
+                    loop.call_soon_threadsafe(_resolve, future)
+                except RuntimeError:
+                    # The event loop of the waiter is closed, its wake-up goes to the next waiter
+                    self._wake()
+
+            if self._acquire_or_wait(_wake):
+                return
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not self._discard(_wake):
+                    # The wake-up was meant for this caller, pass it on
+                    self._wake()
+                raise
+
+    def release(self, outcome: Outcome = 'success') -> None:
+        """Free a slot, increasing the cap after a success and decreasing it after an overload."""
+        with self._lock:
+            self._in_flight -= 1
+            if outcome == 'overload':
+                self._limit = max(float(self.minimum), self._limit * self.decrease)
+            elif outcome == 'success':
+                # About one more slot per window of successful calls
+                self._limit = min(float(self.maximum), self._limit + 1 / self._limit)
+        self._wake()
+
+
+def _api_error(error: BaseException) -> Optional[openai.APIError]:
+    """Return the OpenAI error behind `error`, instructor may wrap it in its own exceptions."""
+    # Already loaded by the call that raised `error`
+    import openai
+
+    seen: List[BaseException] = []
+    current: Optional[BaseException] = error
+    while current is not None and current not in seen:
+        if isinstance(current, openai.APIError):
+            return current
+        seen.append(current)
+        current = current.__cause__ or current.__context__
+    return None
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Return the delay asked by the `Retry-After` or `Retry-After-Ms` header of the response of `error`."""
+    import openai
+
+    api_error = _api_error(error)
+    if not isinstance(api_error, openai.APIStatusError):
+        return None
+    headers = api_error.response.headers
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _error_reason(error: BaseException) -> str:
+    import openai
+
+    api_error = _api_error(error)
+    if isinstance(api_error, openai.APIStatusError):
+        return 'rate_limited' if api_error.status_code == 429 else 'server_error'
+    return 'connection_error'
+
+
+def is_overload(error: BaseException) -> bool:
+    """Return whether `error` is the provider rejecting the call for rate limit or overload (429 or 5xx)."""
+    import openai
+
+    api_error = _api_error(error)
+    return isinstance(api_error, openai.APIStatusError) and (
+        api_error.status_code == 429 or api_error.status_code >= 500
+    )
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Return whether the call failing with `error` may succeed if retried."""
+    import openai
+
+    api_error = _api_error(error)
+    return is_overload(error) or isinstance(api_error, openai.APIConnectionError)
+
+
+def _messages_tokens(messages: List[ChatCompletionMessageParam]) -> int:
+    return sum(estimate_tokens(str(message.get('content', ''))) for message in messages)
+
+
+class ModelLimiter:
+    """Rate limits, retries and adaptive concurrency of the calls to one model."""
+
+    def __init__(self, settings: Optional[LimitSettings] = None, model: str = '') -> None:
+        """Initialize the limiter.
+
+        Parameter
+            settings (LimitSettings): The limits, unlimited rates by default.
+            model (str): The model the calls are sent to, used to label the metrics.
+        """
+        self.model: str = model
+        self.settings: LimitSettings = settings or LimitSettings()
+        self.requests: Optional[TokenBucket] = (
+            TokenBucket(self.settings.requests_per_minute) if self.settings.requests_per_minute else None
+        )
+        self.tokens: Optional[TokenBucket] = (
+            TokenBucket(self.settings.tokens_per_minute) if self.settings.tokens_per_minute else None
+        )
+        self.concurrency = AdaptiveConcurrency(
+            self.settings.initial_concurrency,
+            self.settings.min_concurrency,
+            self.settings.max_concurrency,
+        )
+        self._stats = LimiterStats()
+        self._stats_lock = threading.Lock()
+
+    def stats(self) -> LimiterStats:
+        """Return a snapshot of the counters."""
+        with self._stats_lock:
+            return self._stats.model_copy(
+                update={'concurrency_limit': self.concurrency.limit, 'in_flight': self.concurrency.in_flight},
+            )
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        with self._stats_lock:
+            self._stats.calls += 1
+            self._stats.throttled_seconds += wait
+        return wait
+
+    def _settle(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        if self.tokens is not None and actual_tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def _count_error(self, error: BaseException, reason: str, *, retried: bool) -> None:
+        with self._stats_lock:
+            if is_overload(error):
+                if reason == 'rate_limited':
+                    self._stats.rate_limited += 1
+                else:
+                    self._stats.server_errors += 1
+            if retried:
+                self._stats.retries += 1
+            else:
+                self._stats.failures += 1
+
+    def _retry_delay(self, attempt: int, error: BaseException) -> Optional[float]:
+        """Return how long to wait before retrying after `error`, None when the call should not be retried."""
+        reason = _error_reason(error)
+        retried = is_retryable(error) and attempt < self.settings.max_retries
+        self._count_error(error, reason, retried=retried)
+        if not retried:
+            return None
+        LLM_RETRIES.inc(model=self.model, reason=reason)
+        # Full jitter spreads the retries of the callers rejected together
+        delay = random.uniform(0, min(self.settings.max_delay, self.settings.base_delay * 2**attempt))  # noqa: S311
+        retry_after = retry_after_seconds(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def _estimate(self, messages: List[ChatCompletionMessageParam]) -> int:
+        return _messages_tokens(messages) + self.settings.expected_completion_tokens
+
+    def call(
+        self,
+        fn: Callable[[], T],
+        messages: List[ChatCompletionMessageParam],
+        tokens_used: Callable[[T], Optional[int]],
+    ) -> T:
+        """Call `fn` within the limits, retrying it on rate limit, server and connection errors.
+
+        Parameter
+            fn (Callable): The call to make.
+            messages (List[ChatCompletionMessageParam]): The messages sent, to estimate the tokens of the call.
+            tokens_used (Callable): Return the actual number of tokens of a response, None when unknown.
+        """
+        estimated_tokens = self._estimate(messages)
+        attempt = 0
+        while True:
+            time.sleep(self._reserve(estimated_tokens))
+            self.concurrency.acquire()
+            outcome: Outcome = 'success'
+            try:
+                response = fn()
+            except Exception as e:
+                outcome = 'overload' if is_overload(e) else 'error'
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+            else:
+                self._settle(estimated_tokens, tokens_used(response))
+                return response
+            finally:
+                self.concurrency.release(outcome)
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        messages: List[ChatCompletionMessageParam],
+        tokens_used: Callable[[T], Optional[int]],
+    ) -> T:
+        """Async counterpart of `call`."""
+        estimated_tokens = self._estimate(messages)
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve(estimated_tokens))
+            await self.concurrency.aacquire()
+            outcome: Outcome = 'success'
+            try:
+                response = await fn()
+            except Exception as e:
+                outcome = 'overload' if is_overload(e) else 'error'
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+            else:
+                self._settle(estimated_tokens, tokens_used(response))
+                return response
+            finally:
+                self.concurrency.release(outcome)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @asynccontextmanager
+    async def aslot(self, messages: List[ChatCompletionMessageParam]) -> AsyncIterator[Callable[[Optional[int]], None]]:
+        """Hold a slot for a call read as it streams, until the block exits.
+
+        The call is not retried since part of its response may already be used. The block is given a function to call
+        with the actual number of tokens of the response once it is known.
+
+        Parameter
+            messages (List[ChatCompletionMessageParam]): The messages sent, to estimate the tokens of the call.
+        """
+        estimated_tokens = self._estimate(messages)
+        await asyncio.sleep(self._reserve(estimated_tokens))
+        await self.concurrency.aacquire()
+        outcome: Outcome = 'error'
+        try:
+            yield partial(self._settle, estimated_tokens)
+            outcome = 'success'
+        except Exception as e:
+            if is_overload(e):
+                outcome = 'overload'
+            self._count_error(e, _error_reason(e), retried=False)
+            raise
+        finally:
+            self.concurrency.release(outcome)
+
+
+class RateLimiter:
+    """The limiters of every model, created on first use with the settings of the model or the default ones."""
+
+    def __init__(
+        self,
+        default_settings: Optional[LimitSettings] = None,
+        model_settings: Optional[Dict[str, LimitSettings]] = None,
+    ) -> None:
+        """Initialize the limiters.
+
+        Parameter
+            default_settings (LimitSettings): The limits of the models without their own settings.
+            model_settings (Dict[str, LimitSettings]): The limits of specific models.
+        """
+        self.default_settings: LimitSettings = default_settings or LimitSettings()
+        self.model_settings: Dict[str, LimitSettings] = dict(model_settings or {})
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def for_model(self, model: str) -> ModelLimiter:
+        """Return the limiter of `model`."""
+        with self._lock:
+            limiter = self._limiters.get(model)
+            if limiter is None:
+                limiter = ModelLimiter(self.model_settings.get(model, self.default_settings), model)
+                self._limiters[model] = limiter
+            return limiter
+
+    def stats(self) -> Dict[str, LimiterStats]:
+        """Return the counters of every model."""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {model: limiter.stats() for model, limiter in limiters.items()}
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def limiter_from_env() -> Optional[RateLimiter]:
+    """Build the limiter described by the `LLM_GRAPHS_LIMITS`, `LLM_GRAPHS_RPM`, `LLM_GRAPHS_TPM` environment variables.
+
+    `LLM_GRAPHS_LIMITS=1` enables the limiter, as does setting `LLM_GRAPHS_RPM` or `LLM_GRAPHS_TPM`, the requests and
+    tokens per minute of every model. `LLM_GRAPHS_MAX_RETRIES` sets the number of retries.
+    """
+    requests_per_minute = _env_float('LLM_GRAPHS_RPM')
+    tokens_per_minute = _env_float('LLM_GRAPHS_TPM')
+    enabled = os.environ.get('LLM_GRAPHS_LIMITS', '').lower() in ('1', 'true')
+    if not enabled and requests_per_minute is None and tokens_per_minute is None:
+        return None
+    settings = LimitSettings(
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        max_retries=int(os.environ.get('LLM_GRAPHS_MAX_RETRIES', LimitSettings().max_retries)),
+    )
+    return RateLimiter(settings)
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_loaded = False
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> Optional[RateLimiter]:
+    """Return the process-wide limiter, or None when limiting is disabled."""
+    global _limiter, _limiter_loaded
+    with _limiter_lock:
+        if not _limiter_loaded:
+            _limiter = limiter_from_env()
+            _limiter_loaded = True
+        return _limiter
+
+
+def set_limiter(limiter: Optional[RateLimiter]) -> Optional[RateLimiter]:
+    """Replace the process-wide limiter, None disables limiting. Return the previous limiter."""
+    previous = get_limiter()
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
+    return previous
+
+
+def _concurrency_gauges() -> Dict[Tuple[str, ...], float]:
+    limiter = _limiter
+    if limiter is None:
+        return {}
+    return {(model,): stats.concurrency_limit for model, stats in limiter.stats().items()}
+
+
+register_callback_gauge(
+    'llm_graphs_concurrency_limit',
+    'Adaptive concurrency cap of the LLM calls, by model.',
+    _concurrency_gauges,
+    ('model',),
+)
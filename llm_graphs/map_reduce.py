@@ -0,0 +1,331 @@
+"""Build the graph of a book from its full text: a partial graph per chunk of the text, merged into one graph.
+
+The text is read and cut into overlapping chunks lazily, the chunk graphs are generated concurrently and folded into
+a `GraphMerger` as soon as each one is done. The merger deduplicates the nodes by normalized name, remaps the ids,
+merges the links and counts how often each node and link was seen, which ranks them when the merged graph is pruned
+down to the target size. Only the chunks being processed and the merged graph are in memory, whatever the size of
+the text.
+
+    python -m llm_graphs.map_reduce book.txt --book-name "Moby Dick" --max-nodes 20
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import re
+import time
+import unicodedata
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.defaults import (
+    DEFAULT_MEANING_STR,
+    GPT_4O,
+    default_goal_str,
+)
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+from llm_graphs.pipeline import BookGraphResult
+from llm_graphs.step import (
+    DEFAULT_MAX_CONCURRENCY,
+    agenerate_chunk_graph,
+)
+from llm_graphs.usage import track_usage
+from llm_graphs.validation import repair_graph
+
+if TYPE_CHECKING:
+    from instructor import AsyncInstructor
+
+READ_BLOCK_CHARS = 64 * 1024
+_ARTICLES = re.compile(r'^(the|a|an)\s+')
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+class MapReduceSettings(BaseModel):
+    """How the graph of a text is built.
+
+    The text is cut into chunks of about `chunk_chars` characters, consecutive chunks sharing `overlap_chars`
+    characters so that the relations across a cut are seen. Each chunk graph has at most `chunk_max_nodes` nodes and
+    the merged graph is pruned down to `max_nodes` nodes and `max_links` links. While merging, the least seen nodes
+    are dropped whenever there are more than `max_pending_nodes` of them, which bounds the memory used.
+    """
+
+    chunk_chars: int = 12_000
+    overlap_chars: int = 400
+    chunk_max_nodes: int = 15
+    max_nodes: int = 20
+    max_links: int = 40
+    max_pending_nodes: int = 1000
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    model_for_generation: str = GPT_4O
+    use_cache: bool = True
+
+
+def read_blocks(path: str | Path, block_chars: int = READ_BLOCK_CHARS) -> Iterator[str]:
+    """Yield the text of a file by blocks of `block_chars` characters."""
+    with Path(path).open(encoding='utf-8', errors='replace') as file:
+        while block := file.read(block_chars):
+            yield block
+
+
+def _cut(text: str, limit: int) -> int:
+    """Return where to cut `text` before `limit`: the last paragraph, sentence or word break of its second half."""
+    for separator in ('\n\n', '. ', '\n', ' '):
+        position = text.rfind(separator, limit // 2, limit)
+        if position != -1:
+            return position + len(separator)
+    return limit
+
+
+def chunk_text(blocks: Iterable[str], chunk_chars: int = 12_000, overlap_chars: int = 400) -> Iterator[str]:
+    """Cut a text given by blocks into chunks of at most `chunk_chars` characters, at paragraph, sentence or word
+    breaks when possible, each chunk starting with the last `overlap_chars` characters of the previous one.
+
+    Parameter
+        blocks (Iterable[str]): The text, in blocks of any size, read lazily.
+        chunk_chars (int): The maximum size of a chunk.
+        overlap_chars (int): The size of the text shared by consecutive chunks, less than half `chunk_chars`.
+    """
+    if not 0 <= overlap_chars < chunk_chars // 2:
+        raise ValueError(f'overlap_chars should be between 0 and half chunk_chars, got {overlap_chars}')
+    buffer = ''
+    # The size of the start of the buffer already sent in the previous chunk
+    seen = 0
+    for block in blocks:
+        buffer += block
+        while len(buffer) > chunk_chars:
+            end = _cut(buffer, chunk_chars)
+            yield buffer[:end]
+            start = max(end - overlap_chars, 0)
+            # The overlap starts on a word
+            space = buffer.find(' ', start, end)
+            start = space + 1 if space != -1 else start
+            buffer = buffer[start:]
+            seen = end - start
+    if len(buffer) > seen and buffer[seen:].strip():
+        yield buffer
+
+
+def normalize_name(name: str) -> str:
+    """Return the key deduplicating the nodes: the name without accents, case, punctuation or leading article."""
+    ascii_name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+    words = _NON_WORD.sub(' ', ascii_name.casefold()).strip()
+    return _ARTICLES.sub('', words) or words
+
+
+class GraphMerger:
+    """Merge partial graphs into one, deduplicating the nodes by normalized name."""
+
+    def __init__(self, max_pending_nodes: int = 1000) -> None:
+        """Initialize a new instance of the `GraphMerger` class.
+
+        Parameter
+            max_pending_nodes (int): The number of nodes above which the least seen ones are dropped.
+        """
+        self.max_pending_nodes: int = max_pending_nodes
+        self.num_graphs: int = 0
+        self._node_ids: Dict[str, int] = {}
+        self._nodes: Dict[int, Node] = {}
+        self._mentions: Dict[int, int] = {}
+        self._links: Dict[Tuple[int, int], Link] = {}
+        self._link_weights: Dict[Tuple[int, int], int] = {}
+        self._next_id = 0
+
+    def add(self, knowledge_graph: KnowledgeGraph) -> None:
+        """Merge the nodes and links of a graph, its dangling links and self-loops being dropped."""
+        self.num_graphs += 1
+        # The node ids of the graph, remapped to the merged ids
+        remap: Dict[int, int] = {}
+        for node in knowledge_graph.nodes:
+            key = normalize_name(node.name)
+            if not key:
+                continue
+            node_id = self._node_ids.get(key)
+            if node_id is None:
+                node_id = self._next_id
+                self._next_id += 1
+                self._node_ids[key] = node_id
+                self._nodes[node_id] = node.model_copy(update={'node_id': node_id})
+                self._mentions[node_id] = 0
+            elif len(node.description) > len(self._nodes[node_id].description):
+                # The most detailed description is kept
+                self._nodes[node_id] = self._nodes[node_id].model_copy(update={'description': node.description})
+            if node.node_id not in remap:
+                remap[node.node_id] = node_id
+                self._mentions[node_id] += 1
+
+        for link in knowledge_graph.links:
+            pair = (remap.get(link.node_id_from, -1), remap.get(link.node_id_to, -1))
+            if -1 in pair or pair[0] == pair[1]:
+                continue
+            if pair not in self._links:
+                self._links[pair] = link.model_copy(update={'node_id_from': pair[0], 'node_id_to': pair[1]})
+                self._link_weights[pair] = 0
+            self._link_weights[pair] += 1
+
+        if len(self._nodes) > self.max_pending_nodes:
+            self._keep(self.max_pending_nodes // 2)
+
+    def _score(self, node_id: int, degrees: Dict[int, int]) -> Tuple[int, int, int]:
+        # Seen in more chunks first, then more linked, then seen first
+        return self._mentions[node_id], degrees.get(node_id, 0), -node_id
+
+    def _degrees(self) -> Dict[int, int]:
+        degrees: Dict[int, int] = {}
+        for source, target in self._links:
+            degrees[source] = degrees.get(source, 0) + 1
+            degrees[target] = degrees.get(target, 0) + 1
+        return degrees
+
+    def _keep(self, max_nodes: int) -> None:
+        """Drop all but the `max_nodes` best scored nodes and their links."""
+        degrees = self._degrees()
+        kept = set(sorted(self._nodes, key=lambda node_id: self._score(node_id, degrees), reverse=True)[:max_nodes])
+        self._node_ids = {key: node_id for key, node_id in self._node_ids.items() if node_id in kept}
+        self._nodes = {node_id: node for node_id, node in self._nodes.items() if node_id in kept}
+        self._mentions = {node_id: mentions for node_id, mentions in self._mentions.items() if node_id in kept}
+        self._links = {pair: link for pair, link in self._links.items() if pair[0] in kept and pair[1] in kept}
+        self._link_weights = {pair: self._link_weights[pair] for pair in self._links}
+
+    def graph(self, name: str, reasoning: str, max_nodes: int, max_links: int) -> KnowledgeGraph:
+        """Return the merged graph pruned to the `max_nodes` most seen nodes and `max_links` most seen links.
+
+        The graph is repaired, so the loops between two nodes and the nodes left isolated by the pruning are dropped
+        and only the largest connected component is kept.
+        """
+        degrees = self._degrees()
+        nodes = sorted(self._nodes, key=lambda node_id: self._score(node_id, degrees), reverse=True)[:max_nodes]
+        kept = set(nodes)
+        pairs = [pair for pair in self._links if pair[0] in kept and pair[1] in kept]
+        # Sorted by weight, the repair keeps the most seen direction of a loop between two nodes
+        pairs = sorted(pairs, key=lambda pair: self._link_weights[pair], reverse=True)[:max_links]
+        knowledge_graph = KnowledgeGraph(
+            nodes=[self._nodes[node_id] for node_id in sorted(kept)],
+            links=[self._links[pair].model_copy(update={'link_id': i}) for i, pair in enumerate(pairs)],
+            name=name,
+            reasoning=reasoning,
+        )
+        return repair_graph(knowledge_graph)
+
+
+async def abuild_graph_from_text(
+    book_name: str,
+    chunks: Iterable[str],
+    settings: Optional[MapReduceSettings] = None,
+    client: Optional[AsyncInstructor] = None,
+) -> BookGraphResult:
+    """Build the graph of a book from the chunks of its text, see `chunk_text`.
+
+    The chunks are consumed lazily by `settings.max_concurrency` workers. A failed chunk is reported in the errors
+    of the result and the graph is merged from the others, the result failing only when every chunk failed.
+    """
+    settings = settings or MapReduceSettings()
+    if settings.max_concurrency < 1:
+        raise ValueError('max_concurrency should be at least 1')
+    goal_str = default_goal_str(book_name)
+    merger = GraphMerger(settings.max_pending_nodes)
+    errors: List[str] = []
+    indexed_chunks = enumerate(chunks)
+    start = time.monotonic()
+
+    async def _worker() -> None:
+        # The workers share the iterator, each chunk is taken by exactly one of them
+        for index, chunk in indexed_chunks:
+            try:
+                chunk_graph = await agenerate_chunk_graph(
+                    model=settings.model_for_generation,
+                    goal_str=goal_str,
+                    meaning_str=DEFAULT_MEANING_STR,
+                    chunk=chunk,
+                    chunk_index=index,
+                    max_nodes=settings.chunk_max_nodes,
+                    client=client,
+                    use_cache=settings.use_cache,
+                )
+            except Exception as e:
+                errors.append(f'Chunk {index}: {e}')
+            else:
+                merger.add(chunk_graph)
+
+    with track_usage() as usage:
+        await asyncio.gather(*(_worker() for _ in range(settings.max_concurrency)))
+
+    num_chunks = merger.num_graphs + len(errors)
+    if not merger.num_graphs:
+        return BookGraphResult(
+            index=0,
+            book_name=book_name,
+            success=False,
+            errors=errors or ['The text is empty'],
+            usage=usage,
+            elapsed_seconds=time.monotonic() - start,
+        )
+    graph = merger.graph(
+        name=book_name,
+        reasoning=f'Merged from the graphs of {merger.num_graphs} of the {num_chunks} excerpts of the book.',
+        max_nodes=settings.max_nodes,
+        max_links=settings.max_links,
+    )
+    return BookGraphResult(
+        index=0,
+        book_name=book_name,
+        success=True,
+        graph=graph,
+        errors=errors,
+        usage=usage,
+        elapsed_seconds=time.monotonic() - start,
+    )
+
+
+async def abuild_graph_from_file(
+    book_name: str,
+    path: str | Path,
+    settings: Optional[MapReduceSettings] = None,
+    client: Optional[AsyncInstructor] = None,
+) -> BookGraphResult:
+    """Build the graph of a book from its text file, read by blocks."""
+    settings = settings or MapReduceSettings()
+    chunks = chunk_text(read_blocks(path), settings.chunk_chars, settings.overlap_chars)
+    return await abuild_graph_from_text(book_name, chunks, settings, client)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Print the result of the graph of a text file as JSON."""
+    defaults = MapReduceSettings()
+    parser = argparse.ArgumentParser(prog='python -m llm_graphs.map_reduce', description=__doc__.splitlines()[0])
+    parser.add_argument('path', type=Path, help='The text of the book.')
+    parser.add_argument('--book-name', type=str, help='The name of the book, the file name by default.')
+    parser.add_argument('--chunk-chars', type=int, default=defaults.chunk_chars)
+    parser.add_argument('--overlap-chars', type=int, default=defaults.overlap_chars)
+    parser.add_argument('--max-nodes', type=int, default=defaults.max_nodes)
+    parser.add_argument('--max-links', type=int, default=defaults.max_links)
+    parser.add_argument('--max-concurrency', type=int, default=defaults.max_concurrency)
+    parser.add_argument('--model', type=str, default=defaults.model_for_generation)
+    args = parser.parse_args(argv)
+    settings = MapReduceSettings(
+        chunk_chars=args.chunk_chars,
+        overlap_chars=args.overlap_chars,
+        max_nodes=args.max_nodes,
+        max_links=args.max_links,
+        max_concurrency=args.max_concurrency,
+        model_for_generation=args.model,
+    )
+    result = asyncio.run(abuild_graph_from_file(args.book_name or args.path.stem, args.path, settings))
+    print(result.model_dump_json(indent=2))  # noqa: T201
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+"""Metrics of the LLM calls, exposed in the Prometheus text format and optionally as OpenTelemetry spans.
+
+The metrics are kept in process, in the `REGISTRY` of this module, and rendered by `render_metrics` (served at
+`/metrics` by the API). `LLM_GRAPHS_METRICS=none` disables them, the instrumented functions then only pay for a
+boolean check. `LLM_GRAPHS_OTEL=1` also wraps each step in an OpenTelemetry span when `opentelemetry-api` is
+installed, the exporter being configured by the application as usual.
+"""
+from __future__ import annotations
+
+import asyncio
+import inspect
+import math
+import os
+import threading
+import time
+from contextlib import (
+    aclosing,
+    contextmanager,
+)
+from functools import wraps
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+    cast,
+)
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """Base of the metrics: a name, a help text and the values of each combination of labels."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        """Initialize a metric without any value."""
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """Return the (suffixed name, formatted labels, value) of every sample."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Return the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonic counter."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        """Initialize a counter without any value."""
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add `amount` to the counter of `labels`."""
+        if not _enabled:
+            return
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Return the counter of `labels`."""
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """Return the value of every combination of labels."""
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """Value that goes up and down."""
+
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Subtract `amount` from the gauge of `labels`."""
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the gauge of `labels`."""
+        if not _enabled:
+            return
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Cumulative histogram with fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ) -> None:
+        """Initialize a histogram without any observation."""
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = (*sorted(buckets), math.inf)
+        # Per combination of labels: the count of each bucket (not cumulative), the sum and the count
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Add an observation to the histogram of `labels`."""
+        if not _enabled:
+            return
+        key = self._label_values(labels)
+        bucket_ix = next(ix for ix, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            counts[bucket_ix] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: str) -> int:
+        """Return the number of observations of `labels`."""
+        with self._lock:
+            values = self._values.get(self._label_values(labels))
+        return values[2] if values is not None else 0
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """Return the cumulative buckets, the sum and the count of every combination of labels."""
+        with self._lock:
+            values = {key: (counts[:], total, count) for key, (counts, total, count) in self._values.items()}
+        samples: List[Tuple[str, str, float]] = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels((*self.labelnames, 'le'), (*key, _format_value(bound)))
+                samples.append((f'{self.name}_bucket', labels, cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples += [(f'{self.name}_sum', labels, total), (f'{self.name}_count', labels, count)]
+        return samples
+
+
+class CallbackGauge(Metric):
+    """Gauge read from a callback at render time, for values already tracked elsewhere such as the cache size."""
+
+    kind = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Dict[LabelValues, float]],
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        """Initialize a gauge reading its values from `callback`."""
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """Return the values returned by the callback."""
+        return [
+            (self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(self.callback().items())
+        ]
+
+
+class MetricsRegistry:
+    """The metrics rendered together."""
+
+    def __init__(self) -> None:
+        """Initialize an empty registry."""
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add `metric`, replacing a metric of the same name."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STEP_DURATION = cast(
+    Histogram,
+    REGISTRY.register(
+        Histogram(
+            'llm_graphs_step_duration_seconds',
+            'Duration of the step functions, cache hits included.',
+            ('step', 'model', 'outcome'),
+        ),
+    ),
+)
+LLM_TOKENS = cast(
+    Counter,
+    REGISTRY.register(Counter('llm_graphs_llm_tokens_total', 'Tokens spent by the LLM calls.', ('model', 'kind'))),
+)
+LLM_CALLS = cast(
+    Counter,
+    REGISTRY.register(
+        Counter('llm_graphs_llm_calls_total', 'LLM calls that missed the response cache.', ('model', 'outcome')),
+    ),
+)
+LLM_IN_FLIGHT = cast(
+    Gauge,
+    REGISTRY.register(Gauge('llm_graphs_llm_in_flight', 'LLM calls waiting for their response.', ('model',))),
+)
+LLM_RETRIES = cast(
+    Counter,
+    REGISTRY.register(
+        Counter('llm_graphs_llm_retries_total', 'LLM calls retried by the rate limiter.', ('model', 'reason')),
+    ),
+)
+PARSE_ERRORS = cast(
+    Counter,
+    REGISTRY.register(
+        Counter(
+            'llm_graphs_parse_errors_total',
+            'Responses failing the validation of their response model, each one retried by instructor.',
+            ('model_family',),
+        ),
+    ),
+)
+GRAPH_VALIDATIONS = cast(
+    Counter,
+    REGISTRY.register(
+        Counter(
+            'llm_graphs_graph_validations_total',
+            'Generated graphs checked against the graph constraints, by outcome.',
+            ('outcome',),
+        ),
+    ),
+)
+GRAPH_PATCHES = cast(
+    Counter,
+    REGISTRY.register(
+        Counter(
+            'llm_graphs_graph_patches_total',
+            'Graphs improved through a patch, by outcome: applied, or fallback to a full regeneration.',
+            ('outcome',),
+        ),
+    ),
+)
+LLM_HEDGES = cast(
+    Counter,
+    REGISTRY.register(
+        Counter(
+            'llm_graphs_llm_hedges_total',
+            'Hedged LLM calls by outcome: won by the hedge, won by the first call, or not sent for the rate cap.',
+            ('model', 'outcome'),
+        ),
+    ),
+)
+RATING_TIER_DURATION = cast(
+    Histogram,
+    REGISTRY.register(
+        Histogram(
+            'llm_graphs_rating_tier_duration_seconds',
+            'Duration of the rating calls of each tier of the rating cascade.',
+            ('tier',),
+        ),
+    ),
+)
+RATING_ESCALATIONS = cast(
+    Counter,
+    REGISTRY.register(
+        Counter(
+            'llm_graphs_rating_escalations_total',
+            'Cheap ratings escalated to the expensive model of the rating cascade, by reason.',
+            ('reason',),
+        ),
+    ),
+)
+
+_enabled = os.environ.get('LLM_GRAPHS_METRICS', '').lower() != 'none'
+
+
+def _otel_tracer() -> Any:  # noqa: ANN401
+    if os.environ.get('LLM_GRAPHS_OTEL', '').lower() not in ('1', 'true'):
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer('llm_graphs')
+
+
+_tracer = _otel_tracer()
+
+
+def metrics_enabled() -> bool:
+    """Return whether the metrics are recorded."""
+    return _enabled
+
+
+# The flag is positional like the value taken by the other setters, e.g. `set_cache`
+def set_metrics_enabled(enabled: bool) -> bool:  # noqa: FBT001
+    """Enable or disable the metrics, return the previous setting."""
+    global _enabled
+    previous, _enabled = _enabled, enabled
+    return previous
+
+
+def record_tokens(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    """Count the tokens of an LLM call."""
+    if not _enabled:
+        return
+    LLM_TOKENS.inc(prompt_tokens, model=model, kind='prompt')
+    LLM_TOKENS.inc(completion_tokens, model=model, kind='completion')
+
+
+@contextmanager
+def track_llm_call(model: str) -> Iterator[None]:
+    """Count an LLM call and keep it in the in-flight gauge while it runs."""
+    if not _enabled:
+        yield
+        return
+    LLM_IN_FLIGHT.inc(model=model)
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'success'
+    except asyncio.CancelledError:
+        # The losing call of a hedged pair
+        outcome = 'cancelled'
+        raise
+    finally:
+        LLM_IN_FLIGHT.dec(model=model)
+        LLM_CALLS.inc(model=model, outcome=outcome)
+
+
+@contextmanager
+def _observe_step(step: str, model: str) -> Iterator[None]:
+    start = time.perf_counter()
+    outcome = 'error'
+    span = _tracer.start_as_current_span(f'llm_graphs.{step}') if _tracer is not None else None
+    try:
+        if span is not None:
+            with span as current:
+                current.set_attribute('llm_graphs.model', model)
+                yield
+        else:
+            yield
+        outcome = 'success'
+    finally:
+        STEP_DURATION.observe(time.perf_counter() - start, step=step, model=model, outcome=outcome)
+
+
+def _model_argument(args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> str:
+    return str(kwargs['model'] if 'model' in kwargs else args[0] if args else '')
+
+
+def _instrument_async_generator(step: str, fn: F) -> F:
+    @wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> AsyncIterator[Any]:  # noqa: ANN401
+        async with aclosing(fn(*args, **kwargs)) as items:
+            if not _enabled and _tracer is None:
+                async for item in items:
+                    yield item
+                return
+            with _observe_step(step, _model_argument(args, kwargs)):
+                async for item in items:
+                    yield item
+
+    return cast(F, wrapper)
+
+
+def instrument_step(step: str) -> Callable[[F], F]:
+    """Decorate a step function, sync, async or streaming and taking the model as first argument, to time it.
+
+    A streaming step is timed until its stream is exhausted or closed.
+    """
+
+    def decorator(fn: F) -> F:
+        if inspect.isasyncgenfunction(fn):
+            return _instrument_async_generator(step, fn)
+        if inspect.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+                if not _enabled and _tracer is None:
+                    return await fn(*args, **kwargs)
+                with _observe_step(step, _model_argument(args, kwargs)):
+                    return await fn(*args, **kwargs)
+
+            return cast(F, async_wrapper)
+
+        @wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+            if not _enabled and _tracer is None:
+                return fn(*args, **kwargs)
+            with _observe_step(step, _model_argument(args, kwargs)):
+                return fn(*args, **kwargs)
+
+        return cast(F, wrapper)
+
+    return decorator
+
+
+def register_callback_gauge(
+    name: str,
+    documentation: str,
+    callback: Callable[[], Dict[LabelValues, float]],
+    labelnames: Sequence[str] = (),
+) -> None:
+    """Add a gauge read from `callback` when the metrics are rendered."""
+    REGISTRY.register(CallbackGauge(name, documentation, callback, labelnames))
+
+
+def render_metrics() -> str:
+    """Return every metric in the Prometheus text format."""
+    return REGISTRY.render()
@@ -1,7 +1,11 @@
 """Models for the knowledge graph."""
 from __future__ import annotations
 
-from typing import List
+from typing import (
+    List,
+    Literal,
+    Optional,
+)
 
 from pydantic import BaseModel
 
@@ -33,6 +37,33 @@ class KnowledgeGraph(BaseModel):
     reasoning: str
 
 
+class GraphEdit(BaseModel):
+    """One edit of a graph, the fields used depending on the operation.
+
+    - add_node: node_id, name and description of the new node
+    - remove_node: node_id, the links of the node are removed with it
+    - rename_node: node_id, and the new name and/or description
+    - add_link: link_id, node_id_from, node_id_to, name and description of the new link
+    - remove_link: link_id
+    - relabel_link: link_id, and the new name and/or description
+    """
+
+    operation: Literal['add_node', 'remove_node', 'rename_node', 'add_link', 'remove_link', 'relabel_link']
+    node_id: Optional[int] = None
+    link_id: Optional[int] = None
+    node_id_from: Optional[int] = None
+    node_id_to: Optional[int] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
+
+
+class GraphPatch(BaseModel):
+    """Edits turning a graph into its improved version, applied in order."""
+
+    edits: List[GraphEdit]
+    reasoning: str
+
+
 class Feedback(BaseModel):
     rating: int
     opinion: str
@@ -40,3 +71,10 @@ class Feedback(BaseModel):
     def display(self) -> str:
         """Display the feedback."""
         return f'Rating: {self.rating}/10 Opinion: {self.opinion}'
+
+
+class RatingBatch(BaseModel):
+    """Ratings collected concurrently for one graph, along with the errors of the ratings that failed."""
+
+    feedbacks: List[Feedback]
+    errors: List[str]
@@ -0,0 +1,127 @@
+"""Improvement of a graph through a patch: the model answers the edits to make instead of the whole new graph.
+
+A patch is a few edits long when the feedbacks only ask for small changes, so far fewer output tokens are generated
+than when the whole graph is written again. The edits are applied locally by `apply_patch`, which checks that every
+edit refers to ids that exist, or do not exist yet for the additions, and raises `PatchError` otherwise so that the
+caller can fall back to a full regeneration.
+"""
+from __future__ import annotations
+
+from typing import (
+    Dict,
+    Literal,
+    cast,
+)
+
+from llm_graphs.models import (
+    GraphEdit,
+    GraphPatch,
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+# How a graph is improved from its feedbacks: written again in full, or patched
+ImproveMode = Literal['full', 'patch']
+DEFAULT_IMPROVE_MODE: ImproveMode = 'full'
+
+
+class PatchError(ValueError):
+    """A patch that cannot be applied to its graph."""
+
+
+def _require(edit: GraphEdit, *fields: str) -> None:
+    missing = [field for field in fields if getattr(edit, field) is None]
+    if missing:
+        raise PatchError(f'{edit.operation} is missing {", ".join(missing)}')
+
+
+def _id(edit: GraphEdit, field: str) -> int:
+    """Return the id `field` of `edit`, once checked by `_require`."""
+    return cast(int, getattr(edit, field))
+
+
+def _label_update(edit: GraphEdit) -> Dict[str, str]:
+    update = {field: getattr(edit, field) for field in ('name', 'description') if getattr(edit, field) is not None}
+    if not update:
+        raise PatchError(f'{edit.operation} has neither a name nor a description')
+    return update
+
+
+def _add_node(nodes: Dict[int, Node], edit: GraphEdit) -> None:
+    _require(edit, 'node_id', 'name')
+    node_id = _id(edit, 'node_id')
+    if node_id in nodes:
+        raise PatchError(f'add_node: node {node_id} already exists')
+    nodes[node_id] = Node(node_id=node_id, name=edit.name, description=edit.description or '')
+
+
+def _edit_node(nodes: Dict[int, Node], links: Dict[int, Link], edit: GraphEdit) -> Dict[int, Link]:
+    """Remove or rename a node, return the links left."""
+    _require(edit, 'node_id')
+    node_id = _id(edit, 'node_id')
+    if node_id not in nodes:
+        raise PatchError(f'{edit.operation}: node {node_id} does not exist')
+    if edit.operation == 'rename_node':
+        nodes[node_id] = nodes[node_id].model_copy(update=_label_update(edit))
+        return links
+    del nodes[node_id]
+    return {link_id: link for link_id, link in links.items() if node_id not in (link.node_id_from, link.node_id_to)}
+
+
+def _add_link(nodes: Dict[int, Node], links: Dict[int, Link], edit: GraphEdit) -> None:
+    _require(edit, 'link_id', 'node_id_from', 'node_id_to', 'name')
+    link_id, node_id_from, node_id_to = _id(edit, 'link_id'), _id(edit, 'node_id_from'), _id(edit, 'node_id_to')
+    if link_id in links:
+        raise PatchError(f'add_link: link {link_id} already exists')
+    for node_id in (node_id_from, node_id_to):
+        if node_id not in nodes:
+            raise PatchError(f'add_link: node {node_id} does not exist')
+    if node_id_from == node_id_to:
+        raise PatchError(f'add_link: link {link_id} is a loop on node {node_id_from}')
+    links[link_id] = Link(
+        link_id=link_id,
+        name=edit.name,
+        node_id_from=node_id_from,
+        node_id_to=node_id_to,
+        description=edit.description or '',
+    )
+
+
+def _edit_link(links: Dict[int, Link], edit: GraphEdit) -> None:
+    """Remove or relabel a link."""
+    _require(edit, 'link_id')
+    link_id = _id(edit, 'link_id')
+    if link_id not in links:
+        raise PatchError(f'{edit.operation}: link {link_id} does not exist')
+    if edit.operation == 'remove_link':
+        del links[link_id]
+    else:
+        links[link_id] = links[link_id].model_copy(update=_label_update(edit))
+
+
+def apply_patch(knowledge_graph: KnowledgeGraph, patch: GraphPatch) -> KnowledgeGraph:
+    """Return a copy of `knowledge_graph` with the edits of `patch` applied in order.
+
+    Parameter
+        knowledge_graph (KnowledgeGraph): The graph the patch was made for.
+        patch (GraphPatch): The edits, each one checked against the graph as left by the previous ones.
+
+    Raise
+        PatchError: When an edit misses a field, refers to a node or link that does not exist, adds a node or link
+            whose id is taken, or adds a self-loop.
+    """
+    nodes: Dict[int, Node] = {node.node_id: node for node in knowledge_graph.nodes}
+    links: Dict[int, Link] = {link.link_id: link for link in knowledge_graph.links}
+    for edit in patch.edits:
+        if edit.operation == 'add_node':
+            _add_node(nodes, edit)
+        elif edit.operation in ('remove_node', 'rename_node'):
+            links = _edit_node(nodes, links, edit)
+        elif edit.operation == 'add_link':
+            _add_link(nodes, links, edit)
+        else:
+            _edit_link(links, edit)
+    return knowledge_graph.model_copy(
+        update={'nodes': list(nodes.values()), 'links': list(links.values()), 'reasoning': patch.reasoning},
+    )
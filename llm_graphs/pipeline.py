@@ -0,0 +1,217 @@
+"""Generate the graphs of many books: a seed graph per book, then optional rate and improve rounds.
+
+`abuild_book_graphs` runs the books on a fixed pool of workers and yields each result as soon as its book is done, so
+a failing book is reported in its own result instead of failing the whole batch.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Iterable,
+    List,
+    Optional,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.cascade import (
+    CascadeSettings,
+    arate_graph_cascade,
+)
+from llm_graphs.defaults import (
+    DEFAULT_MEANING_STR,
+    GPT_3_5_TURBO,
+    GPT_4O,
+    default_goal_str,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+)
+from llm_graphs.patch import (
+    DEFAULT_IMPROVE_MODE,
+    ImproveMode,
+)
+from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
+)
+from llm_graphs.step import (
+    DEFAULT_MAX_CONCURRENCY,
+    agenerate_seed_graph,
+    anew_graph_from_feedback,
+    arate_graph_many,
+)
+from llm_graphs.usage import (
+    Usage,
+    track_usage,
+)
+from llm_graphs.validation import aensure_valid_graph
+
+if TYPE_CHECKING:
+    from instructor import AsyncInstructor
+
+
+class PipelineSettings(BaseModel):
+    """How the graph of each book is built: a seed graph improved `rounds` times from `num_ratings` ratings."""
+
+    rounds: int = 0
+    num_ratings: int = 1
+    model_for_generation: str = GPT_4O
+    model_for_rating: str = GPT_3_5_TURBO
+    use_cache: bool = True
+    repair: bool = True
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING
+    improve_mode: ImproveMode = DEFAULT_IMPROVE_MODE
+    # Rate through a cascade of a cheap and an expensive model instead of `model_for_rating` when set
+    rating_cascade: Optional[CascadeSettings] = None
+
+
+class BookGraphResult(BaseModel):
+    """The graph of one book, `index` being the position of the book in the input.
+
+    `feedbacks` are the ratings the final graph was improved from, `errors` the failed ratings when `success` is
+    True and the error that stopped the book otherwise.
+    """
+
+    index: int
+    book_name: str
+    success: bool
+    graph: Optional[KnowledgeGraph] = None
+    feedbacks: List[Feedback] = []
+    errors: List[str] = []
+    usage: Usage
+    elapsed_seconds: float
+
+
+async def abuild_book_graph(
+    book_name: str,
+    settings: Optional[PipelineSettings] = None,
+    client: Optional[AsyncInstructor] = None,
+    index: int = 0,
+) -> BookGraphResult:
+    """Build the graph of a book, reporting the failures in the result instead of raising them."""
+    settings = settings or PipelineSettings()
+    goal_str = default_goal_str(book_name)
+    start = time.monotonic()
+    feedbacks: List[Feedback] = []
+    errors: List[str] = []
+    graph: Optional[KnowledgeGraph] = None
+    with track_usage() as usage:
+        try:
+            generate = partial(
+                agenerate_seed_graph,
+                model=settings.model_for_generation,
+                goal_str=goal_str,
+                meaning_str=DEFAULT_MEANING_STR,
+                client=client,
+            )
+            graph = await aensure_valid_graph(
+                await generate(use_cache=settings.use_cache),
+                regenerate=partial(generate, use_cache=False),
+                repair=settings.repair,
+            )
+            for _ in range(settings.rounds):
+                if settings.rating_cascade is not None:
+                    cascade_rating = await arate_graph_cascade(
+                        goal_str=goal_str,
+                        meaning_str=DEFAULT_MEANING_STR,
+                        knowledge_graph=graph,
+                        settings=settings.rating_cascade,
+                        num_ratings=settings.num_ratings,
+                        client=client,
+                        use_cache=settings.use_cache,
+                        graph_encoding=settings.graph_encoding,
+                    )
+                    rating_batch = cascade_rating.rating_batch
+                else:
+                    rating_batch = await arate_graph_many(
+                        model=settings.model_for_rating,
+                        goal_str=goal_str,
+                        meaning_str=DEFAULT_MEANING_STR,
+                        knowledge_graph=graph,
+                        num_ratings=settings.num_ratings,
+                        client=client,
+                        use_cache=settings.use_cache,
+                        graph_encoding=settings.graph_encoding,
+                    )
+                errors += rating_batch.errors
+                if not rating_batch.feedbacks:
+                    raise RuntimeError(f'All the ratings failed: {rating_batch.errors}')
+                feedbacks = rating_batch.feedbacks
+                generate = partial(
+                    anew_graph_from_feedback,
+                    model=settings.model_for_generation,
+                    goal_str=goal_str,
+                    meaning_str=DEFAULT_MEANING_STR,
+                    last_knowledge_graph=graph,
+                    last_feedbacks=feedbacks,
+                    client=client,
+                    graph_encoding=settings.graph_encoding,
+                    improve_mode=settings.improve_mode,
+                )
+                graph = await aensure_valid_graph(
+                    await generate(use_cache=settings.use_cache),
+                    regenerate=partial(generate, use_cache=False),
+                    repair=settings.repair,
+                )
+        except Exception as e:
+            return BookGraphResult(
+                index=index,
+                book_name=book_name,
+                success=False,
+                errors=[str(e)],
+                usage=usage,
+                elapsed_seconds=time.monotonic() - start,
+            )
+    return BookGraphResult(
+        index=index,
+        book_name=book_name,
+        success=True,
+        graph=graph,
+        feedbacks=feedbacks,
+        errors=errors,
+        usage=usage,
+        elapsed_seconds=time.monotonic() - start,
+    )
+
+
+async def abuild_book_graphs(
+    book_names: Iterable[str],
+    settings: Optional[PipelineSettings] = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    client: Optional[AsyncInstructor] = None,
+) -> AsyncIterator[BookGraphResult]:
+    """Build the graphs of many books, `max_concurrency` at a time, yielding the results in completion order.
+
+    The book names are consumed lazily and at most `max_concurrency` finished results wait for the consumer, so the
+    memory used does not grow with the number of books.
+    """
+    if max_concurrency < 1:
+        raise ValueError('max_concurrency should be at least 1')
+    books = enumerate(book_names)
+    results: asyncio.Queue[Optional[BookGraphResult]] = asyncio.Queue(maxsize=max_concurrency)
+
+    async def _worker() -> None:
+        # The workers share the iterator, each book is taken by exactly one of them
+        for index, book_name in books:
+            await results.put(await abuild_book_graph(book_name, settings, client, index))
+        await results.put(None)
+
+    workers = [asyncio.create_task(_worker()) for _ in range(max_concurrency)]
+    try:
+        num_running = len(workers)
+        while num_running:
+            result = await results.get()
+            if result is None:
+                num_running -= 1
+            else:
+                yield result
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
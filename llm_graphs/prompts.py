@@ -1,14 +1,67 @@
 from __future__ import annotations
 
-from typing import List
+import math
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    Literal,
+)
 
-from openai.types.chat import ChatCompletionMessageParam  # noqa: TCH002
+from pydantic import BaseModel
 
 from llm_graphs.models import (
     Feedback,
     KnowledgeGraph,
 )
 
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
+
+# Rough average number of characters per token of the OpenAI tokenizers on English text
+CHARS_PER_TOKEN = 4
+
+
+class GraphEncoding(BaseModel):
+    """How a graph is written in the rate and improve prompts.
+
+    `json` is the pydantic JSON dump of the graph, `compact` writes the nodes and links as tables with one row per
+    node or link, so the key names are written once instead of once per node and link.
+    """
+
+    graph_format: Literal['json', 'compact'] = 'json'
+    include_reasoning: bool = True
+
+
+DEFAULT_GRAPH_ENCODING = GraphEncoding()
+COMPACT_GRAPH_ENCODING = GraphEncoding(graph_format='compact', include_reasoning=False)
+
+
+def _cell(text: str) -> str:
+    return text.replace('\n', ' ').replace('|', '/')
+
+
+def encode_graph(knowledge_graph: KnowledgeGraph, graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING) -> str:
+    """Return the text representing the graph in the prompts."""
+    if graph_encoding.graph_format == 'json':
+        exclude = None if graph_encoding.include_reasoning else {'reasoning'}
+        return knowledge_graph.model_dump_json(exclude=exclude)
+    lines = [f'name: {_cell(knowledge_graph.name)}']
+    if graph_encoding.include_reasoning:
+        lines.append(f'reasoning: {_cell(knowledge_graph.reasoning)}')
+    lines.append('nodes (node_id|name|description):')
+    lines += [f'{node.node_id}|{_cell(node.name)}|{_cell(node.description)}' for node in knowledge_graph.nodes]
+    lines.append('links (link_id|node_id_from|node_id_to|name|description):')
+    lines += [
+        f'{link.link_id}|{link.node_id_from}|{link.node_id_to}|{_cell(link.name)}|{_cell(link.description)}'
+        for link in knowledge_graph.links
+    ]
+    return '\n'.join(lines)
+
+
+def _graph_label(graph_encoding: GraphEncoding) -> str:
+    return 'json' if graph_encoding.graph_format == 'json' else 'table'
+
 
 def system_graph_creator() -> ChatCompletionMessageParam:
     """Return the system message for the graph creator."""
@@ -44,19 +97,54 @@ Take some time and reason step by step before creating the graph object to make
     }
 
 
+def user_generate_chunk_graph(
+    goal_str: str,
+    meaning_str: str,
+    chunk: str,
+    chunk_index: int,
+    max_nodes: int,
+) -> ChatCompletionMessageParam:
+    """Return the user message to build the partial graph of one excerpt of a text."""
+    return {
+        'role': 'user',
+        'content': f'''
+# Goal
+{goal_str}
+The book is too long to be read at once, the graph will be merged from the graphs of its excerpts.
+# Excerpt
+Excerpt {chunk_index + 1} of the book, between the excerpt tags
+<excerpt>
+{chunk}
+</excerpt>
+# Graph meaning
+{meaning_str}
+# Graph structure
+- Each node represents a concept, a character or a place of the excerpt
+- Name the nodes as the book does, without article, so that the graphs of the other excerpts use the same names
+- idFrom and idTo are the ids of the nodes from where the link starts and where the link is directed
+- Only add the links supported by the excerpt, and no link between two node ids that do not exist
+- A node should not have a self-loop and there should not be a loop between two nodes
+- The graph should have at most {max_nodes} nodes, the most important of the excerpt
+- You should describe your thought process in the reasoning field of the graph
+''',
+    }
+
+
 def user_rate_graph(
     goal_str: str,
     meaning_str: str,
     knowledge_graph: KnowledgeGraph,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
 ) -> ChatCompletionMessageParam:
     """Return the message to rate the graph."""
+    label = _graph_label(graph_encoding)
     return {
         'role': 'user',
         'content': f'''
-Graph json
-{knowledge_graph.model_dump_json()}
+Graph {label}
+{encode_graph(knowledge_graph, graph_encoding)}
 
-The json above represents a graph that was generated and is supposed to follow the criteria below
+The {label} above represents a graph that was generated and is supposed to follow the criteria below
 <criteria>
 # Goal
 {goal_str}
@@ -75,15 +163,16 @@ def user_improve_from_feedback(
     meaning_str: str,
     last_knowledge_graph: KnowledgeGraph,
     last_feedback: List[Feedback],
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
 ) -> ChatCompletionMessageParam:
     """Return the message to improve the graph based in its rating."""
-    feedbacks_list = '\n'.join([f'- {f.display()}' for f in last_feedback])
+    feedbacks_list = _feedbacks_list(last_feedback)
     return {
         'role': 'user',
         'content': f'''
 You made the graph below
 ```
-{last_knowledge_graph.model_dump_json()}
+{encode_graph(last_knowledge_graph, graph_encoding)}
 ```
 Following those instructions
 # Goal
@@ -95,3 +184,118 @@ And received the following ratings:
 . Improve the graph
 ''',
     }
+
+
+def user_patch_from_feedback(
+    goal_str: str,
+    meaning_str: str,
+    last_knowledge_graph: KnowledgeGraph,
+    last_feedback: List[Feedback],
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> ChatCompletionMessageParam:
+    """Return the message to improve the graph based on its rating through a list of edits."""
+    feedbacks_list = _feedbacks_list(last_feedback)
+    next_node_id = max((node.node_id for node in last_knowledge_graph.nodes), default=0) + 1
+    next_link_id = max((link.link_id for link in last_knowledge_graph.links), default=0) + 1
+    return {
+        'role': 'user',
+        'content': f'''
+You made the graph below
+```
+{encode_graph(last_knowledge_graph, graph_encoding)}
+```
+Following those instructions
+# Goal
+{goal_str}
+# Graph meaning
+{meaning_str}
+And received the following ratings:
+{feedbacks_list}
+. Improve the graph by listing the edits to make to it, applied in order, instead of writing the whole graph again
+# Edits
+- add_node: node_id, name and description of a new node, the new node ids start at {next_node_id}
+- remove_node: node_id of the node to remove, its links are removed with it
+- rename_node: node_id, and the new name and/or description of the node
+- add_link: link_id, node_id_from, node_id_to, name and description of a new link, the new link ids start at {next_link_id}
+- remove_link: link_id of the link to remove
+- relabel_link: link_id, and the new name and/or description of the link
+Only refer to the ids of the graph above or of the nodes and links you added, and keep the graph connected without loops
+''',
+    }
+
+
+def _feedbacks_list(feedbacks: List[Feedback]) -> str:
+    return '\n'.join([f'- {f.display()}' for f in feedbacks])
+
+
+class SectionSize(BaseModel):
+    """Size of a part of a prompt."""
+
+    chars: int
+    estimated_tokens: int
+
+
+class PromptSizeReport(BaseModel):
+    """Size of a prompt and of each of its sections, `template` being the fixed text around the other sections."""
+
+    sections: Dict[str, SectionSize]
+    total: SectionSize
+
+
+def estimate_tokens(text: str) -> int:
+    """Return a rough estimate of the number of tokens of `text`."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _section_size(text: str) -> SectionSize:
+    return SectionSize(chars=len(text), estimated_tokens=estimate_tokens(text))
+
+
+def prompt_size_report(messages: List[ChatCompletionMessageParam], sections: Dict[str, str]) -> PromptSizeReport:
+    """Return the size of `messages` split between the given `sections` and the template around them."""
+    total_chars = sum(len(str(message.get('content', ''))) for message in messages)
+    report_sections = {name: _section_size(text) for name, text in sections.items()}
+    template_chars = total_chars - sum(section.chars for section in report_sections.values())
+    report_sections['template'] = SectionSize(
+        chars=template_chars,
+        estimated_tokens=math.ceil(template_chars / CHARS_PER_TOKEN),
+    )
+    return PromptSizeReport(
+        sections=report_sections,
+        total=SectionSize(chars=total_chars, estimated_tokens=math.ceil(total_chars / CHARS_PER_TOKEN)),
+    )
+
+
+def rate_prompt_size_report(
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> PromptSizeReport:
+    """Return the size of the messages sent to rate a graph."""
+    return prompt_size_report(
+        [system_graph_creator(), user_rate_graph(goal_str, meaning_str, knowledge_graph, graph_encoding)],
+        {'graph': encode_graph(knowledge_graph, graph_encoding), 'goal': goal_str, 'meaning': meaning_str},
+    )
+
+
+def improve_prompt_size_report(
+    goal_str: str,
+    meaning_str: str,
+    last_knowledge_graph: KnowledgeGraph,
+    last_feedback: List[Feedback],
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> PromptSizeReport:
+    """Return the size of the messages sent to improve a graph from its ratings."""
+    return prompt_size_report(
+        [
+            system_graph_creator(),
+            user_improve_from_feedback(goal_str, meaning_str, last_knowledge_graph, last_feedback, graph_encoding),
+        ],
+        {
+            'graph': encode_graph(last_knowledge_graph, graph_encoding),
+            'goal': goal_str,
+            'meaning': meaning_str,
+            'feedbacks': _feedbacks_list(last_feedback),
+        },
+    )
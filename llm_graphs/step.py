@@ -1,75 +1,648 @@
 from __future__ import annotations
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import (
+    aclosing,
+    nullcontext,
+)
+from contextvars import copy_context
+from functools import partial
 from typing import (
+    TYPE_CHECKING,
+    AsyncContextManager,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
     List,
     Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
 )
 
-import instructor
-from instructor import Instructor
-from openai import OpenAI
+from loguru import logger
+from pydantic import BaseModel
 
+from llm_graphs.cache import (
+    cache_key,
+    get_cache,
+)
+from llm_graphs.clients import (
+    get_async_client,
+    get_client,
+)
+from llm_graphs.hedging import get_hedger
+from llm_graphs.limits import get_limiter
+from llm_graphs.metrics import (
+    GRAPH_PATCHES,
+    instrument_step,
+    record_tokens,
+    track_llm_call,
+)
 from llm_graphs.models import (
     Feedback,
+    GraphPatch,
     KnowledgeGraph,
+    Link,
+    Node,
+    RatingBatch,
+)
+from llm_graphs.patch import (
+    DEFAULT_IMPROVE_MODE,
+    ImproveMode,
+    PatchError,
+    apply_patch,
 )
 from llm_graphs.prompts import (
+    DEFAULT_GRAPH_ENCODING,
+    GraphEncoding,
     system_graph_creator,
+    user_generate_chunk_graph,
     user_generate_graph,
     user_improve_from_feedback,
+    user_patch_from_feedback,
     user_rate_graph,
 )
+from llm_graphs.usage import (
+    record_usage,
+    response_usage,
+)
+from llm_graphs.validation import validate_graph
+
+if TYPE_CHECKING:
+    from instructor import (
+        AsyncInstructor,
+        Instructor,
+    )
+    from openai.types.chat import ChatCompletionMessageParam
+
+DEFAULT_MAX_CONCURRENCY = 4
 
+T = TypeVar('T', bound=BaseModel)
 
-def _get_client(client: Optional[Instructor]) -> Instructor:
+GraphEvent = Union[Node, Link, KnowledgeGraph]
+
+
+def _get_client(client: Optional[Instructor], model: Optional[str] = None) -> Instructor:
+    if client is None:
+        return get_client(model)
+    return client
+
+
+def _get_async_client(client: Optional[AsyncInstructor], model: Optional[str] = None) -> AsyncInstructor:
     if client is None:
-        return instructor.from_openai(OpenAI())
+        return get_async_client(model)
     return client
 
 
+def _tokens_used(response: BaseModel) -> Optional[int]:
+    return response_usage(response).total_tokens or None
+
+
+def _record_response(model: str, response: BaseModel) -> None:
+    usage = response_usage(response)
+    record_usage(usage)
+    record_tokens(model, usage.prompt_tokens, usage.completion_tokens)
+
+
+def _cacheable(response: BaseModel) -> bool:
+    # An invalid graph is regenerated without the cache, caching it would serve it again to the next same request
+    return not isinstance(response, KnowledgeGraph) or validate_graph(response).is_valid
+
+
+def complete(
+    client: Instructor,
+    model: str,
+    response_model: Type[T],
+    messages: List[ChatCompletionMessageParam],
+    *,
+    use_cache: bool = True,
+) -> T:
+    """Return the structured completion of `messages`, served from the response cache when possible.
+
+    The calls that miss the cache go through the rate limiter of `llm_graphs.limits`. Graphs failing `validate_graph`
+    are not cached.
+    """
+    cache = get_cache() if use_cache else None
+    key = cache_key(model, response_model, messages) if cache is not None else ''
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return response_model.model_validate_json(cached)
+    create = partial(client.chat.completions.create, model=model, response_model=response_model, messages=messages)
+    limiter = get_limiter()
+    with track_llm_call(model):
+        response: T = limiter.for_model(model).call(create, messages, _tokens_used) if limiter is not None else create()
+    _record_response(model, response)
+    if cache is not None and _cacheable(response):
+        cache.set(key, response.model_dump_json().encode())
+    return response
+
+
+async def acomplete(
+    client: AsyncInstructor,
+    model: str,
+    response_model: Type[T],
+    messages: List[ChatCompletionMessageParam],
+    *,
+    use_cache: bool = True,
+) -> T:
+    """Async counterpart of `complete`.
+
+    The calls that miss the cache are also hedged by `llm_graphs.hedging` when it is enabled, each of the two calls of
+    a hedged pair going through the rate limiter.
+    """
+    cache = get_cache() if use_cache else None
+    key = cache_key(model, response_model, messages) if cache is not None else ''
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return response_model.model_validate_json(cached)
+    create = partial(client.chat.completions.create, model=model, response_model=response_model, messages=messages)
+    limiter = get_limiter()
+
+    async def call() -> T:
+        with track_llm_call(model):
+            response: T = await (
+                limiter.for_model(model).acall(create, messages, _tokens_used) if limiter is not None else create()
+            )
+        return response
+
+    hedger = get_hedger()
+    response = await (hedger.for_model(model).acall(call) if hedger is not None else call())
+    _record_response(model, response)
+    if cache is not None and _cacheable(response):
+        cache.set(key, response.model_dump_json().encode())
+    return response
+
+
+def _check_fan_out(num_ratings: int, max_concurrency: int) -> None:
+    if num_ratings < 1:
+        raise ValueError(f'num_ratings should be at least 1, got {num_ratings}')
+    if max_concurrency < 1:
+        raise ValueError(f'max_concurrency should be at least 1, got {max_concurrency}')
+
+
+def _seed_graph_messages(goal_str: str, meaning_str: str) -> List[ChatCompletionMessageParam]:
+    return [system_graph_creator(), user_generate_graph(goal_str, meaning_str)]
+
+
+def _chunk_graph_messages(
+    goal_str: str,
+    meaning_str: str,
+    chunk: str,
+    chunk_index: int,
+    max_nodes: int,
+) -> List[ChatCompletionMessageParam]:
+    return [system_graph_creator(), user_generate_chunk_graph(goal_str, meaning_str, chunk, chunk_index, max_nodes)]
+
+
+def _rate_graph_messages(
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    graph_encoding: GraphEncoding,
+) -> List[ChatCompletionMessageParam]:
+    return [system_graph_creator(), user_rate_graph(goal_str, meaning_str, knowledge_graph, graph_encoding)]
+
+
+def _graph_from_feedback_messages(
+    goal_str: str,
+    meaning_str: str,
+    last_knowledge_graph: KnowledgeGraph,
+    last_feedbacks: List[Feedback],
+    graph_encoding: GraphEncoding,
+) -> List[ChatCompletionMessageParam]:
+    return [
+        system_graph_creator(),
+        user_improve_from_feedback(goal_str, meaning_str, last_knowledge_graph, last_feedbacks, graph_encoding),
+    ]
+
+
+def _graph_patch_messages(
+    goal_str: str,
+    meaning_str: str,
+    last_knowledge_graph: KnowledgeGraph,
+    last_feedbacks: List[Feedback],
+    graph_encoding: GraphEncoding,
+) -> List[ChatCompletionMessageParam]:
+    return [
+        system_graph_creator(),
+        user_patch_from_feedback(goal_str, meaning_str, last_knowledge_graph, last_feedbacks, graph_encoding),
+    ]
+
+
+def _patched_graph(last_knowledge_graph: KnowledgeGraph, patch: GraphPatch) -> Optional[KnowledgeGraph]:
+    """Return the patched graph, or None when the patch does not apply and the graph has to be written again."""
+    try:
+        knowledge_graph = apply_patch(last_knowledge_graph, patch)
+    except PatchError as e:
+        logger.warning('Falling back to a full regeneration, the patch does not apply: {}', e)
+        GRAPH_PATCHES.inc(outcome='fallback')
+        return None
+    GRAPH_PATCHES.inc(outcome='applied')
+    return knowledge_graph
+
+
+@instrument_step('generate_seed_graph')
 def generate_seed_graph(
     model: str,
     goal_str: str,
     meaning_str: str,
+    *,
     client: Optional[Instructor] = None,
+    use_cache: bool = True,
 ) -> KnowledgeGraph:
-    _client = _get_client(client)
-    return _client.chat.completions.create(
-        model=model,
-        response_model=KnowledgeGraph,
-        messages=[system_graph_creator(), user_generate_graph(goal_str, meaning_str)],
+    _client = _get_client(client, model)
+    return complete(
+        _client,
+        model,
+        KnowledgeGraph,
+        _seed_graph_messages(goal_str, meaning_str),
+        use_cache=use_cache,
     )
 
 
+@instrument_step('rate_graph')
 def rate_graph(
     model: str,
     goal_str: str,
     meaning_str: str,
     knowledge_graph: KnowledgeGraph,
+    *,
     client: Optional[Instructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
 ) -> Feedback:
-    _client = _get_client(client)
-    return _client.chat.completions.create(
-        model=model,
-        response_model=Feedback,
-        messages=[system_graph_creator(), user_rate_graph(goal_str, meaning_str, knowledge_graph)],
+    _client = _get_client(client, model)
+    return complete(
+        _client,
+        model,
+        Feedback,
+        _rate_graph_messages(goal_str, meaning_str, knowledge_graph, graph_encoding),
+        use_cache=use_cache,
     )
 
 
+@instrument_step('new_graph_from_feedback')
 def new_graph_from_feedback(
     model: str,
     goal_str: str,
     meaning_str: str,
     last_knowledge_graph: KnowledgeGraph,
     last_feedbacks: List[Feedback],
+    *,
+    client: Optional[Instructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+    improve_mode: ImproveMode = DEFAULT_IMPROVE_MODE,
+) -> KnowledgeGraph:
+    _client = _get_client(client, model)
+    if improve_mode == 'patch':
+        patch = complete(
+            _client,
+            model,
+            GraphPatch,
+            _graph_patch_messages(goal_str, meaning_str, last_knowledge_graph, last_feedbacks, graph_encoding),
+            use_cache=use_cache,
+        )
+        knowledge_graph = _patched_graph(last_knowledge_graph, patch)
+        if knowledge_graph is not None:
+            return knowledge_graph
+    return complete(
+        _client,
+        model,
+        KnowledgeGraph,
+        _graph_from_feedback_messages(
+            goal_str,
+            meaning_str,
+            last_knowledge_graph,
+            last_feedbacks,
+            graph_encoding,
+        ),
+        use_cache=use_cache,
+    )
+
+
+def rate_graph_many(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    num_ratings: int = 1,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    *,
     client: Optional[Instructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> RatingBatch:
+    """Rate a graph `num_ratings` times, running at most `max_concurrency` ratings at once.
+
+    A failing rating does not fail the batch: its error is reported next to the ratings that succeeded.
+    """
+    _check_fan_out(num_ratings, max_concurrency)
+    _client = _get_client(client, model)
+    feedbacks: List[Feedback] = []
+    errors: List[str] = []
+    with ThreadPoolExecutor(max_workers=min(num_ratings, max_concurrency)) as executor:
+        futures = [
+            # Only the first rating may come from the cache so that the other ratings stay independent samples
+            # Each rating runs in a copy of the caller context so that its usage is tracked by the caller
+            executor.submit(
+                copy_context().run,
+                partial(
+                    rate_graph,
+                    model,
+                    goal_str,
+                    meaning_str,
+                    knowledge_graph,
+                    client=_client,
+                    use_cache=use_cache and i == 0,
+                    graph_encoding=graph_encoding,
+                ),
+            )
+            for i in range(num_ratings)
+        ]
+        for future in futures:
+            try:
+                feedbacks.append(future.result())
+            except Exception as e:
+                errors.append(str(e))
+    return RatingBatch(feedbacks=feedbacks, errors=errors)
+
+
+@instrument_step('generate_seed_graph')
+async def agenerate_seed_graph(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+) -> KnowledgeGraph:
+    _client = _get_async_client(client, model)
+    return await acomplete(
+        _client,
+        model,
+        KnowledgeGraph,
+        _seed_graph_messages(goal_str, meaning_str),
+        use_cache=use_cache,
+    )
+
+
+@instrument_step('generate_chunk_graph')
+async def agenerate_chunk_graph(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    chunk: str,
+    chunk_index: int,
+    max_nodes: int,
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+) -> KnowledgeGraph:
+    _client = _get_async_client(client, model)
+    return await acomplete(
+        _client,
+        model,
+        KnowledgeGraph,
+        _chunk_graph_messages(goal_str, meaning_str, chunk, chunk_index, max_nodes),
+        use_cache=use_cache,
+    )
+
+
+@instrument_step('rate_graph')
+async def arate_graph(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> Feedback:
+    _client = _get_async_client(client, model)
+    return await acomplete(
+        _client,
+        model,
+        Feedback,
+        _rate_graph_messages(goal_str, meaning_str, knowledge_graph, graph_encoding),
+        use_cache=use_cache,
+    )
+
+
+@instrument_step('new_graph_from_feedback')
+async def anew_graph_from_feedback(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    last_knowledge_graph: KnowledgeGraph,
+    last_feedbacks: List[Feedback],
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+    improve_mode: ImproveMode = DEFAULT_IMPROVE_MODE,
 ) -> KnowledgeGraph:
-    _client = _get_client(client)
-    return _client.chat.completions.create(
-        model=model,
-        response_model=KnowledgeGraph,
-        messages=[
-            system_graph_creator(),
-            user_improve_from_feedback(goal_str, meaning_str, last_knowledge_graph, last_feedbacks),
-        ],
+    _client = _get_async_client(client, model)
+    if improve_mode == 'patch':
+        patch = await acomplete(
+            _client,
+            model,
+            GraphPatch,
+            _graph_patch_messages(goal_str, meaning_str, last_knowledge_graph, last_feedbacks, graph_encoding),
+            use_cache=use_cache,
+        )
+        knowledge_graph = _patched_graph(last_knowledge_graph, patch)
+        if knowledge_graph is not None:
+            return knowledge_graph
+    return await acomplete(
+        _client,
+        model,
+        KnowledgeGraph,
+        _graph_from_feedback_messages(
+            goal_str,
+            meaning_str,
+            last_knowledge_graph,
+            last_feedbacks,
+            graph_encoding,
+        ),
+        use_cache=use_cache,
+    )
+
+
+async def arate_graph_many(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    knowledge_graph: KnowledgeGraph,
+    num_ratings: int = 1,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> RatingBatch:
+    """Async counterpart of `rate_graph_many`."""
+    _check_fan_out(num_ratings, max_concurrency)
+    _client = _get_async_client(client, model)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _rate(i: int) -> Feedback:
+        async with semaphore:
+            # Only the first rating may come from the cache so that the other ratings stay independent samples
+            return await arate_graph(
+                model,
+                goal_str,
+                meaning_str,
+                knowledge_graph,
+                client=_client,
+                use_cache=use_cache and i == 0,
+                graph_encoding=graph_encoding,
+            )
+
+    results = await asyncio.gather(*(_rate(i) for i in range(num_ratings)), return_exceptions=True)
+    feedbacks: List[Feedback] = []
+    errors: List[str] = []
+    for result in results:
+        if isinstance(result, Feedback):
+            feedbacks.append(result)
+        elif isinstance(result, Exception):
+            errors.append(str(result))
+        else:
+            raise result
+    return RatingBatch(feedbacks=feedbacks, errors=errors)
+
+
+def _new_graph_events(
+    partial_graph: KnowledgeGraph,
+    num_nodes_sent: int,
+    num_links_sent: int,
+) -> Tuple[List[GraphEvent], int, int]:
+    """Return the nodes and links of a partial graph completed since `num_nodes_sent` and `num_links_sent` were sent.
+
+    A node (resp. link) is complete as soon as the model starts writing the next one, or the links (resp. the graph
+    name). The numbers of nodes and links sent, including the new ones, are returned along with them.
+    """
+    nodes = partial_graph.nodes or []
+    links = partial_graph.links or []
+    num_complete_nodes = len(nodes) if links or partial_graph.name else len(nodes) - 1
+    num_complete_links = len(links) if partial_graph.name else len(links) - 1
+    events: List[GraphEvent] = [
+        Node.model_validate(node.model_dump()) for node in nodes[num_nodes_sent:num_complete_nodes]
+    ]
+    events += [Link.model_validate(link.model_dump()) for link in links[num_links_sent:num_complete_links]]
+    return events, max(num_nodes_sent, num_complete_nodes), max(num_links_sent, num_complete_links)
+
+
+def _last_graph_events(graph: KnowledgeGraph, num_nodes_sent: int = 0, num_links_sent: int = 0) -> List[GraphEvent]:
+    """Return the nodes and links of `graph` not sent yet, then the graph itself."""
+    return [*graph.nodes[num_nodes_sent:], *graph.links[num_links_sent:], graph]
+
+
+def _ignore_tokens(_: Optional[int]) -> None:
+    pass
+
+
+def _stream_slot(
+    model: str,
+    messages: List[ChatCompletionMessageParam],
+) -> AsyncContextManager[Callable[[Optional[int]], None]]:
+    """Return the slot of the rate limiter held by a stream until it closes, see `ModelLimiter.aslot`."""
+    limiter = get_limiter()
+    return limiter.for_model(model).aslot(messages) if limiter is not None else nullcontext(_ignore_tokens)
+
+
+async def astream_graph(
+    client: AsyncInstructor,
+    model: str,
+    messages: List[ChatCompletionMessageParam],
+    *,
+    use_cache: bool = True,
+) -> AsyncGenerator[GraphEvent, None]:
+    """Stream the nodes and links of a graph as soon as they are parsed, then the complete graph.
+
+    A node (resp. link) is sent once the model starts writing the next one, see `_new_graph_events`. The complete
+    graph is validated and yielded last, and served from the response cache when possible.
+    """
+    cache = get_cache() if use_cache else None
+    key = cache_key(model, KnowledgeGraph, messages) if cache is not None else ''
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        for event in _last_graph_events(KnowledgeGraph.model_validate_json(cached)):
+            yield event
+        return
+
+    num_nodes_sent = 0
+    num_links_sent = 0
+    last_partial = None
+    with track_llm_call(model):
+        async with _stream_slot(model, messages) as settle:
+            async for partial_graph in client.chat.completions.create_partial(
+                model=model,
+                response_model=KnowledgeGraph,
+                messages=messages,
+            ):
+                last_partial = partial_graph
+                events, num_nodes_sent, num_links_sent = _new_graph_events(
+                    partial_graph,
+                    num_nodes_sent,
+                    num_links_sent,
+                )
+                for event in events:
+                    yield event
+            if last_partial is None:
+                raise RuntimeError('The model did not return any graph')
+            settle(_tokens_used(last_partial))
+
+    _record_response(model, last_partial)
+    graph = KnowledgeGraph.model_validate(last_partial.model_dump())
+    if cache is not None and _cacheable(graph):
+        cache.set(key, graph.model_dump_json().encode())
+    for event in _last_graph_events(graph, num_nodes_sent, num_links_sent):
+        yield event
+
+
+@instrument_step('stream_seed_graph')
+async def astream_seed_graph(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+) -> AsyncIterator[GraphEvent]:
+    """Streaming counterpart of `agenerate_seed_graph`, see `astream_graph`."""
+    _client = _get_async_client(client, model)
+    messages = _seed_graph_messages(goal_str, meaning_str)
+    async with aclosing(astream_graph(_client, model, messages, use_cache=use_cache)) as events:
+        async for event in events:
+            yield event
+
+
+@instrument_step('stream_graph_from_feedback')
+async def astream_graph_from_feedback(
+    model: str,
+    goal_str: str,
+    meaning_str: str,
+    last_knowledge_graph: KnowledgeGraph,
+    last_feedbacks: List[Feedback],
+    *,
+    client: Optional[AsyncInstructor] = None,
+    use_cache: bool = True,
+    graph_encoding: GraphEncoding = DEFAULT_GRAPH_ENCODING,
+) -> AsyncIterator[GraphEvent]:
+    """Streaming counterpart of `anew_graph_from_feedback`, see `astream_graph`."""
+    _client = _get_async_client(client, model)
+    messages = _graph_from_feedback_messages(
+        goal_str,
+        meaning_str,
+        last_knowledge_graph,
+        last_feedbacks,
+        graph_encoding,
     )
+    async with aclosing(astream_graph(_client, model, messages, use_cache=use_cache)) as events:
+        async for event in events:
+            yield event
@@ -0,0 +1,68 @@
+"""Token usage accounting for the LLM calls of the step functions.
+
+`track_usage` opens a scope collecting the usage of every call made inside it, including from the asyncio tasks and
+worker threads it starts. Scopes can be nested, a call counts towards every scope it runs in.
+"""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Iterator,
+    Tuple,
+)
+
+from pydantic import BaseModel
+
+
+class Usage(BaseModel):
+    """Number of LLM calls and tokens spent."""
+
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        """Return the number of prompt and completion tokens."""
+        return self.prompt_tokens + self.completion_tokens
+
+    def __add__(self, other: Usage) -> Usage:
+        return Usage(
+            calls=self.calls + other.calls,
+            prompt_tokens=self.prompt_tokens + other.prompt_tokens,
+            completion_tokens=self.completion_tokens + other.completion_tokens,
+        )
+
+
+_trackers: ContextVar[Tuple[Usage, ...]] = ContextVar('usage_trackers', default=())
+
+
+@contextmanager
+def track_usage() -> Iterator[Usage]:
+    """Collect the usage of the LLM calls made in the `with` block."""
+    usage = Usage()
+    token = _trackers.set((*_trackers.get(), usage))
+    try:
+        yield usage
+    finally:
+        _trackers.reset(token)
+
+
+def response_usage(response: Any) -> Usage:  # noqa: ANN401
+    """Return the usage of one call, read from the raw completion instructor attaches to its responses."""
+    usage = getattr(getattr(response, '_raw_response', None), 'usage', None)
+    return Usage(
+        calls=1,
+        prompt_tokens=getattr(usage, 'prompt_tokens', None) or 0,
+        completion_tokens=getattr(usage, 'completion_tokens', None) or 0,
+    )
+
+
+def record_usage(usage: Usage) -> None:
+    """Add `usage` to every open `track_usage` scope."""
+    for tracker in _trackers.get():
+        tracker.calls += usage.calls
+        tracker.prompt_tokens += usage.prompt_tokens
+        tracker.completion_tokens += usage.completion_tokens
@@ -0,0 +1,250 @@
+"""Local structural checks of knowledge graphs.
+
+The graph prompts ask for graphs without dangling links, isolated nodes, disconnected components, self-loops or
+loops between two nodes. Those constraints are checked here in a single pass over the graph instead of asking an
+LLM to rate the graph.
+"""
+from __future__ import annotations
+
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from pydantic import BaseModel
+
+from llm_graphs.compact import CompactGraph
+from llm_graphs.metrics import GRAPH_VALIDATIONS
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+IssueKind = Literal[
+    'duplicate_node_id',
+    'duplicate_link_id',
+    'dangling_link',
+    'self_loop',
+    'two_cycle',
+    'isolated_node',
+    'disconnected',
+]
+
+
+class GraphIssue(BaseModel):
+    """A violation of the graph constraints."""
+
+    kind: IssueKind
+    message: str
+    node_ids: List[int] = []
+    link_ids: List[int] = []
+
+
+class ValidationReport(BaseModel):
+    """All the violations found in a graph."""
+
+    issues: List[GraphIssue]
+
+    @property
+    def is_valid(self) -> bool:
+        """Return whether the graph follows all the constraints."""
+        return not self.issues
+
+    def display(self) -> str:
+        """Display the issues, one per line."""
+        return '\n'.join(f'- {issue.message}' for issue in self.issues)
+
+
+def _components(nodes: List[Node], links: List[Link]) -> List[List[int]]:
+    """Return the node ids of the weakly connected components, in the order of their first node in `nodes`."""
+    return CompactGraph(KnowledgeGraph.model_construct(nodes=nodes, links=links, name='', reasoning='')).components()
+
+
+def _split_links(
+    node_ids: Set[int],
+    links: List[Link],
+) -> Tuple[List[Link], List[Link], List[Link], List[Tuple[Link, Link]]]:
+    """Split the links into valid, dangling and self-loop links, and list the 2-cycles among the valid ones.
+
+    Of the two links of a 2-cycle, only the first one in `links` is kept in the valid links.
+    """
+    valid: List[Link] = []
+    dangling: List[Link] = []
+    self_loops: List[Link] = []
+    two_cycles: List[Tuple[Link, Link]] = []
+    by_direction: Dict[Tuple[int, int], Link] = {}
+    for link in links:
+        if link.node_id_from not in node_ids or link.node_id_to not in node_ids:
+            dangling.append(link)
+        elif link.node_id_from == link.node_id_to:
+            self_loops.append(link)
+        elif (link.node_id_to, link.node_id_from) in by_direction:
+            two_cycles.append((by_direction[(link.node_id_to, link.node_id_from)], link))
+        else:
+            by_direction.setdefault((link.node_id_from, link.node_id_to), link)
+            valid.append(link)
+    return valid, dangling, self_loops, two_cycles
+
+
+def _unique_by_id(nodes: List[Node], links: List[Link]) -> Tuple[List[Node], List[Link], List[int], List[int]]:
+    """Keep the first node (resp. link) of each id, return the ids that were duplicated."""
+    unique_nodes: Dict[int, Node] = {}
+    duplicate_node_ids: List[int] = []
+    for node in nodes:
+        if node.node_id in unique_nodes:
+            duplicate_node_ids.append(node.node_id)
+        else:
+            unique_nodes[node.node_id] = node
+    unique_links: Dict[int, Link] = {}
+    duplicate_link_ids: List[int] = []
+    for link in links:
+        if link.link_id in unique_links:
+            duplicate_link_ids.append(link.link_id)
+        else:
+            unique_links[link.link_id] = link
+    return list(unique_nodes.values()), list(unique_links.values()), duplicate_node_ids, duplicate_link_ids
+
+
+def validate_graph(knowledge_graph: KnowledgeGraph) -> ValidationReport:
+    """Return every violation of the graph constraints found in `knowledge_graph`."""
+    nodes, links, duplicate_node_ids, duplicate_link_ids = _unique_by_id(knowledge_graph.nodes, knowledge_graph.links)
+    issues = [
+        GraphIssue(kind='duplicate_node_id', message=f'Several nodes have the id {node_id}', node_ids=[node_id])
+        for node_id in duplicate_node_ids
+    ]
+    issues += [
+        GraphIssue(kind='duplicate_link_id', message=f'Several links have the id {link_id}', link_ids=[link_id])
+        for link_id in duplicate_link_ids
+    ]
+    node_ids = [node.node_id for node in nodes]
+    valid_links, dangling, self_loops, two_cycles = _split_links(set(node_ids), links)
+    issues += [
+        GraphIssue(
+            kind='dangling_link',
+            message=f'Link {link.link_id} goes from node {link.node_id_from} to node {link.node_id_to} '
+            'but one of them does not exist',
+            node_ids=[link.node_id_from, link.node_id_to],
+            link_ids=[link.link_id],
+        )
+        for link in dangling
+    ]
+    issues += [
+        GraphIssue(
+            kind='self_loop',
+            message=f'Link {link.link_id} is a loop on node {link.node_id_from}',
+            node_ids=[link.node_id_from],
+            link_ids=[link.link_id],
+        )
+        for link in self_loops
+    ]
+    issues += [
+        GraphIssue(
+            kind='two_cycle',
+            message=f'Links {first.link_id} and {second.link_id} form a loop between nodes '
+            f'{first.node_id_from} and {first.node_id_to}',
+            node_ids=[first.node_id_from, first.node_id_to],
+            link_ids=[first.link_id, second.link_id],
+        )
+        for first, second in two_cycles
+    ]
+    linked_node_ids = {link.node_id_from for link in valid_links} | {link.node_id_to for link in valid_links}
+    isolated_node_ids = [node_id for node_id in node_ids if node_id not in linked_node_ids]
+    issues += [
+        GraphIssue(kind='isolated_node', message=f'Node {node_id} is not linked to any node', node_ids=[node_id])
+        for node_id in isolated_node_ids
+    ]
+    components = _components([node for node in nodes if node.node_id in linked_node_ids], valid_links)
+    if len(components) > 1:
+        largest = max(components, key=len)
+        issues.append(
+            GraphIssue(
+                kind='disconnected',
+                message=f'The graph has {len(components)} separate components',
+                node_ids=[node_id for component in components if component is not largest for node_id in component],
+            ),
+        )
+    return ValidationReport(issues=issues)
+
+
+def repair_graph(knowledge_graph: KnowledgeGraph, *, keep_largest_component: bool = True) -> KnowledgeGraph:
+    """Return a copy of `knowledge_graph` following the graph constraints.
+
+    The repair is deterministic: duplicated ids keep their first node or link, dangling links and self-loops are
+    dropped, the second link of each 2-cycle is dropped, then isolated nodes are pruned and, when
+    `keep_largest_component` is set, only the largest connected component is kept.
+    """
+    nodes, links, _, _ = _unique_by_id(knowledge_graph.nodes, knowledge_graph.links)
+    node_ids = [node.node_id for node in nodes]
+    valid_links, _, _, _ = _split_links(set(node_ids), links)
+    linked_node_ids = {link.node_id_from for link in valid_links} | {link.node_id_to for link in valid_links}
+    if keep_largest_component:
+        components = _components([node for node in nodes if node.node_id in linked_node_ids], valid_links)
+        largest_component: List[int] = max(components, key=len, default=[])
+        linked_node_ids = set(largest_component)
+        valid_links = [link for link in valid_links if link.node_id_from in linked_node_ids]
+    return knowledge_graph.model_copy(
+        update={
+            'nodes': [node for node in nodes if node.node_id in linked_node_ids],
+            'links': valid_links,
+        },
+    )
+
+
+def _valid_or_repaired(knowledge_graph: KnowledgeGraph, *, regenerated: bool, repair: bool) -> Optional[KnowledgeGraph]:
+    """Return the graph when it is valid, its repair when `repair` is set and keeps some nodes, None otherwise."""
+    if validate_graph(knowledge_graph).is_valid:
+        GRAPH_VALIDATIONS.inc(outcome='regenerated' if regenerated else 'valid')
+        return knowledge_graph
+    if repair:
+        repaired_graph = repair_graph(knowledge_graph)
+        if repaired_graph.nodes:
+            GRAPH_VALIDATIONS.inc(outcome='repaired')
+            return repaired_graph
+    return None
+
+
+def ensure_valid_graph(
+    knowledge_graph: KnowledgeGraph,
+    regenerate: Callable[[], KnowledgeGraph],
+    *,
+    repair: bool = True,
+    max_regenerations: int = 1,
+) -> KnowledgeGraph:
+    """Return a graph following the graph constraints.
+
+    An invalid graph is repaired when `repair` is set, and re-requested with `regenerate` (up to `max_regenerations`
+    times) when the repair is disabled or leaves no node. The last graph is returned as is if no attempt succeeds.
+    """
+    for attempt in range(max_regenerations + 1):
+        if attempt:
+            knowledge_graph = regenerate()
+        valid_graph = _valid_or_repaired(knowledge_graph, regenerated=attempt > 0, repair=repair)
+        if valid_graph is not None:
+            return valid_graph
+    GRAPH_VALIDATIONS.inc(outcome='invalid')
+    return knowledge_graph
+
+
+async def aensure_valid_graph(
+    knowledge_graph: KnowledgeGraph,
+    regenerate: Callable[[], Awaitable[KnowledgeGraph]],
+    *,
+    repair: bool = True,
+    max_regenerations: int = 1,
+) -> KnowledgeGraph:
+    """Async counterpart of `ensure_valid_graph`."""
+    for attempt in range(max_regenerations + 1):
+        if attempt:
+            knowledge_graph = await regenerate()
+        valid_graph = _valid_or_repaired(knowledge_graph, regenerated=attempt > 0, repair=repair)
+        if valid_graph is not None:
+            return valid_graph
+    GRAPH_VALIDATIONS.inc(outcome='invalid')
+    return knowledge_graph
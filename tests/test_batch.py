@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+from llm_graphs.batch import (
+    main,
+    read_finished,
+    read_titles,
+    run_batch,
+)
+from llm_graphs.models import KnowledgeGraph
+from llm_graphs.pipeline import BookGraphResult
+from llm_graphs.usage import Usage
+
+
+def _build(index: int, book_name: str) -> BookGraphResult:
+    if book_name == 'Bad Book':
+        raise RuntimeError('LLM error')
+    return BookGraphResult(
+        index=index,
+        book_name=book_name,
+        success=True,
+        graph=KnowledgeGraph(nodes=[], links=[], name=book_name, reasoning=''),
+        usage=Usage(calls=1),
+        elapsed_seconds=0,
+    )
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.output_path = self.directory / 'graphs.jsonl'
+
+    def test_read_titles(self) -> None:
+        jsonl_path = self.directory / 'titles.jsonl'
+        jsonl_path.write_text('"Dune"\n{"title": "Emma"}\n\n{"book_name": "Ulysses"}\n')
+        assert read_titles(jsonl_path) == ['Dune', 'Emma', 'Ulysses']
+        csv_path = self.directory / 'titles.csv'
+        csv_path.write_text('author,title\nHerbert,Dune\nAusten,"Emma, a novel"\n')
+        assert read_titles(csv_path) == ['Dune', 'Emma, a novel']
+        csv_path.write_text('Dune\nEmma\n')
+        assert read_titles(csv_path) == ['Dune', 'Emma']
+
+    def test_run_batch_appends_one_result_per_title(self) -> None:
+        progress = []
+        stats = run_batch(
+            ['Dune', 'Bad Book', 'Emma'],
+            self.output_path,
+            _build,
+            max_workers=2,
+            on_progress=progress.append,
+        )
+        assert (stats.succeeded, stats.failed, stats.skipped) == (2, 1, 0)
+        assert len(progress) == 3
+        results = [BookGraphResult.model_validate_json(line) for line in self.output_path.read_text().splitlines()]
+        assert sorted(result.index for result in results) == [0, 1, 2]
+        assert [result.errors for result in results if not result.success] == [['LLM error']]
+
+    def test_run_batch_resumes_after_a_crash(self) -> None:
+        run_batch(['Dune', 'Bad Book'], self.output_path, _build, max_workers=1)
+        # A crash in the middle of writing a line
+        with self.output_path.open('a') as f:
+            f.write('{"index": 2, "book_na')
+        assert read_finished(self.output_path) == {0}
+        stats = run_batch(['Dune', 'Good Book', 'Emma'], self.output_path, _build, max_workers=1)
+        assert (stats.succeeded, stats.failed, stats.skipped) == (2, 0, 1)
+        assert read_finished(self.output_path) == {0, 1, 2}
+
+    def test_one_shot_mode_with_the_default_model(self) -> None:
+        input_path = self.directory / 'titles.csv'
+        input_path.write_text('Dune\n')
+        complete = MagicMock(return_value=KnowledgeGraph(nodes=[], links=[], name='Dune', reasoning=''))
+        with (
+            patch('llm_graphs.agents.one_shot_agent.get_client'),
+            patch('llm_graphs.agents.one_shot_agent.complete', complete),
+        ):
+            assert main([str(input_path), str(self.output_path), '--mode', 'one-shot']) == 0
+        assert complete.call_args.args[1] == 'gpt-4o'
+        (line,) = self.output_path.read_text().splitlines()
+        assert BookGraphResult.model_validate_json(line).success
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import unittest
+from typing import Callable
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+from llm_graphs.agents import beam_search
+from llm_graphs.agents.beam_search import (
+    BeamSearchSettings,
+    abeam_search,
+)
+from llm_graphs.agents.rating_agent import RatingGraphCreator
+from llm_graphs.cache import (
+    MemoryCache,
+    set_cache,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+from llm_graphs.prompts import GraphEncoding
+from llm_graphs.usage import track_usage
+
+
+def _graph(name: str) -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[Node(node_id=1, name='a', description=''), Node(node_id=2, name='b', description='')],
+        links=[Link(link_id=1, name='ab', node_id_from=1, node_id_to=2, description='')],
+        name=name,
+        reasoning='',
+    )
+
+
+def _client(rating: Callable[[int], int] = lambda n: n) -> MagicMock:
+    num_graphs = 0
+
+    async def create(model: str, response_model: type, messages: list) -> object:  # noqa: ARG001
+        nonlocal num_graphs
+        if response_model is Feedback:
+            # Graph `graph <n>` is rated `rating(n)`, n by default
+            graph_name = messages[1]['content'].split('"name":"graph ')[1].split('"')[0]
+            return Feedback(rating=rating(int(graph_name)), opinion='')
+        num_graphs += 1
+        return _graph(f'graph {num_graphs}')
+
+    client = MagicMock()
+    client.chat.completions.create = create
+    return client
+
+
+class TestBeamSearch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.client = _client()
+
+    async def test_beam_search_explores_the_best_candidates(self) -> None:
+        settings = BeamSearchSettings(num_seeds=3, beam_width=2, num_rounds=2)
+        result = await abeam_search('Test Book', settings, client=self.client)
+        assert result.stop_reason == 'num_rounds'
+        # 3 seeds, then 2 children per round
+        assert len(result.candidates) == 7
+        assert [candidate.depth for candidate in result.candidates] == [0, 0, 0, 1, 1, 2, 2]
+        # Seeds 3 and 2 are improved first, then their children rated 5 and 4
+        assert [candidate.parent_id for candidate in result.candidates[3:]] == [2, 1, 4, 3]
+        assert result.best.graph.name == 'graph 7'
+        assert [candidate.graph.name for candidate in result.lineage()] == ['graph 3', 'graph 4', 'graph 7']
+        assert result.usage.calls == 14
+
+    async def test_surviving_parents_get_new_children(self) -> None:
+        set_cache(MemoryCache())
+        # Every child is rated lower than its parent, so the seed stays in the beam and is improved every round
+        client = _client(lambda n: 10 - n)
+        result = await abeam_search('Test Book', BeamSearchSettings(num_seeds=1, beam_width=2, num_rounds=2), client)
+        assert [candidate.parent_id for candidate in result.candidates] == [None, 0, 0, 1]
+        assert [candidate.graph.name for candidate in result.candidates] == ['graph 1', 'graph 2', 'graph 3', 'graph 4']
+        assert result.best.graph.name == 'graph 1'
+
+    async def test_token_budget_stops_the_search(self) -> None:
+        settings = BeamSearchSettings(num_seeds=2, beam_width=1, num_rounds=5, max_tokens=0)
+        result = await abeam_search('Test Book', settings, client=self.client)
+        assert result.stop_reason == 'max_tokens'
+        assert len(result.candidates) == 2
+
+    async def test_usage_is_tracked_across_scopes(self) -> None:
+        with track_usage() as usage:
+            await abeam_search('Test Book', BeamSearchSettings(num_seeds=1, num_rounds=0), client=self.client)
+        assert usage.calls == 2
+
+
+class TestRatingGraphCreatorBeamSearch(unittest.TestCase):
+    def test_creator_settings_and_history(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        graph_encoding = GraphEncoding(include_reasoning=False)
+        with patch('llm_graphs.agents.rating_agent.get_client'):
+            creator = RatingGraphCreator('Test Book', max_concurrency=1, graph_encoding=graph_encoding)
+        creator._graphs_history.append({'graph': _graph('previous'), 'rating': None})
+        with patch.object(beam_search, 'abeam_search', wraps=abeam_search) as search:
+            result = creator.beam_search(BeamSearchSettings(num_seeds=2, num_rounds=1, max_concurrency=2), _client())
+        settings = search.call_args.args[1]
+        assert (settings.max_concurrency, settings.graph_encoding) == (2, graph_encoding)
+        assert [entry['graph'] for entry in creator._graphs_history] == [
+            candidate.graph for candidate in result.lineage()
+        ]
+
+
+if __name__ == '__main__':
+    unittest.main()
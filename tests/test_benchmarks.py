@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import random
+import unittest
+
+import httpx
+import instructor
+from openai import AsyncOpenAI
+
+from benchmarks.fake_openai import (
+    FakeServerSettings,
+    create_app,
+    sample_latency,
+)
+from benchmarks.load import (
+    LevelResult,
+    compare,
+    percentile,
+)
+from benchmarks.startup import (
+    StartupResult,
+    StartupRun,
+    check,
+    measure,
+)
+from llm_graphs.step import (
+    agenerate_seed_graph,
+    arate_graph,
+)
+from llm_graphs.validation import validate_graph
+
+
+def _result(rps: float, p99_ms: float, errors: int = 0) -> LevelResult:
+    return LevelResult(
+        scenario='api_init',
+        concurrency=8,
+        requests=100,
+        errors=errors,
+        seconds=1,
+        rps=rps,
+        p50_ms=10,
+        p95_ms=20,
+        p99_ms=p99_ms,
+        peak_rss_mb=100,
+    )
+
+
+class TestFakeOpenAI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.app = create_app(FakeServerSettings(latency_mean=0, seed=0))
+        http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.app))
+        self.addAsyncCleanup(http_client.aclose)
+        openai_client = AsyncOpenAI(api_key='sk-fake', base_url='http://fake/v1', http_client=http_client)
+        self.client = instructor.from_openai(openai_client, mode=instructor.Mode.TOOLS)
+
+    async def test_canned_payloads(self) -> None:
+        graph = await agenerate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.client, use_cache=False)
+        assert validate_graph(graph).is_valid
+        feedback = await arate_graph('gpt-4o', 'goal', 'meaning', graph, client=self.client, use_cache=False)
+        assert 3 <= feedback.rating <= 9
+        assert self.app.state.stats.requests == 2
+
+    async def test_rate_limited(self) -> None:
+        self.app = create_app(FakeServerSettings(latency_mean=0, rate_limit_rate=1))
+        transport = httpx.ASGITransport(app=self.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://fake') as client:
+            response = await client.post('/v1/chat/completions', json={'tools': []})
+        assert response.status_code == 429
+        assert response.headers['retry-after-ms'] == '50'
+
+
+class TestLoad(unittest.TestCase):
+    def test_sample_latency(self) -> None:
+        rng = random.Random(0)
+        settings = FakeServerSettings(latency_distribution='uniform', latency_mean=0.1)
+        assert all(0 <= sample_latency(settings, rng) <= 0.2 for _ in range(100))
+        assert sample_latency(FakeServerSettings(latency_distribution='constant', latency_mean=0.1), rng) == 0.1
+
+    def test_percentile(self) -> None:
+        values = [float(i) for i in range(1, 101)]
+        assert percentile(values, 0.5) == 50
+        assert percentile(values, 0.99) == 99
+        assert percentile([3.0], 0.95) == 3
+        assert percentile([], 0.5) == 0
+
+    def test_compare(self) -> None:
+        baseline = [_result(rps=100, p99_ms=50)]
+        assert compare([_result(rps=90, p99_ms=55)], baseline, tolerance=0.25) == []
+        regressions = compare([_result(rps=50, p99_ms=100, errors=1)], baseline, tolerance=0.25)
+        assert len(regressions) == 3
+
+
+class TestStartup(unittest.TestCase):
+    def test_check(self) -> None:
+        result = StartupResult(module='api.main', runs=[StartupRun(seconds=1, loaded=['pyvis'])], median=1, best=1)
+        assert check(result, budget=2) == ['api.main: pyvis imported eagerly']
+        assert check(result.model_copy(update={'runs': []}), budget=0.5) == [
+            'api.main: median import 1.000 s over the 0.500 s budget',
+        ]
+
+    def test_api_imports_lazily(self) -> None:
+        # The budget is loose so a slow machine does not fail, `make bench-startup` holds the real one
+        assert check(measure(runs=1), budget=10) == []
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+from llm_graphs.cache import (
+    MemoryCache,
+    SQLiteCache,
+    cache_key,
+    set_cache,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+from llm_graphs.step import generate_seed_graph
+
+
+class TestCacheKey(unittest.TestCase):
+    def test_cache_key_depends_on_the_whole_request(self) -> None:
+        messages = [{'role': 'user', 'content': 'hello'}]
+        key = cache_key('gpt-4o', KnowledgeGraph, messages)  # type: ignore
+        assert key == cache_key('gpt-4o', KnowledgeGraph, [{'content': 'hello', 'role': 'user'}])  # type: ignore
+        assert key != cache_key('gpt-4', KnowledgeGraph, messages)  # type: ignore
+        assert key != cache_key('gpt-4o', Feedback, messages)  # type: ignore
+        assert key != cache_key('gpt-4o', KnowledgeGraph, [{'role': 'user', 'content': 'hi'}])  # type: ignore
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_hits_and_misses(self) -> None:
+        cache = MemoryCache()
+        assert cache.get('a') is None
+        cache.set('a', b'value')
+        assert cache.get('a') == b'value'
+        stats = cache.stats()
+        assert (stats.hits, stats.misses, stats.entries, stats.size_bytes) == (1, 1, 1, 5)
+
+    def test_lru_eviction_on_entries_and_bytes(self) -> None:
+        cache = MemoryCache(max_entries=2, max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.get('a')
+        cache.set('c', b'1234')
+        assert cache.get('b') is None
+        assert cache.get('a') == b'1234'
+        cache.set('d', b'12345678')
+        assert cache.stats().size_bytes <= 10
+        assert cache.stats().evictions == 3
+
+    def test_ttl(self) -> None:
+        cache = MemoryCache(ttl=10)
+        with patch('llm_graphs.cache.time.time', return_value=0):
+            cache.set('a', b'value')
+        with patch('llm_graphs.cache.time.time', return_value=11):
+            assert cache.get('a') is None
+        assert cache.stats().expirations == 1
+
+
+class TestSQLiteCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.tmp_dir.name) / 'cache.sqlite3')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_persists_across_instances(self) -> None:
+        cache = SQLiteCache(self.path)
+        cache.set('a', b'value')
+        cache.close()
+        cache = SQLiteCache(self.path)
+        assert cache.get('a') == b'value'
+        assert cache.stats().hits == 1
+        cache.close()
+
+    def test_max_bytes_eviction(self) -> None:
+        cache = SQLiteCache(self.path, max_bytes=8)
+        with patch('llm_graphs.cache.time.time', return_value=0):
+            cache.set('a', b'1234')
+        with patch('llm_graphs.cache.time.time', return_value=1):
+            cache.set('b', b'1234')
+        with patch('llm_graphs.cache.time.time', return_value=2):
+            cache.set('c', b'1234')
+        assert cache.get('a') is None
+        assert cache.get('c') == b'1234'
+        cache.close()
+
+    def test_size_tracks_replaced_and_reopened_entries(self) -> None:
+        cache = SQLiteCache(self.path)
+        cache.set('a', b'1234')
+        cache.set('a', b'12')
+        cache.set('b', b'123')
+        assert cache.stats().size_bytes == 5
+        cache.close()
+        cache = SQLiteCache(self.path, max_bytes=4)
+        assert cache.stats().size_bytes == 5
+        cache.set('c', b'1')
+        assert cache.stats().size_bytes <= 4
+        cache.close()
+
+
+class TestCachedStep(unittest.TestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(MemoryCache()))
+        self.mock_graph = KnowledgeGraph(nodes=[], links=[], name='Test Graph', reasoning='Test reasoning')
+        self.mock_client = MagicMock()
+        self.mock_client.chat.completions.create.return_value = self.mock_graph
+
+    def test_repeated_calls_hit_the_cache(self) -> None:
+        first = generate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        second = generate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        assert first == second == self.mock_graph
+        self.mock_client.chat.completions.create.assert_called_once()
+
+    def test_use_cache_opt_out(self) -> None:
+        generate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        generate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client, use_cache=False)
+        assert self.mock_client.chat.completions.create.call_count == 2
+
+    def test_invalid_graphs_are_not_cached(self) -> None:
+        self.mock_client.chat.completions.create.return_value = KnowledgeGraph(
+            nodes=[Node(node_id=1, name='node', description='')],
+            links=[Link(link_id=1, name='', node_id_from=1, node_id_to=1, description='')],
+            name='Test Graph',
+            reasoning='',
+        )
+        generate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        generate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        assert self.mock_client.chat.completions.create.call_count == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
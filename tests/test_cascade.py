@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    MagicMock,
+    patch,
+)
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from api.main import app
+from llm_graphs.agents.rating_agent import RatingGraphCreator
+from llm_graphs.cache import set_cache
+from llm_graphs.cascade import (
+    CascadeSettings,
+    arate_graph_cascade,
+    cascade_stats,
+    escalation_reasons,
+    rate_graph_cascade,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    RatingBatch,
+)
+
+OPINION = 'The graph covers the main characters and their relations, but misses the political factions of the book.'
+
+
+def _batch(*ratings: int, opinion: str = OPINION) -> RatingBatch:
+    return RatingBatch(feedbacks=[Feedback(rating=rating, opinion=opinion) for rating in ratings], errors=[])
+
+
+def _graph() -> KnowledgeGraph:
+    return KnowledgeGraph(nodes=[], links=[], name='Test Graph', reasoning='')
+
+
+def _client(*feedbacks: Feedback) -> MagicMock:
+    client = MagicMock()
+    client.chat.completions.create = MagicMock(side_effect=feedbacks)
+    return client
+
+
+class TestCascadeSettings(unittest.TestCase):
+    def test_cheap_num_ratings_is_bounded(self) -> None:
+        for cheap_num_ratings in (0, 200):
+            with self.subTest(cheap_num_ratings=cheap_num_ratings), pytest.raises(ValidationError):
+                CascadeSettings(cheap_num_ratings=cheap_num_ratings)
+
+    def test_rate_endpoint_rejects_unbounded_cheap_ratings(self) -> None:
+        rate = AsyncMock()
+        body = {'book_name': 'Dune', 'graph': _graph().model_dump()}
+        with patch('api.main._rate', rate):
+            client = TestClient(app)
+            for cheap_num_ratings in (0, 200):
+                rating_cascade = {'cheap_num_ratings': cheap_num_ratings}
+                response = client.post('/book_graph/rate', json={**body, 'rating_cascade': rating_cascade})
+                assert response.status_code == 422
+        rate.assert_not_awaited()
+
+
+class TestEscalationReasons(unittest.TestCase):
+    def test_confident_ratings_are_kept(self) -> None:
+        settings = CascadeSettings()
+        assert escalation_reasons(_batch(8, 9), settings) == []
+        assert escalation_reasons(_batch(2, 3), settings) == []
+
+    def test_uncertain_ratings_are_escalated(self) -> None:
+        settings = CascadeSettings()
+        assert escalation_reasons(_batch(5, 6), settings) == ['mid_range']
+        assert escalation_reasons(_batch(2, 9), settings) == ['mid_range', 'disagreement']
+        assert escalation_reasons(_batch(8, 8, opinion='Good.'), settings) == ['quality']
+        assert escalation_reasons(_batch(11, 11), settings) == ['quality']
+        assert escalation_reasons(RatingBatch(feedbacks=[], errors=['boom']), settings) == ['failed']
+
+
+class TestRateGraphCascade(unittest.TestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.settings = CascadeSettings(cheap_model='cheap', expensive_model='expensive')
+
+    def _models(self, client: MagicMock) -> list:
+        return [call.kwargs['model'] for call in client.chat.completions.create.call_args_list]
+
+    def test_confident_cheap_ratings_are_kept(self) -> None:
+        client = _client(Feedback(rating=9, opinion=OPINION), Feedback(rating=8, opinion=OPINION))
+        before = cascade_stats()
+        result = rate_graph_cascade('goal', 'meaning', _graph(), self.settings, client=client)
+        assert (result.model, result.reasons) == ('cheap', [])
+        assert [feedback.rating for feedback in result.rating_batch.feedbacks] == [9, 8]
+        assert self._models(client) == ['cheap', 'cheap']
+        stats = cascade_stats()
+        assert (stats.cheap.calls, stats.expensive.calls) == (before.cheap.calls + 1, before.expensive.calls)
+
+    def test_uncertain_cheap_ratings_are_escalated(self) -> None:
+        client = _client(*(Feedback(rating=rating, opinion=OPINION) for rating in (5, 6, 7)))
+        before = cascade_stats()
+        result = rate_graph_cascade('goal', 'meaning', _graph(), self.settings, client=client)
+        assert (result.model, result.reasons) == ('expensive', ['mid_range'])
+        assert [feedback.rating for feedback in result.rating_batch.feedbacks] == [7]
+        assert self._models(client) == ['cheap', 'cheap', 'expensive']
+        stats = cascade_stats()
+        assert stats.expensive.calls == before.expensive.calls + 1
+        assert stats.escalations['mid_range'] == before.escalations.get('mid_range', 0) + 1
+
+    def test_cheap_ratings_are_kept_when_the_expensive_ones_fail(self) -> None:
+        feedbacks = [Feedback(rating=5, opinion=OPINION), Feedback(rating=6, opinion=OPINION)]
+        client = _client(*feedbacks, RuntimeError('boom'))
+        result = rate_graph_cascade('goal', 'meaning', _graph(), self.settings, client=client)
+        assert result.model == 'cheap'
+        assert result.rating_batch.feedbacks == feedbacks
+        assert result.rating_batch.errors == ['boom']
+
+    def test_rating_graph_creator(self) -> None:
+        client = _client(*(Feedback(rating=rating, opinion=OPINION) for rating in (5, 6, 7)))
+        with patch('llm_graphs.agents.rating_agent.get_client', return_value=client):
+            creator = RatingGraphCreator('Test Book', rating_cascade=self.settings)
+        creator._graphs_history.append({'graph': _graph(), 'rating': None})
+        creator.rate_this_graph()
+        assert creator.get_rating(-1) == [Feedback(rating=7, opinion=OPINION)]
+
+
+class TestArateGraphCascade(unittest.IsolatedAsyncioTestCase):
+    async def test_escalation(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        settings = CascadeSettings(cheap_model='cheap', expensive_model='expensive', cheap_num_ratings=1)
+        client = MagicMock()
+        models = []
+
+        async def create(**kwargs: object) -> Feedback:
+            models.append(kwargs['model'])
+            return Feedback(rating=8, opinion='Too short.' if kwargs['model'] == 'cheap' else OPINION)
+
+        client.chat.completions.create = create
+        result = await arate_graph_cascade('goal', 'meaning', _graph(), settings, num_ratings=2, client=client)
+        assert (result.model, result.reasons) == ('expensive', ['quality'])
+        assert models == ['cheap', 'expensive', 'expensive']
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import os
+import unittest
+from unittest.mock import patch
+
+from llm_graphs.clients import (
+    ClientRegistry,
+    ClientSettings,
+    model_family,
+    models_to_warm,
+)
+from llm_graphs.limits import (
+    RateLimiter,
+    set_limiter,
+)
+
+
+class TestClientRegistry(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.registry = ClientRegistry(ClientSettings(http2=False))
+
+    async def asyncTearDown(self) -> None:
+        await self.registry.aclose()
+
+    def test_model_family(self) -> None:
+        assert model_family('gpt-4o') == 'gpt'
+        assert model_family('gpt-3.5-turbo') == 'gpt'
+        assert model_family(None) == 'default'
+
+    def test_clients_are_shared_within_a_family(self) -> None:
+        client = self.registry.get_client('gpt-4o', api_key='sk-test')
+        assert self.registry.get_client('gpt-3.5-turbo', api_key='sk-test') is client
+        assert self.registry.get_client('gpt-4o', api_key='sk-other') is not client
+        assert self.registry.get_client('gpt-4o', base_url='http://localhost:8000/v1', api_key='sk-test') is not client
+
+    def test_sync_and_async_clients_are_separate(self) -> None:
+        client = self.registry.get_async_client('gpt-4o', api_key='sk-test')
+        assert self.registry.get_async_client('gpt-4o', api_key='sk-test') is client
+        assert self.registry.get_client('gpt-4o', api_key='sk-test') is not client
+
+    async def test_aclose_drops_the_pooled_clients(self) -> None:
+        client = self.registry.get_async_client('gpt-4o', api_key='sk-test')
+        await self.registry.aclose()
+        assert self.registry.get_async_client('gpt-4o', api_key='sk-test') is not client
+
+    def test_warm_builds_the_clients(self) -> None:
+        with patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test'}):
+            self.registry.warm(['gpt-4o'])
+            assert (
+                self.registry.get_client('gpt-4o') is self.registry._clients[self.registry._key('gpt-4o', None, None)]
+            )
+        assert len(self.registry._http_clients) == len(self.registry._async_http_clients) == 1
+
+    def test_sdk_retries_are_off_while_limiting(self) -> None:
+        previous = set_limiter(None)
+        self.addCleanup(set_limiter, previous)
+        assert self.registry.get_client('gpt-4o', api_key='sk-test').client.max_retries == 2
+        set_limiter(RateLimiter())
+        assert self.registry.get_async_client('gpt-4o', api_key='sk-test').client.max_retries == 0
+
+    def test_models_to_warm(self) -> None:
+        with patch.dict(os.environ, {'LLM_GRAPHS_WARM_CLIENTS': 'gpt-4o, gpt-3.5-turbo,'}):
+            assert models_to_warm() == ['gpt-4o', 'gpt-3.5-turbo']
+        with patch.dict(os.environ, {}, clear=True):
+            assert models_to_warm() == []
+
+
+if __name__ == '__main__':
+    unittest.main()
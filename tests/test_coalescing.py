@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+import unittest
+
+from api.coalescing import (
+    SingleFlight,
+    request_key,
+)
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    def test_request_key_ignores_key_order(self) -> None:
+        assert request_key('init', {'a': 1, 'b': 2}) == request_key('init', {'b': 2, 'a': 1})
+        assert request_key('init', {'a': 1}) != request_key('rate', {'a': 1})
+        assert request_key('init', {'a': 1}) != request_key('init', {'a': 2})
+
+    async def test_identical_calls_share_one_execution(self) -> None:
+        single_flight = SingleFlight()
+        calls = 0
+
+        async def fn() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 'graph'
+
+        results = await asyncio.gather(*(single_flight.do('key', fn) for _ in range(5)))
+        assert results == ['graph'] * 5
+        assert calls == 1
+        stats = single_flight.stats()
+        assert (stats.calls, stats.collapsed, stats.in_flight) == (1, 4, 0)
+
+    async def test_finished_calls_are_not_reused(self) -> None:
+        single_flight = SingleFlight()
+
+        async def fn() -> int:
+            return 1
+
+        await single_flight.do('key', fn)
+        await single_flight.do('key', fn)
+        assert single_flight.stats().calls == 2
+
+    async def test_errors_are_shared(self) -> None:
+        single_flight = SingleFlight()
+
+        async def fn() -> None:
+            await asyncio.sleep(0.01)
+            raise RuntimeError('boom')
+
+        results = await asyncio.gather(*(single_flight.do('key', fn) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    async def test_a_cancelled_caller_does_not_cancel_the_others(self) -> None:
+        single_flight = SingleFlight()
+
+        async def fn() -> str:
+            await asyncio.sleep(0.02)
+            return 'graph'
+
+        first = asyncio.ensure_future(single_flight.do('key', fn))
+        second = asyncio.ensure_future(single_flight.do('key', fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'graph'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import unittest
+
+import pytest
+
+from llm_graphs.compact import (
+    CompactGraph,
+    StringTable,
+)
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+
+class TestCompactGraph(unittest.TestCase):
+    def setUp(self) -> None:
+        self.graph = KnowledgeGraph(
+            nodes=[
+                Node(node_id=10, name='a', description='first'),
+                Node(node_id=20, name='b', description='second'),
+                Node(node_id=30, name='c', description='third'),
+                Node(node_id=40, name='d', description='fourth'),
+            ],
+            links=[
+                Link(link_id=1, name='ab', node_id_from=10, node_id_to=20, description='a to b'),
+                Link(link_id=2, name='ac', node_id_from=10, node_id_to=30, description='a to c'),
+                Link(link_id=3, name='cb', node_id_from=30, node_id_to=20, description='c to b'),
+                Link(link_id=4, name='dangling', node_id_from=30, node_id_to=99, description='c to nowhere'),
+            ],
+            name='Test Graph',
+            reasoning='reasoning',
+        )
+        self.compact = CompactGraph.from_knowledge_graph(self.graph)
+
+    def test_round_trip(self) -> None:
+        assert self.compact.to_knowledge_graph() == self.graph
+
+    def test_lookups(self) -> None:
+        assert self.compact.index_of(30) == 2
+        assert self.compact.node(20) == self.graph.nodes[1]
+        assert self.compact.node_name(40) == 'd'
+        assert 99 not in self.compact
+        with pytest.raises(KeyError):
+            self.compact.index_of(99)
+
+    def test_adjacency(self) -> None:
+        assert self.compact.successors(10) == [20, 30]
+        assert self.compact.predecessors(20) == [10, 30]
+        assert self.compact.neighbours(30) == [20, 10]
+        assert [link.link_id for link in self.compact.out_links(30)] == [3]
+        assert [link.link_id for link in self.compact.in_links(20)] == [1, 3]
+
+    def test_degrees_and_components(self) -> None:
+        assert (self.compact.out_degree(10), self.compact.in_degree(10), self.compact.degree(20)) == (2, 0, 2)
+        assert list(self.compact.degrees()) == [2, 2, 2, 0]
+        assert self.compact.components() == [[10, 20, 30], [40]]
+
+    def test_link_ends(self) -> None:
+        sources, targets = self.compact.link_ends()
+        assert list(zip(sources, targets)) == [(0, 1), (0, 2), (2, 1)]
+
+    def test_shared_string_table(self) -> None:
+        strings = StringTable()
+        CompactGraph(self.graph, strings)
+        num_strings = len(strings)
+        other = CompactGraph(self.graph, strings)
+        assert len(strings) == num_strings
+        assert other.to_knowledge_graph() == self.graph
+
+
+if __name__ == '__main__':
+    unittest.main()
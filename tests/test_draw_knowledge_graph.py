@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import unittest
+
+from fastapi.testclient import TestClient
+
+from api.main import app
+from llm_graphs.cache import MemoryCache
+from llm_graphs.draw_knowledge_graph import (
+    RenderOptions,
+    render_html,
+    render_key,
+    set_render_cache,
+)
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+
+def _graph(name: str = 'graph') -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[
+            Node(node_id=1, name='Dune', description='A desert planet.'),
+            Node(node_id=2, name='Spice', description='A rare drug.'),
+        ],
+        links=[Link(link_id=1, name='produces', node_id_from=1, node_id_to=2, description='Dune produces spice.')],
+        name=name,
+        reasoning='',
+    )
+
+
+class TestRender(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = MemoryCache()
+        previous = set_render_cache(self.cache)
+        self.addCleanup(set_render_cache, previous)
+
+    def test_render_key(self) -> None:
+        assert render_key(_graph()) == render_key(_graph(), RenderOptions())
+        assert render_key(_graph()) != render_key(_graph('other'))
+        assert render_key(_graph()) != render_key(_graph(), RenderOptions(height='900px'))
+
+    def test_pages_are_cached(self) -> None:
+        page = render_html(_graph())
+        assert b'Spice' in page
+        assert render_html(_graph()) == page
+        stats = self.cache.stats()
+        assert (stats.hits, stats.misses, stats.entries) == (1, 1, 1)
+
+    def test_fixed_layout(self) -> None:
+        page = render_html(_graph())
+        assert b'"physics": false' in page
+        assert b'"x": 0.0' in page
+        assert b'"physics": false' not in render_html(_graph(), RenderOptions(layout=None))
+
+    def test_without_cache(self) -> None:
+        set_render_cache(None)
+        assert render_html(_graph()) == render_html(_graph())
+        assert self.cache.stats().entries == 0
+
+
+class TestRenderEndpoint(unittest.TestCase):
+    def setUp(self) -> None:
+        previous = set_render_cache(MemoryCache())
+        self.addCleanup(set_render_cache, previous)
+        self.client = TestClient(app)
+        self.body = {'graph': _graph().model_dump()}
+
+    def test_etag(self) -> None:
+        response = self.client.post('/v1/book_graph/render', json=self.body)
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/html')
+        etag = response.headers['etag']
+        assert etag == f'"{render_key(_graph())}"'
+
+        response = self.client.post('/v1/book_graph/render', json=self.body, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.content == b''
+
+        body = {**self.body, 'options': {'height': '900px'}}
+        response = self.client.post('/v1/book_graph/render', json=body, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+    def test_get_rendered_page(self) -> None:
+        response = self.client.post('/v1/book_graph/render', json=self.body)
+        location = response.headers['content-location']
+        assert self.client.get(location).content == response.content
+        assert self.client.get(location, headers={'If-None-Match': response.headers['etag']}).status_code == 304
+        assert self.client.get('/v1/book_graph/render/unknown').status_code == 404
+
+    def test_layout(self) -> None:
+        response = self.client.post('/v1/book_graph/layout', json=self.body)
+        assert response.json()['output'] == [
+            {'id': 1, 'x': 0.0, 'y': 0.0, 'physics': False},
+            {'id': 2, 'x': 0.0, 'y': 150.0, 'physics': False},
+        ]
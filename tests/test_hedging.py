@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import asyncio
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    MagicMock,
+)
+
+from llm_graphs.hedging import (
+    Hedger,
+    HedgeSettings,
+    ModelHedger,
+    set_hedger,
+)
+from llm_graphs.models import Feedback
+from llm_graphs.step import arate_graph
+
+
+def _hedger(**settings: float) -> ModelHedger:
+    hedger = ModelHedger(HedgeSettings(min_samples=4, min_delay=0.01, max_hedge_ratio=1, **settings), 'gpt-4o')
+    for latency in (0.01, 0.01, 0.02, 0.02):
+        hedger.observe(latency)
+    return hedger
+
+
+class TestModelHedger(unittest.IsolatedAsyncioTestCase):
+    def test_delay_is_a_percentile_of_the_latencies(self) -> None:
+        hedger = ModelHedger(HedgeSettings(min_samples=3, percentile=50, min_delay=0))
+        hedger.observe(1)
+        hedger.observe(3)
+        assert hedger.delay() is None
+        hedger.observe(2)
+        assert hedger.delay() == 2
+        hedger.settings.max_delay = 1.5
+        assert hedger.delay() == 1.5
+
+    async def test_fast_calls_are_not_hedged(self) -> None:
+        hedger = _hedger()
+        fn = AsyncMock(return_value='graph')
+        assert await hedger.acall(fn) == 'graph'
+        assert fn.await_count == 1
+        assert hedger.stats().hedged == 0
+
+    async def test_slow_calls_are_hedged_and_the_loser_cancelled(self) -> None:
+        hedger = _hedger()
+        cancelled = asyncio.Event()
+        calls = 0
+
+        async def fn() -> str:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+            return f'call {calls}'
+
+        assert await hedger.acall(fn) == 'call 2'
+        await asyncio.wait_for(cancelled.wait(), 1)
+        stats = hedger.stats()
+        assert (stats.hedged, stats.hedge_wins, stats.primary_wins) == (1, 1, 0)
+
+    async def test_the_other_call_is_awaited_when_one_fails(self) -> None:
+        hedger = _hedger()
+        calls = 0
+
+        async def fn() -> str:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                await asyncio.sleep(0.1)
+                return 'primary'
+            raise RuntimeError('boom')
+
+        assert await hedger.acall(fn) == 'primary'
+        assert hedger.stats().primary_wins == 1
+
+    async def test_extra_calls_are_capped(self) -> None:
+        hedger = _hedger(max_burst=1, max_delay=0.01)
+        hedger.settings.max_hedge_ratio = 0.5
+
+        async def fn() -> str:
+            await asyncio.sleep(0.05)
+            return 'graph'
+
+        for _ in range(4):
+            await hedger.acall(fn)
+        stats = hedger.stats()
+        assert (stats.calls, stats.hedged, stats.rate_capped) == (4, 2, 2)
+
+
+class TestHedgedSteps(unittest.IsolatedAsyncioTestCase):
+    async def test_step_calls_are_hedged(self) -> None:
+        hedger = Hedger(HedgeSettings(min_samples=1, min_delay=0.01, max_hedge_ratio=1))
+        previous = set_hedger(hedger)
+        self.addCleanup(set_hedger, previous)
+        hedger.for_model('gpt-4o').observe(0.01)
+        responses = iter([0.5, 0])
+
+        async def create(**_: object) -> Feedback:
+            await asyncio.sleep(next(responses))
+            return Feedback(rating=7, opinion='Good')
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        feedback = await arate_graph('gpt-4o', 'goal', 'meaning', MagicMock(), client=client, use_cache=False)
+        assert feedback.rating == 7
+        assert hedger.stats()['gpt-4o'].hedge_wins == 1
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    patch,
+)
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.jobs import (
+    JobQueueFullError,
+    JobRunner,
+    set_job_runner,
+)
+from api.main import app
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+    RatingBatch,
+)
+
+
+def _graph(name: str = 'graph') -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[
+            Node(node_id=1, name='Dune', description='A desert planet.'),
+            Node(node_id=2, name='Spice', description='A rare drug.'),
+        ],
+        links=[Link(link_id=1, name='produces', node_id_from=1, node_id_to=2, description='Dune produces spice.')],
+        name=name,
+        reasoning='',
+    )
+
+
+class TestJobRunner(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.runner = JobRunner(max_workers=2, max_queued=2, result_ttl=60)
+        self.addAsyncCleanup(self.runner.aclose)
+
+    async def _wait(self, job_id: str) -> str:
+        for _ in range(100):
+            job = self.runner.get(job_id)
+            assert job is not None
+            if job.finished_at is not None:
+                return job.status
+            await asyncio.sleep(0.01)
+        raise AssertionError(f'Job {job_id} did not finish')
+
+    async def test_results_and_errors(self) -> None:
+        async def succeed() -> str:
+            return 'graph'
+
+        async def fail() -> None:
+            raise RuntimeError('boom')
+
+        succeeded, failed = self.runner.submit('init', succeed), self.runner.submit('init', fail)
+        assert succeeded.status == 'queued'
+        assert await self._wait(succeeded.job_id) == 'succeeded'
+        assert self.runner.get(succeeded.job_id).result == 'graph'
+        assert await self._wait(failed.job_id) == 'failed'
+        assert self.runner.get(failed.job_id).errors == ['RuntimeError: boom']
+
+    async def test_bounded_workers_and_queue(self) -> None:
+        running = 0
+        peak = 0
+        release = asyncio.Event()
+
+        async def fn() -> None:
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await release.wait()
+            running -= 1
+
+        jobs = [self.runner.submit('rate', fn) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        jobs += [self.runner.submit('rate', fn) for _ in range(2)]
+        with pytest.raises(JobQueueFullError):
+            self.runner.submit('rate', fn)
+        stats = self.runner.stats()
+        assert (stats.running, stats.queued, stats.rejected) == (2, 2, 1)
+        release.set()
+        assert [await self._wait(job.job_id) for job in jobs] == ['succeeded'] * 4
+        assert peak == 2
+
+    async def test_cancel(self) -> None:
+        async def fn() -> None:
+            await asyncio.sleep(10)
+
+        running, _ = (self.runner.submit('improve', fn) for _ in range(2))
+        await asyncio.sleep(0.01)
+        queued = self.runner.submit('improve', fn)
+        assert self.runner.cancel(queued.job_id).status == 'cancelled'
+        self.runner.cancel(running.job_id)
+        assert await self._wait(running.job_id) == 'cancelled'
+        assert self.runner.cancel('unknown') is None
+        assert self.runner.stats().cancelled == 2
+
+    async def test_finished_jobs_expire(self) -> None:
+        async def fn() -> None:
+            return None
+
+        job = self.runner.submit('init', fn)
+        await self._wait(job.job_id)
+        with patch('api.jobs.time.time', return_value=time.time() + 61):
+            assert self.runner.get(job.job_id) is None
+        assert self.runner.stats().expired == 1
+
+
+class TestJobEndpoints(unittest.TestCase):
+    def setUp(self) -> None:
+        previous = set_job_runner(JobRunner())
+        self.addCleanup(set_job_runner, previous)
+        rate = AsyncMock(return_value=RatingBatch(feedbacks=[Feedback(rating=6, opinion='Fine')], errors=[]))
+        improve = AsyncMock(return_value=_graph('improved'))
+        for name, mock in (('_rate', rate), ('_improved_graph', improve)):
+            patcher = patch(f'api.main.{name}', mock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_submit_and_poll(self) -> None:
+        with TestClient(app) as client:
+            body = {'book_name': 'Dune', 'graph': _graph().model_dump(), 'num_ratings': 2}
+            response = client.post('/v1/jobs/book_graph/rate_and_improve', json=body)
+            assert response.status_code == 202
+            location = response.headers['location']
+            for _ in range(100):
+                job = client.get(location).json()['output']
+                if job['status'] not in ('queued', 'running'):
+                    break
+                time.sleep(0.01)
+            assert job['status'] == 'succeeded'
+            assert job['result']['output']['new_graph']['name'] == 'improved'
+            assert client.delete(location).json()['output']['status'] == 'succeeded'
+            assert client.get('/v1/jobs/unknown').status_code == 404
+
+    def test_invalid_requests_are_not_queued(self) -> None:
+        with TestClient(app) as client:
+            body = {'book_name': 'Dune', 'graph': _graph().model_dump(), 'num_ratings': 0}
+            assert client.post('/v1/jobs/book_graph/rate', json=body).status_code == 422
+            assert client.get('/v1/jobs/stats').json()['output']['submitted'] == 0
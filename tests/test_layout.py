@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import unittest
+
+import numpy as np
+import pytest
+
+from llm_graphs.cache import MemoryCache
+from llm_graphs.layout import (
+    LayoutSettings,
+    _exact_repulsion,
+    _tree_repulsion,
+    compute_layout,
+    force_layout,
+    layer_indices,
+    set_layout_cache,
+)
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+
+def _graph(links: list[tuple[int, int]], num_nodes: int = 4) -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[Node(node_id=i, name=f'node {i}', description='') for i in range(num_nodes)],
+        links=[
+            Link(link_id=i, name='link', node_id_from=source, node_id_to=target, description='')
+            for i, (source, target) in enumerate(links)
+        ],
+        name='graph',
+        reasoning='',
+    )
+
+
+class TestLayout(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = MemoryCache()
+        previous = set_layout_cache(self.cache)
+        self.addCleanup(set_layout_cache, previous)
+
+    def test_layer_indices(self) -> None:
+        sources, targets = np.array([0, 0, 1, 2]), np.array([1, 2, 3, 3])
+        assert layer_indices(4, sources, targets).tolist() == [0, 1, 1, 2]
+        assert layer_indices(3, np.array([0, 1, 2]), np.array([1, 2, 0])) is None
+
+    def test_layered_layout(self) -> None:
+        positions = compute_layout(_graph([(0, 1), (0, 2), (1, 3), (2, 3)]))
+        assert [positions[i][1] for i in range(4)] == [0, 150, 150, 300]
+        assert positions[1][0] != positions[2][0]
+
+    def test_loops_fall_back_to_the_force_layout(self) -> None:
+        graph = _graph([(0, 1), (1, 2), (2, 0), (2, 3)])
+        positions = compute_layout(graph)
+        assert len(set(positions.values())) == 4
+        with pytest.raises(ValueError, match='has a loop'):
+            compute_layout(graph, LayoutSettings(algorithm='layered'))
+
+    def test_layouts_are_cached_by_structure(self) -> None:
+        graph = _graph([(0, 1), (1, 2), (2, 3)])
+        positions = compute_layout(graph)
+        renamed = graph.model_copy(update={'name': 'renamed'})
+        assert compute_layout(renamed) == positions
+        assert self.cache.stats().hits == 1
+        compute_layout(graph, LayoutSettings(algorithm='force'))
+        assert self.cache.stats().entries == 2
+
+    def test_force_layout_separates_the_nodes(self) -> None:
+        rng = np.random.default_rng(0)
+        sources = np.arange(1, 50)
+        targets = rng.integers(0, sources)
+        pos = force_layout(50, sources, targets, LayoutSettings())
+        distances = np.linalg.norm(pos[:, None] - pos[None], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        assert distances.min() > 30
+
+    def test_tree_repulsion_approximates_the_exact_repulsion(self) -> None:
+        pos = np.random.default_rng(0).normal(0, 10, size=(1000, 2))
+        exact = _exact_repulsion(pos)
+        error = np.linalg.norm(_tree_repulsion(pos) - exact) / np.linalg.norm(exact)
+        assert error < 0.02
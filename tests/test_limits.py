@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import unittest
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+import httpx
+import openai
+import pytest
+
+from llm_graphs.limits import (
+    AdaptiveConcurrency,
+    LimitSettings,
+    ModelLimiter,
+    TokenBucket,
+    limiter_from_env,
+    retry_after_seconds,
+)
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+def _status_error(status_code: int, headers: dict) -> openai.APIStatusError:
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request('POST', 'https://api.openai.com'))
+    error_class = openai.RateLimitError if status_code == 429 else openai.InternalServerError
+    return error_class('error', response=response, body=None)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve_waits_once_the_bucket_is_empty(self) -> None:
+        bucket = TokenBucket(rate_per_minute=60)
+        assert bucket.reserve(60) == 0
+        assert bucket.reserve(30) == pytest.approx(30, abs=0.1)
+        bucket.adjust(-30)
+        assert bucket.reserve(1) == pytest.approx(1, abs=0.1)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def test_aimd(self) -> None:
+        concurrency = AdaptiveConcurrency(initial=8, minimum=2, maximum=9)
+        concurrency.acquire()
+        concurrency.release('overload')
+        assert concurrency.limit == 4
+        concurrency.acquire()
+        concurrency.release('success')
+        assert concurrency.limit == 4.25
+        concurrency.acquire()
+        concurrency.release('error')
+        assert concurrency.limit == 4.25
+        for _ in range(3):
+            concurrency.acquire()
+            concurrency.release('overload')
+        assert concurrency.limit == 2
+
+    def test_invalid_limits(self) -> None:
+        with pytest.raises(ValueError, match='1 <= minimum'):
+            AdaptiveConcurrency(initial=1, minimum=2)
+
+
+class TestModelLimiter(unittest.IsolatedAsyncioTestCase):
+    def test_retry_after(self) -> None:
+        assert retry_after_seconds(_status_error(429, {'retry-after': '3'})) == 3
+        assert retry_after_seconds(_status_error(429, {'retry-after-ms': '250'})) == 0.25
+        assert retry_after_seconds(_status_error(429, {})) is None
+        wrapped = RuntimeError('instructor error')
+        wrapped.__cause__ = _status_error(429, {'retry-after': '2'})
+        assert retry_after_seconds(wrapped) == 2
+
+    @patch('llm_graphs.limits.time.sleep')
+    def test_call_retries_rate_limits_honouring_retry_after(self, sleep: MagicMock) -> None:
+        limiter = ModelLimiter(LimitSettings(max_retries=3, base_delay=0.01))
+        fn = MagicMock(side_effect=[_status_error(429, {'retry-after': '5'}), _status_error(503, {}), 'response'])
+        assert limiter.call(fn, MESSAGES, lambda _: None) == 'response'
+        delays = [call.args[0] for call in sleep.call_args_list if call.args[0] > 0]
+        assert delays[0] == 5
+        assert 0 < delays[1] <= 0.02
+        stats = limiter.stats()
+        assert (stats.retries, stats.rate_limited, stats.server_errors, stats.failures) == (2, 1, 1, 0)
+        assert stats.concurrency_limit < LimitSettings().initial_concurrency
+
+    def test_call_gives_up(self) -> None:
+        limiter = ModelLimiter(LimitSettings(max_retries=2))
+        fn = MagicMock(side_effect=_status_error(429, {}))
+        with patch('llm_graphs.limits.time.sleep'), pytest.raises(openai.RateLimitError):
+            limiter.call(fn, MESSAGES, lambda _: None)
+        assert fn.call_count == 3
+        fn = MagicMock(side_effect=ValueError('not retryable'))
+        with pytest.raises(ValueError, match='not retryable'):
+            limiter.call(fn, MESSAGES, lambda _: None)
+        assert fn.call_count == 1
+        assert limiter.stats().failures == 2
+
+    async def test_acall_caps_the_concurrency(self) -> None:
+        limiter = ModelLimiter(LimitSettings(initial_concurrency=2, max_concurrency=2))
+        running = 0
+        max_running = 0
+
+        async def fn() -> str:
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return 'response'
+
+        responses = await asyncio.gather(*(limiter.acall(fn, MESSAGES, lambda _: None) for _ in range(6)))
+        assert responses == ['response'] * 6
+        assert max_running == 2
+        assert limiter.stats().in_flight == 0
+
+    async def test_aslot_is_held_until_the_block_exits(self) -> None:
+        limiter = ModelLimiter(LimitSettings(tokens_per_minute=10000, expected_completion_tokens=100))
+        async with limiter.aslot(MESSAGES) as settle:
+            assert limiter.stats().in_flight == 1
+            settle(5000)
+        assert limiter.stats().in_flight == 0
+        # 5000 tokens are left, the 1000 missing ones take 6 seconds to refill
+        assert limiter.tokens is not None
+        assert limiter.tokens.reserve(6000) == pytest.approx(6, abs=0.1)
+
+    async def test_aslot_counts_the_errors_without_retrying(self) -> None:
+        limiter = ModelLimiter()
+        with pytest.raises(openai.RateLimitError):
+            async with limiter.aslot(MESSAGES):
+                raise _status_error(429, {})
+        stats = limiter.stats()
+        assert (stats.in_flight, stats.rate_limited, stats.retries, stats.failures) == (0, 1, 0, 1)
+        assert stats.concurrency_limit < LimitSettings().initial_concurrency
+
+
+class TestLimiterFromEnv(unittest.TestCase):
+    def test_limiting_is_opt_in(self) -> None:
+        with patch.dict(os.environ, {}, clear=True):
+            assert limiter_from_env() is None
+        with patch.dict(os.environ, {'LLM_GRAPHS_LIMITS': '1'}, clear=True):
+            limiter = limiter_from_env()
+            assert limiter is not None
+            assert limiter.default_settings.requests_per_minute is None
+        with patch.dict(os.environ, {'LLM_GRAPHS_RPM': '500'}, clear=True):
+            limiter = limiter_from_env()
+            assert limiter is not None
+            assert limiter.default_settings.requests_per_minute == 500
+
+
+if __name__ == '__main__':
+    unittest.main()
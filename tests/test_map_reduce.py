@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import unittest
+from typing import (
+    List,
+    Tuple,
+)
+from unittest.mock import MagicMock
+
+import pytest
+
+from llm_graphs.cache import set_cache
+from llm_graphs.map_reduce import (
+    GraphMerger,
+    MapReduceSettings,
+    abuild_graph_from_text,
+    chunk_text,
+    normalize_name,
+)
+from llm_graphs.models import (
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+
+
+def _graph(names: List[str], links: List[Tuple[int, int]], first_id: int = 0) -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[Node(node_id=first_id + i, name=name, description=name) for i, name in enumerate(names)],
+        links=[
+            Link(link_id=i, name=f'link {i}', node_id_from=first_id + a, node_id_to=first_id + b, description='')
+            for i, (a, b) in enumerate(links)
+        ],
+        name='chunk',
+        reasoning='',
+    )
+
+
+class TestChunkText(unittest.TestCase):
+    def test_chunks_are_bounded_and_overlap(self) -> None:
+        text = ' '.join(f'word{i}.' for i in range(2000))
+        blocks = [text[i : i + 1000] for i in range(0, len(text), 1000)]
+        chunks = list(chunk_text(blocks, chunk_chars=1000, overlap_chars=100))
+        assert all(len(chunk) <= 1000 for chunk in chunks)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            assert chunk[:20] in previous[-100:]
+        assert chunks[0].startswith('word0.')
+        assert chunks[-1].endswith('word1999.')
+
+    def test_short_text(self) -> None:
+        assert list(chunk_text(['A short text.'], chunk_chars=1000, overlap_chars=100)) == ['A short text.']
+        assert list(chunk_text(['  ', ''], chunk_chars=1000, overlap_chars=100)) == []
+
+    def test_overlap_is_checked(self) -> None:
+        with pytest.raises(ValueError, match='overlap_chars'):
+            list(chunk_text(['text'], chunk_chars=100, overlap_chars=60))
+
+
+class TestGraphMerger(unittest.TestCase):
+    def test_normalize_name(self) -> None:
+        assert normalize_name('The  White-Whale!') == 'white whale'
+        assert normalize_name('Achab') == normalize_name('achab')
+        assert normalize_name('Éléonore') == 'eleonore'
+        assert normalize_name('The') == 'the'
+
+    def test_nodes_are_deduplicated_and_ids_remapped(self) -> None:
+        merger = GraphMerger()
+        merger.add(_graph(['Ahab', 'The White Whale'], [(0, 1)]))
+        merger.add(_graph(['white whale', 'Ishmael', 'Ahab'], [(2, 0), (1, 0)], first_id=10))
+        graph = merger.graph('Moby Dick', '', max_nodes=10, max_links=10)
+        assert [node.name for node in graph.nodes] == ['Ahab', 'The White Whale', 'Ishmael']
+        assert [node.node_id for node in graph.nodes] == [0, 1, 2]
+        # The link between Ahab and the whale was seen twice and comes first
+        assert [(link.node_id_from, link.node_id_to) for link in graph.links] == [(0, 1), (2, 1)]
+        assert [link.link_id for link in graph.links] == [0, 1]
+
+    def test_pruning_keeps_the_most_seen_nodes(self) -> None:
+        merger = GraphMerger()
+        merger.add(_graph(['a', 'b', 'c', 'd'], [(0, 1), (1, 2), (2, 3)]))
+        merger.add(_graph(['a', 'b', 'c'], [(0, 1), (1, 2)]))
+        graph = merger.graph('book', '', max_nodes=3, max_links=1)
+        assert [node.name for node in graph.nodes] == ['a', 'b']
+        assert len(graph.links) == 1
+
+    def test_pending_nodes_are_bounded(self) -> None:
+        merger = GraphMerger(max_pending_nodes=10)
+        merger.add(_graph(['kept', 'other'], [(0, 1)]))
+        for i in range(20):
+            merger.add(_graph(['kept', f'node {i}'], [(0, 1)]))
+            assert len(merger._nodes) <= 10
+        graph = merger.graph('book', '', max_nodes=10, max_links=10)
+        assert graph.nodes[0].name == 'kept'
+
+
+class TestBuildGraphFromText(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.client = MagicMock()
+        self.client.chat.completions.create = self.create
+
+    async def create(self, model: str, response_model: type, messages: list) -> object:  # noqa: ARG002
+        content = messages[1]['content']
+        if 'Excerpt 2 ' in content:
+            raise RuntimeError('LLM error')
+        return _graph(['Ahab', 'Whale', content.split('<excerpt>\n')[1].split()[0]], [(0, 1), (2, 0)])
+
+    async def test_chunk_graphs_are_merged(self) -> None:
+        chunks = ['Ishmael sails.', 'Queequeg sails.', 'Starbuck sails.']
+        result = await abuild_graph_from_text('Moby Dick', chunks, MapReduceSettings(max_concurrency=2), self.client)
+        assert result.success
+        assert result.errors == ['Chunk 1: LLM error']
+        assert result.usage.calls == 2
+        assert sorted(node.name for node in result.graph.nodes) == ['Ahab', 'Ishmael', 'Starbuck', 'Whale']
+
+    async def test_empty_text(self) -> None:
+        result = await abuild_graph_from_text('Moby Dick', [], client=self.client)
+        assert not result.success
+        assert result.errors == ['The text is empty']
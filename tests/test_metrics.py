@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    MagicMock,
+)
+
+import pytest
+
+from llm_graphs.cache import set_cache
+from llm_graphs.metrics import (
+    LLM_CALLS,
+    STEP_DURATION,
+    Counter,
+    Histogram,
+    MetricsRegistry,
+    set_metrics_enabled,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+)
+from llm_graphs.step import (
+    arate_graph,
+    astream_seed_graph,
+    rate_graph,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self) -> None:
+        registry = MetricsRegistry()
+        counter = Counter('calls_total', 'Calls.', ('model',))
+        histogram = Histogram('duration_seconds', 'Duration.', buckets=(1, 2))
+        registry.register(counter)
+        registry.register(histogram)
+        counter.inc(model='gpt-4o')
+        counter.inc(2, model='gpt-4o')
+        histogram.observe(1.5)
+        histogram.observe(3)
+        assert registry.render() == (
+            '# HELP calls_total Calls.\n'
+            '# TYPE calls_total counter\n'
+            'calls_total{model="gpt-4o"} 3\n'
+            '# HELP duration_seconds Duration.\n'
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{le="1"} 0\n'
+            'duration_seconds_bucket{le="2"} 1\n'
+            'duration_seconds_bucket{le="+Inf"} 2\n'
+            'duration_seconds_sum 4.5\n'
+            'duration_seconds_count 2\n'
+        )
+
+    def test_labels_are_checked(self) -> None:
+        with pytest.raises(ValueError, match='expects the labels'):
+            Counter('calls_total', 'Calls.', ('model',)).inc(step='rate_graph')
+
+    def test_disabled_metrics_are_not_recorded(self) -> None:
+        counter = Counter('calls_total', 'Calls.')
+        self.addCleanup(set_metrics_enabled, set_metrics_enabled(False))
+        counter.inc()
+        assert counter.value() == 0
+
+
+class TestStepMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.addCleanup(set_metrics_enabled, set_metrics_enabled(True))
+        self.graph = KnowledgeGraph(nodes=[], links=[], name='Test Graph', reasoning='')
+
+    async def test_steps_are_timed(self) -> None:
+        model = 'test-metrics-model'
+        client = MagicMock()
+        client.chat.completions.create = MagicMock(return_value=Feedback(rating=8, opinion=''))
+        rate_graph(model, 'goal', 'meaning', self.graph, client=client)
+        async_client = MagicMock()
+        async_client.chat.completions.create = AsyncMock(side_effect=RuntimeError('LLM error'))
+        with pytest.raises(RuntimeError, match='LLM error'):
+            await arate_graph(model, 'goal', 'meaning', self.graph, client=async_client)
+        assert STEP_DURATION.count(step='rate_graph', model=model, outcome='success') == 1
+        assert STEP_DURATION.count(step='rate_graph', model=model, outcome='error') == 1
+        assert LLM_CALLS.value(model=model, outcome='success') == 1
+        assert LLM_CALLS.value(model=model, outcome='error') == 1
+
+    async def test_streaming_steps_are_timed(self) -> None:
+        model = 'test-stream-metrics-model'
+
+        async def create_partial(**_: object):  # type: ignore
+            yield self.graph
+
+        client = MagicMock()
+        client.chat.completions.create_partial = create_partial
+        events = [event async for event in astream_seed_graph(model, 'goal', 'meaning', client=client)]
+        assert events == [self.graph]
+        assert STEP_DURATION.count(step='stream_seed_graph', model=model, outcome='success') == 1
+        assert LLM_CALLS.value(model=model, outcome='success') == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
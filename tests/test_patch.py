@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    MagicMock,
+)
+
+import pytest
+
+from llm_graphs.cache import set_cache
+from llm_graphs.models import (
+    Feedback,
+    GraphEdit,
+    GraphPatch,
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+from llm_graphs.patch import (
+    PatchError,
+    apply_patch,
+)
+from llm_graphs.step import (
+    anew_graph_from_feedback,
+    new_graph_from_feedback,
+)
+
+
+def _graph() -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[
+            Node(node_id=1, name='Ahab', description='The captain.'),
+            Node(node_id=2, name='Whale', description='The white whale.'),
+            Node(node_id=3, name='Ishmael', description='The narrator.'),
+        ],
+        links=[
+            Link(link_id=1, name='hunts', node_id_from=1, node_id_to=2, description=''),
+            Link(link_id=2, name='follows', node_id_from=3, node_id_to=1, description=''),
+        ],
+        name='Moby Dick',
+        reasoning='',
+    )
+
+
+def _patch(*edits: GraphEdit) -> GraphPatch:
+    return GraphPatch(edits=list(edits), reasoning='patched')
+
+
+class TestApplyPatch(unittest.TestCase):
+    def test_edits(self) -> None:
+        patch = _patch(
+            GraphEdit(operation='add_node', node_id=4, name='Starbuck'),
+            GraphEdit(operation='add_link', link_id=3, node_id_from=4, node_id_to=1, name='advises'),
+            GraphEdit(operation='rename_node', node_id=2, name='Moby Dick'),
+            GraphEdit(operation='relabel_link', link_id=1, description='Ahab hunts the whale.'),
+            GraphEdit(operation='remove_node', node_id=3),
+        )
+        graph = apply_patch(_graph(), patch)
+        assert [(node.node_id, node.name) for node in graph.nodes] == [(1, 'Ahab'), (2, 'Moby Dick'), (4, 'Starbuck')]
+        assert [(link.link_id, link.node_id_from, link.node_id_to) for link in graph.links] == [(1, 1, 2), (3, 4, 1)]
+        assert graph.links[0].name == 'hunts'
+        assert graph.links[0].description == 'Ahab hunts the whale.'
+        assert graph.nodes[1].description == 'The white whale.'
+        assert graph.reasoning == 'patched'
+        assert len(_graph().nodes) == 3
+
+    def test_remove_link(self) -> None:
+        graph = apply_patch(_graph(), _patch(GraphEdit(operation='remove_link', link_id=2)))
+        assert [link.link_id for link in graph.links] == [1]
+
+    def test_invalid_edits(self) -> None:
+        invalid_edits = [
+            GraphEdit(operation='add_node', node_id=1, name='Ahab'),
+            GraphEdit(operation='add_node', name='Starbuck'),
+            GraphEdit(operation='remove_node', node_id=9),
+            GraphEdit(operation='rename_node', node_id=1),
+            GraphEdit(operation='add_link', link_id=1, node_id_from=1, node_id_to=3, name='knows'),
+            GraphEdit(operation='add_link', link_id=3, node_id_from=1, node_id_to=9, name='knows'),
+            GraphEdit(operation='add_link', link_id=3, node_id_from=1, node_id_to=1, name='knows'),
+            GraphEdit(operation='remove_link', link_id=9),
+        ]
+        for edit in invalid_edits:
+            with self.subTest(edit=edit), pytest.raises(PatchError):
+                apply_patch(_graph(), _patch(edit))
+
+    def test_edits_see_the_previous_edits(self) -> None:
+        patch = _patch(
+            GraphEdit(operation='remove_node', node_id=3),
+            GraphEdit(operation='relabel_link', link_id=2, name='follows'),
+        )
+        with pytest.raises(PatchError):
+            apply_patch(_graph(), patch)
+
+
+class TestPatchMode(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.feedbacks = [Feedback(rating=5, opinion='Rename the whale')]
+        self.full_graph = _graph().model_copy(update={'name': 'full'})
+
+    async def test_patch_is_applied(self) -> None:
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(
+            return_value=_patch(GraphEdit(operation='rename_node', node_id=2, name='Moby Dick')),
+        )
+        graph = await anew_graph_from_feedback(
+            'gpt-4o',
+            'goal',
+            'meaning',
+            _graph(),
+            self.feedbacks,
+            client=client,
+            improve_mode='patch',
+        )
+        assert graph.nodes[1].name == 'Moby Dick'
+        kwargs = client.chat.completions.create.call_args.kwargs
+        assert kwargs['response_model'] is GraphPatch
+        assert 'the new node ids start at 4' in kwargs['messages'][1]['content']
+
+    def test_invalid_patch_falls_back_to_a_full_graph(self) -> None:
+        client = MagicMock()
+        client.chat.completions.create.side_effect = [
+            _patch(GraphEdit(operation='remove_node', node_id=9)),
+            self.full_graph,
+        ]
+        graph = new_graph_from_feedback(
+            'gpt-4o',
+            'goal',
+            'meaning',
+            _graph(),
+            self.feedbacks,
+            client=client,
+            improve_mode='patch',
+        )
+        assert graph == self.full_graph
+        response_models = [call.kwargs['response_model'] for call in client.chat.completions.create.call_args_list]
+        assert response_models == [GraphPatch, KnowledgeGraph]
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import unittest
+from unittest.mock import MagicMock
+
+import pytest
+
+from llm_graphs.cache import set_cache
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+from llm_graphs.pipeline import (
+    PipelineSettings,
+    abuild_book_graphs,
+)
+
+
+def _graph(name: str) -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[Node(node_id=1, name='a', description=''), Node(node_id=2, name='b', description='')],
+        links=[Link(link_id=1, name='ab', node_id_from=1, node_id_to=2, description='')],
+        name=name,
+        reasoning='',
+    )
+
+
+class TestBuildBookGraphs(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.client = MagicMock()
+        self.client.chat.completions.create = self.create
+        self.running = 0
+        self.max_running = 0
+
+    async def create(self, model: str, response_model: type, messages: list) -> object:  # noqa: ARG002
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if 'Book 3' in messages[1]['content']:
+                raise RuntimeError('LLM error')
+            if response_model is Feedback:
+                return Feedback(rating=5, opinion='')
+            return _graph('graph')
+        finally:
+            self.running -= 1
+
+    async def test_each_book_gets_its_own_result(self) -> None:
+        books = [f'Book {i}' for i in range(6)]
+        results = [
+            result
+            async for result in abuild_book_graphs(
+                books,
+                PipelineSettings(rounds=1),
+                max_concurrency=2,
+                client=self.client,
+            )
+        ]
+        assert sorted(result.index for result in results) == list(range(6))
+        by_index = {result.index: result for result in results}
+        assert not by_index[3].success
+        assert by_index[3].errors == ['LLM error']
+        assert by_index[3].graph is None
+        assert by_index[0].success
+        assert by_index[0].book_name == 'Book 0'
+        assert by_index[0].feedbacks == [Feedback(rating=5, opinion='')]
+        assert by_index[0].usage.calls == 3
+        assert self.max_running <= 2
+
+    async def test_invalid_concurrency(self) -> None:
+        with pytest.raises(ValueError, match='max_concurrency'):
+            [result async for result in abuild_book_graphs(['Book'], max_concurrency=0, client=self.client)]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,35 @@
 from __future__ import annotations
 
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+import pytest
 
 from llm_graphs.agents.rating_agent import RatingGraphCreator
+from llm_graphs.cache import set_cache
 from llm_graphs.models import (
     Feedback,
     KnowledgeGraph,
+    Link,
+    Node,
 )
 
 
+def _graph(name: str) -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[Node(node_id=1, name='a', description=''), Node(node_id=2, name='b', description='')],
+        links=[Link(link_id=1, name='ab', node_id_from=1, node_id_to=2, description='')],
+        name=name,
+        reasoning='',
+    )
+
+
 class TestRatingGraphCreator(unittest.TestCase):
     def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
         self.book_name = 'Test Book'
         self.mock_client = MagicMock()
         self.creator = RatingGraphCreator(self.book_name)
@@ -77,5 +95,49 @@ class TestRatingGraphCreator(unittest.TestCase):
         assert '- Rating: 8/10 Opinion: Test opinion' in generate_from_rating_prompt
 
 
+class TestRefineUntil(unittest.TestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        with patch('llm_graphs.agents.rating_agent.get_client', return_value=MagicMock()):
+            self.creator = RatingGraphCreator('Test Book')
+
+    def _responses(self, ratings: list) -> None:
+        responses = [_graph('graph 0')]
+        for i, rating in enumerate(ratings):
+            responses += [Feedback(rating=rating, opinion=''), _graph(f'graph {i + 1}')]
+        self.creator._client.chat.completions.create = MagicMock(side_effect=responses)
+
+    def test_stops_on_plateau_and_returns_the_best_graph(self) -> None:
+        self._responses([5, 7, 7, 6])
+        result = self.creator.refine_until(patience=2)
+        assert result.stop_reason == 'plateau'
+        assert result.iterations == 4
+        assert result.graph.name == 'graph 1'
+        assert result.rating == 7
+        assert self.creator.get_graph(result.ix) == result.graph
+        assert result.usage.calls == 8
+        history = self.creator._graphs_history
+        assert len(history) == 4
+        assert [entry['usage'].calls for entry in history] == [2, 2, 2, 2]
+        assert all(entry['latency_seconds'] >= 0 for entry in history)
+
+    def test_stops_on_target_rating(self) -> None:
+        self._responses([5, 9])
+        result = self.creator.refine_until(target_rating=9)
+        assert result.stop_reason == 'target_rating'
+        assert result.graph.name == 'graph 1'
+
+    def test_stops_before_exceeding_the_calls_budget(self) -> None:
+        self._responses([5, 6, 7])
+        result = self.creator.refine_until(max_calls=5)
+        assert result.stop_reason == 'max_calls'
+        assert result.usage.calls == 4
+        assert result.graph.name == 'graph 1'
+
+    def test_invalid_arguments(self) -> None:
+        with pytest.raises(ValueError, match='patience'):
+            self.creator.refine_until(patience=0)
+
+
 if __name__ == '__main__':
     unittest.main()
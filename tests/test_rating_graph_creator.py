@@ -5,8 +5,14 @@ import unittest
 from llm_graphs.models import (
     Feedback,
     KnowledgeGraph,
+    Link,
+    Node,
 )
 from llm_graphs.prompts import (
+    COMPACT_GRAPH_ENCODING,
+    GraphEncoding,
+    encode_graph,
+    rate_prompt_size_report,
     system_graph_creator,
     user_generate_graph,
     user_improve_from_feedback,
@@ -53,5 +59,51 @@ class TestPrompts(unittest.TestCase):
         assert 'Needs improvement in structure.' in actual['content'], actual['content']  # type: ignore
 
 
+class TestGraphEncoding(unittest.TestCase):
+    def setUp(self) -> None:
+        self.knowledge_graph = KnowledgeGraph(
+            nodes=[
+                Node(node_id=1, name='Prince', description='The little prince'),
+                Node(node_id=2, name='Rose', description='His | rose'),
+            ],
+            links=[Link(link_id=1, name='loves', node_id_from=1, node_id_to=2, description='He loves\nher')],
+            name='Test Graph',
+            reasoning='A long reasoning that is not needed to rate the graph.',
+        )
+        self.goal_str = 'Generate a graph that will help the reader understand the structure of the book.'
+        self.meaning_str = '- The graph explains the book.'
+
+    def test_json_encoding_is_the_default(self) -> None:
+        assert encode_graph(self.knowledge_graph) == self.knowledge_graph.model_dump_json()
+        without_reasoning = encode_graph(self.knowledge_graph, GraphEncoding(include_reasoning=False))
+        assert 'reasoning' not in without_reasoning
+
+    def test_compact_encoding(self) -> None:
+        encoded = encode_graph(self.knowledge_graph, COMPACT_GRAPH_ENCODING)
+        assert encoded.splitlines() == [
+            'name: Test Graph',
+            'nodes (node_id|name|description):',
+            '1|Prince|The little prince',
+            '2|Rose|His / rose',
+            'links (link_id|node_id_from|node_id_to|name|description):',
+            '1|1|2|loves|He loves her',
+        ]
+        rate_prompt = user_rate_graph(self.goal_str, self.meaning_str, self.knowledge_graph, COMPACT_GRAPH_ENCODING)
+        assert encoded in rate_prompt['content']  # type: ignore
+
+    def test_prompt_size_report(self) -> None:
+        json_report = rate_prompt_size_report(self.goal_str, self.meaning_str, self.knowledge_graph)
+        compact_report = rate_prompt_size_report(
+            self.goal_str,
+            self.meaning_str,
+            self.knowledge_graph,
+            COMPACT_GRAPH_ENCODING,
+        )
+        assert set(json_report.sections) == {'graph', 'goal', 'meaning', 'template'}
+        assert sum(section.chars for section in json_report.sections.values()) == json_report.total.chars
+        assert compact_report.sections['graph'].chars < json_report.sections['graph'].chars
+        assert compact_report.total.estimated_tokens < json_report.total.estimated_tokens
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import (
+    AsyncMock,
+    patch,
+)
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.main import app
+from api.sessions import (
+    Session,
+    SessionStore,
+    set_session_store,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+    RatingBatch,
+)
+
+
+def _graph(name: str = 'graph') -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[
+            Node(node_id=1, name='Dune', description='A desert planet.'),
+            Node(node_id=2, name='Spice', description='A rare drug.'),
+        ],
+        links=[Link(link_id=1, name='produces', node_id_from=1, node_id_to=2, description='Dune produces spice.')],
+        name=name,
+        reasoning='',
+    )
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = str(Path(directory.name) / 'sessions.sqlite3')
+
+    def test_entries(self) -> None:
+        session = Session(book_name='Dune').with_graph(_graph('first')).with_graph(_graph('second'))
+        assert session.entry(-1).graph.name == 'second'
+        assert session.entry(0).graph.name == 'first'
+        with pytest.raises(IndexError):
+            session.entry(2)
+        rated = session.with_entry(
+            -2,
+            session.entry(-2).model_copy(update={'rating': [Feedback(rating=5, opinion='')]}),
+        )
+        assert rated.entry(0).rating is not None
+        assert session.entry(0).rating is None
+        assert rated.summary()['num_graphs'] == 2
+
+    def test_memory_sessions_are_evicted(self) -> None:
+        store = SessionStore(max_sessions=2)
+        sessions = [store.create('Dune') for _ in range(3)]
+        assert store.get(sessions[0].session_id) is None
+        assert store.get(sessions[2].session_id) == sessions[2]
+        stats = store.stats()
+        assert (stats.evictions, stats.sessions, stats.hits, stats.misses) == (1, 2, 1, 1)
+
+    def test_sqlite_sessions_survive_restarts_and_evictions(self) -> None:
+        store = SessionStore(max_sessions=1, path=self.path)
+        session = store.save(Session(book_name='Dune').with_graph(_graph()))
+        store.create('Emma')
+        assert store.get(session.session_id) == session
+        assert store.stats().loads == 1
+        store.close()
+
+        store = SessionStore(path=self.path)
+        self.addCleanup(store.close)
+        assert store.get(session.session_id) == session
+        assert store.delete(session.session_id)
+        assert store.get(session.session_id) is None
+        assert not store.delete(session.session_id)
+
+    def test_expired_sessions(self) -> None:
+        store = SessionStore(ttl=60)
+        session = store.save(Session(book_name='Dune'))
+        with patch('api.sessions.time.time', return_value=session.updated_at + 61):
+            assert store.get(session.session_id) is None
+        assert store.stats().expirations == 1
+
+    def test_saves_purge_the_expired_sqlite_sessions(self) -> None:
+        store = SessionStore(max_sessions=1, path=self.path, ttl=60)
+        self.addCleanup(store.close)
+        expired = store.create('Dune')
+        with patch('api.sessions.time.time', return_value=expired.updated_at + 61):
+            kept = store.create('Emma')
+        connection = sqlite3.connect(self.path)
+        self.addCleanup(connection.close)
+        assert connection.execute('SELECT session_id FROM sessions').fetchall() == [(kept.session_id,)]
+        assert store.stats().expirations == 1
+
+
+class TestSessionEndpoints(unittest.TestCase):
+    def setUp(self) -> None:
+        previous = set_session_store(SessionStore())
+        self.addCleanup(set_session_store, previous)
+        self.client = TestClient(app)
+        self.rate = AsyncMock(return_value=RatingBatch(feedbacks=[Feedback(rating=6, opinion='Fine')], errors=[]))
+        self.improve = AsyncMock(return_value=_graph('improved'))
+        for name, mock in (('_rate', self.rate), ('_improved_graph', self.improve)):
+            patcher = patch(f'api.main.{name}', mock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _create(self) -> str:
+        response = self.client.post('/v1/sessions', json={'book_name': 'Dune', 'graph': _graph().model_dump()})
+        assert response.status_code == 200
+        assert response.json()['output']['num_graphs'] == 1
+        return response.json()['output']['session_id']
+
+    def test_rate_and_improve_without_the_graph(self) -> None:
+        session_id = self._create()
+        response = self.client.post(f'/v1/sessions/{session_id}/rate_and_improve', json={'num_ratings': 2})
+        assert response.status_code == 200
+        assert response.json()['output']['ix'] == 1
+        assert self.rate.await_args.args[:2] == ('Dune', _graph())
+        assert self.improve.await_args.args[2] == [Feedback(rating=6, opinion='Fine')]
+
+        first = self.client.get(f'/v1/sessions/{session_id}/graphs/0').json()['output']
+        assert first['rating'] == [{'rating': 6, 'opinion': 'Fine'}]
+        last = self.client.get(f'/v1/sessions/{session_id}/graphs/-1').json()['output']
+        assert (last['graph']['name'], last['rating']) == ('improved', None)
+        assert self.client.get(f'/v1/sessions/{session_id}/graphs/2').status_code == 404
+
+    def test_improve_needs_a_rating(self) -> None:
+        session_id = self._create()
+        assert self.client.post(f'/v1/sessions/{session_id}/improve', json={}).status_code == 409
+        assert self.client.post(f'/v1/sessions/{session_id}/rate', json={}).status_code == 200
+        response = self.client.post(f'/v1/sessions/{session_id}/improve', json={'ix': 0})
+        assert response.json()['output']['graph']['name'] == 'improved'
+        assert self.client.get(f'/v1/sessions/{session_id}').json()['output']['num_graphs'] == 2
+
+    def test_unknown_and_deleted_sessions(self) -> None:
+        session_id = self._create()
+        assert self.client.delete(f'/v1/sessions/{session_id}').status_code == 200
+        assert self.client.get(f'/v1/sessions/{session_id}').status_code == 404
+        assert self.client.post(f'/v1/sessions/{session_id}/rate', json={}).status_code == 404
+        assert self.client.delete(f'/v1/sessions/{session_id}').status_code == 404
+
+    def test_invalid_graph(self) -> None:
+        graph = _graph().model_dump()
+        graph['links'][0]['node_id_to'] = 3
+        body = {'book_name': 'Dune', 'graph': graph, 'repair': False}
+        assert self.client.post('/v1/sessions', json=body).status_code == 422
+        response = self.client.post('/v1/sessions', json={**body, 'repair': True})
+        assert response.status_code == 200
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    MagicMock,
+)
+
+import pytest
+
+from llm_graphs.cache import (
+    MemoryCache,
+    set_cache,
+)
+from llm_graphs.limits import (
+    RateLimiter,
+    set_limiter,
+)
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+)
+from llm_graphs.step import (
+    agenerate_seed_graph,
+    anew_graph_from_feedback,
+    arate_graph,
+    arate_graph_many,
+    astream_seed_graph,
+    generate_seed_graph,
+    rate_graph_many,
+)
+
+
+class TestAsyncStep(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.mock_client = MagicMock()
+        self.mock_client.chat.completions.create = AsyncMock()
+        self.mock_graph = KnowledgeGraph(nodes=[], links=[], name='Test Graph', reasoning='Test reasoning')
+        self.mock_feedback = Feedback(rating=8, opinion='Test opinion')
+
+    async def test_agenerate_seed_graph(self) -> None:
+        self.mock_client.chat.completions.create.return_value = self.mock_graph
+        graph = await agenerate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        assert graph == self.mock_graph
+        kwargs = self.mock_client.chat.completions.create.call_args.kwargs
+        assert kwargs['response_model'] is KnowledgeGraph
+        assert 'goal' in kwargs['messages'][1]['content']
+
+    async def test_arate_graph(self) -> None:
+        self.mock_client.chat.completions.create.return_value = self.mock_feedback
+        feedback = await arate_graph('gpt-4o', 'goal', 'meaning', self.mock_graph, client=self.mock_client)
+        assert feedback == self.mock_feedback
+        kwargs = self.mock_client.chat.completions.create.call_args.kwargs
+        assert self.mock_graph.model_dump_json() in kwargs['messages'][1]['content']
+
+    async def test_anew_graph_from_feedback(self) -> None:
+        self.mock_client.chat.completions.create.return_value = self.mock_graph
+        graph = await anew_graph_from_feedback(
+            'gpt-4o',
+            'goal',
+            'meaning',
+            self.mock_graph,
+            [self.mock_feedback],
+            client=self.mock_client,
+        )
+        assert graph == self.mock_graph
+        kwargs = self.mock_client.chat.completions.create.call_args.kwargs
+        assert '- Rating: 8/10 Opinion: Test opinion' in kwargs['messages'][1]['content']
+
+    async def test_sync_and_async_send_the_same_messages(self) -> None:
+        sync_client = MagicMock()
+        sync_client.chat.completions.create.return_value = self.mock_graph
+        generate_seed_graph('gpt-4o', 'goal', 'meaning', client=sync_client)
+        self.mock_client.chat.completions.create.return_value = self.mock_graph
+        await agenerate_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)
+        assert (
+            sync_client.chat.completions.create.call_args.kwargs['messages']
+            == self.mock_client.chat.completions.create.call_args.kwargs['messages']
+        )
+
+
+class TestRatingFanOut(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(None))
+        self.mock_graph = KnowledgeGraph(nodes=[], links=[], name='Test Graph', reasoning='Test reasoning')
+        self.mock_feedback = Feedback(rating=8, opinion='Test opinion')
+
+    def test_rate_graph_many_keeps_partial_results(self) -> None:
+        client = MagicMock()
+        client.chat.completions.create.side_effect = [self.mock_feedback, RuntimeError('boom'), self.mock_feedback]
+        batch = rate_graph_many('gpt-4o', 'goal', 'meaning', self.mock_graph, num_ratings=3, client=client)
+        assert batch.feedbacks == [self.mock_feedback, self.mock_feedback]
+        assert batch.errors == ['boom']
+
+    def test_rate_graph_many_rejects_empty_batches(self) -> None:
+        with pytest.raises(ValueError, match='num_ratings'):
+            rate_graph_many('gpt-4o', 'goal', 'meaning', self.mock_graph, num_ratings=0, client=MagicMock())
+
+    async def test_arate_graph_many_respects_the_concurrency_cap(self) -> None:
+        in_flight = 0
+        max_in_flight = 0
+
+        async def create(**_: object) -> Feedback:
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return self.mock_feedback
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        batch = await arate_graph_many(
+            'gpt-4o',
+            'goal',
+            'meaning',
+            self.mock_graph,
+            num_ratings=5,
+            max_concurrency=2,
+            client=client,
+        )
+        assert len(batch.feedbacks) == 5
+        assert batch.errors == []
+        assert max_in_flight == 2
+
+
+class TestStreaming(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.addCleanup(set_cache, set_cache(MemoryCache()))
+        self.nodes = [Node(node_id=1, name='a', description='A'), Node(node_id=2, name='b', description='B')]
+        self.link = Link(link_id=1, name='ab', node_id_from=1, node_id_to=2, description='AB')
+        self.graph = KnowledgeGraph(nodes=self.nodes, links=[self.link], name='Test Graph', reasoning='reasoning')
+        self.partials = [
+            KnowledgeGraph.model_construct(nodes=[Node.model_construct(node_id=1)], links=None, name=None),
+            KnowledgeGraph.model_construct(nodes=self.nodes, links=None, name=None),
+            KnowledgeGraph.model_construct(nodes=self.nodes, links=[self.link], name=None),
+            self.graph,
+        ]
+        self.mock_client = MagicMock()
+
+    async def test_nodes_and_links_are_streamed_once_complete(self) -> None:
+        seen_partials = []
+
+        async def create_partial(**_: object):  # type: ignore
+            for partial in self.partials:
+                seen_partials.append(partial)
+                yield partial
+
+        async def events():  # type: ignore
+            async for event in astream_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client):
+                yield len(seen_partials), event
+
+        self.mock_client.chat.completions.create_partial = create_partial
+        received = [item async for item in events()]
+        assert received == [(2, self.nodes[0]), (3, self.nodes[1]), (4, self.link), (4, self.graph)]
+
+    async def test_the_stream_holds_a_slot_of_the_limiter(self) -> None:
+        limiter = RateLimiter()
+        self.addCleanup(set_limiter, set_limiter(limiter))
+        in_flight = []
+
+        async def create_partial(**_: object):  # type: ignore
+            for partial in self.partials:
+                in_flight.append(limiter.for_model('gpt-4o').stats().in_flight)
+                yield partial
+
+        self.mock_client.chat.completions.create_partial = create_partial
+        events = [event async for event in astream_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)]
+        assert events[-1] == self.graph
+        assert in_flight == [1] * len(self.partials)
+        assert limiter.for_model('gpt-4o').stats().in_flight == 0
+
+    async def test_cached_graphs_are_replayed(self) -> None:
+        async def create_partial(**_: object):  # type: ignore
+            for partial in self.partials:
+                yield partial
+
+        self.mock_client.chat.completions.create_partial = create_partial
+        first = [event async for event in astream_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)]
+        self.mock_client.chat.completions.create_partial = MagicMock()
+        second = [event async for event in astream_seed_graph('gpt-4o', 'goal', 'meaning', client=self.mock_client)]
+        assert first == second
+        self.mock_client.chat.completions.create_partial.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import unittest
+from unittest.mock import (
+    AsyncMock,
+    MagicMock,
+    patch,
+)
+
+from fastapi.testclient import TestClient
+
+from api.main import app
+from llm_graphs.models import (
+    Feedback,
+    KnowledgeGraph,
+    Link,
+    Node,
+    RatingBatch,
+)
+from llm_graphs.validation import (
+    ensure_valid_graph,
+    repair_graph,
+    validate_graph,
+)
+
+
+def _graph(node_ids: list[int], edges: list[tuple[int, int]]) -> KnowledgeGraph:
+    return KnowledgeGraph(
+        nodes=[Node(node_id=node_id, name=f'node {node_id}', description='') for node_id in node_ids],
+        links=[
+            Link(link_id=link_id, name='', node_id_from=node_from, node_id_to=node_to, description='')
+            for link_id, (node_from, node_to) in enumerate(edges)
+        ],
+        name='Test Graph',
+        reasoning='',
+    )
+
+
+class TestValidateGraph(unittest.TestCase):
+    def test_valid_graph(self) -> None:
+        assert validate_graph(_graph([1, 2, 3], [(1, 2), (2, 3), (1, 3)])).is_valid
+        assert validate_graph(_graph([], [])).is_valid
+
+    def test_reports_every_violation(self) -> None:
+        graph = _graph([1, 2, 3, 4, 5, 6, 7], [(1, 2), (2, 1), (3, 3), (1, 9), (4, 5), (2, 6)])
+        kinds = sorted(issue.kind for issue in validate_graph(graph).issues)
+        assert kinds == ['dangling_link', 'disconnected', 'isolated_node', 'isolated_node', 'self_loop', 'two_cycle']
+
+    def test_duplicate_ids(self) -> None:
+        graph = _graph([1, 1, 2], [(1, 2)])
+        graph.links.append(graph.links[0])
+        kinds = sorted(issue.kind for issue in validate_graph(graph).issues)
+        assert kinds == ['duplicate_link_id', 'duplicate_node_id']
+
+
+class TestRepairGraph(unittest.TestCase):
+    def test_repair_is_valid_and_deterministic(self) -> None:
+        graph = _graph([1, 2, 3, 4, 5, 6, 7], [(1, 2), (2, 1), (3, 3), (1, 9), (4, 5), (2, 6)])
+        repaired = repair_graph(graph)
+        assert validate_graph(repaired).is_valid
+        assert [node.node_id for node in repaired.nodes] == [1, 2, 6]
+        assert [(link.node_id_from, link.node_id_to) for link in repaired.links] == [(1, 2), (2, 6)]
+        assert repair_graph(graph) == repaired
+
+    def test_keep_all_components(self) -> None:
+        graph = _graph([1, 2, 3, 4], [(1, 2), (3, 4)])
+        assert len(repair_graph(graph, keep_largest_component=False).nodes) == 4
+
+
+class TestEnsureValidGraph(unittest.TestCase):
+    def test_valid_graphs_are_kept(self) -> None:
+        graph = _graph([1, 2], [(1, 2)])
+        regenerate = MagicMock()
+        assert ensure_valid_graph(graph, regenerate) is graph
+        regenerate.assert_not_called()
+
+    def test_unrepairable_graphs_are_requested_again(self) -> None:
+        valid_graph = _graph([1, 2], [(1, 2)])
+        regenerate = MagicMock(return_value=valid_graph)
+        assert ensure_valid_graph(_graph([1], [(1, 1)]), regenerate) == valid_graph
+        regenerate.assert_called_once()
+
+    def test_regeneration_without_repair(self) -> None:
+        regenerate = MagicMock(return_value=_graph([1, 2], [(1, 2), (2, 1)]))
+        graph = ensure_valid_graph(_graph([1, 2, 3], [(1, 2)]), regenerate, repair=False, max_regenerations=2)
+        assert regenerate.call_count == 2
+        assert not validate_graph(graph).is_valid
+
+
+class TestRateEndpoint(unittest.TestCase):
+    def test_invalid_graphs_are_repaired_before_being_rated(self) -> None:
+        rate = AsyncMock(return_value=RatingBatch(feedbacks=[Feedback(rating=6, opinion='Fine')], errors=[]))
+        body = {'book_name': 'Dune', 'graph': _graph([1, 2, 3], [(1, 2), (1, 9)]).model_dump()}
+        with patch('api.main._rate', rate):
+            client = TestClient(app)
+            assert client.post('/book_graph/rate', json=body).status_code == 200
+            assert rate.await_args.args[1] == _graph([1, 2], [(1, 2)])
+            assert client.post('/book_graph/rate', json={**body, 'repair': False}).status_code == 422
+        rate.assert_awaited_once()
+
+    def test_rate_and_improve_checks_the_graph_like_rate(self) -> None:
+        rate = AsyncMock(return_value=RatingBatch(feedbacks=[Feedback(rating=6, opinion='Fine')], errors=[]))
+        improve = AsyncMock(return_value=_graph([1, 2], [(1, 2)]))
+        body = {'book_name': 'Dune', 'graph': _graph([1, 2, 3], [(1, 2), (1, 9)]).model_dump()}
+        with patch('api.main._rate', rate), patch('api.main._improved_graph', improve):
+            client = TestClient(app)
+            assert client.post('/book_graph/rate_and_improve', json=body).status_code == 200
+            assert rate.await_args.args[1] == _graph([1, 2], [(1, 2)])
+            response = client.post('/book_graph/rate_and_improve', json={**body, 'repair': False})
+        assert response.status_code == 422
+        assert [issue['kind'] for issue in response.json()['detail']] == ['dangling_link', 'isolated_node']
+        rate.assert_awaited_once()
+
+
+if __name__ == '__main__':
+    unittest.main()